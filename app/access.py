@@ -0,0 +1,166 @@
+"""
+Userが見られるContentの絞り込み
+User -> Associate -> Space(M2M) -> Content の経路を
+Content.objects.visible_to(user) の準結合1つのクエリにする
+
+UserのSpaceのidはaccess_scopeの間保持し、ページごとにはサブクエリを繰り返さない
+visible_contentsを使うビューを加えたら、AccessScopeMiddlewareをMIDDLEWAREに加える
+(使うビューがない間は、リクエストごとのスコープの作成を省くため加えていない)
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.test import TestCase
+
+from app.models import Associate, Content, Plan, Space, Status, User
+from app.pagination import CONTENT_ORDERING
+from app.registry import status_registry
+from app.serializer import FastContentSerializer
+
+_space_ids = ContextVar("visible_space_ids", default=None)
+
+
+def _queryset(user_id):
+    return (
+        Space.associate.through.objects.filter(associate__user_id=user_id)
+        .values_list("space_id", flat=True)
+        .distinct()
+    )
+
+
+def visible_space_ids(user_id):
+    """user_idのUserがAssociateを通じて属するSpaceのid、スコープ内では1回だけ引く"""
+    scope = _space_ids.get()
+    if scope is not None and user_id in scope:
+        return scope[user_id]
+    space_ids = sorted(_queryset(user_id))
+    if scope is not None:
+        scope[user_id] = space_ids
+    return space_ids
+
+
+async def avisible_space_ids(user_id):
+    """visible_space_idsの非同期版"""
+    scope = _space_ids.get()
+    if scope is not None and user_id in scope:
+        return scope[user_id]
+    space_ids = sorted([pk async for pk in _queryset(user_id)])
+    if scope is not None:
+        scope[user_id] = space_ids
+    return space_ids
+
+
+def visible_contents(user_id, queryset=None):
+    """user_idのUserが見られるContent、SpaceのidはスコープのものをSQLに埋め込む"""
+    queryset = Content.objects.all() if queryset is None else queryset
+    return queryset.visible_to(user_id, visible_space_ids(user_id))
+
+
+@contextmanager
+def access_scope():
+    """ブロック内でUserのSpaceのidを共有する"""
+    token = _space_ids.set({})
+    try:
+        yield
+    finally:
+        _space_ids.reset(token)
+
+
+class AccessScopeMiddleware:
+    """リクエストごとにUserのSpaceのidのキャッシュを作る"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with access_scope():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with access_scope():
+            return await self.get_response(request)
+
+
+class TestVisibleTo(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.status = Status.objects.create(status="draft")
+        plan = Plan.objects.create(name="free")
+        cls.user, cls.other = User.objects.bulk_create(
+            [User(name="user", plan=plan), User(name="other", plan=plan)]
+        )
+        contents = Content.objects.bulk_create(
+            [Content(title=f"Content {i}", status=cls.status) for i in range(100)]
+        )
+        spaces = Space.objects.bulk_create([Space(name=f"Space {i}") for i in range(3)])
+        # userはSpace 0, 1に2つのAssociateで、otherはSpace 2に属する
+        associates = Associate.objects.bulk_create(
+            [
+                Associate(name="a", user=cls.user, content=contents[0]),
+                Associate(name="b", user=cls.user, content=contents[0]),
+                Associate(name="c", user=cls.other, content=contents[0]),
+            ]
+        )
+        spaces[0].associate.add(associates[0])
+        spaces[1].associate.add(associates[0], associates[1])
+        spaces[2].associate.add(associates[2])
+        # Content 0〜59はSpace 0、40〜79はSpace 1にも、80〜99はSpace 2のみ
+        spaces[0].content.add(*contents[:60])
+        spaces[1].content.add(*contents[40:80])
+        spaces[2].content.add(*contents[80:])
+        cls.contents = contents
+        cls.spaces = spaces
+        status_registry.name(cls.status.id)
+
+    def test_visible_to(self):
+        visible = Content.objects.visible_to(self.user)
+        # 2つのSpaceに属するContentも1回だけ返す
+        assert sorted(visible.values_list("id", flat=True)) == [
+            content.id for content in self.contents[:80]
+        ]
+        assert set(Content.objects.visible_to(self.other.pk)) == set(self.contents[80:])
+        nobody = User.objects.create(name="nobody", plan=self.user.plan)
+        assert not Content.objects.visible_to(nobody).exists()
+        assert visible_contents(nobody.pk).count() == 0
+        assert visible_contents(self.user.pk).count() == 80
+
+    def test_constant_query_count(self):
+        visible = Content.objects.visible_to(self.user).order_by(*CONTENT_ORDERING)
+        for size in (1, 10, 80):
+            # ページの大きさによらず、ページの取得とシリアライズで1回
+            with self.assertNumQueries(1):
+                rows = FastContentSerializer.rows(visible[:size])
+                data = FastContentSerializer(rows, many=True).data
+            assert len(data) == size
+
+    def test_scope_caches_space_ids(self):
+        with access_scope():
+            with self.assertNumQueries(2):
+                assert visible_contents(self.user.pk).count() == 80
+            for size in (1, 10, 80):
+                with self.assertNumQueries(1):
+                    page = visible_contents(self.user.pk).order_by(*CONTENT_ORDERING)
+                    assert len(page[:size]) == size
+            # 別のUserは別に引く
+            with self.assertNumQueries(2):
+                assert visible_contents(self.other.pk).count() == 20
+        # スコープ外では毎回引く
+        with self.assertNumQueries(2):
+            visible_contents(self.user.pk).count()
+
+    async def test_avisible_space_ids(self):
+        with access_scope():
+            space_ids = await avisible_space_ids(self.user.pk)
+            assert space_ids == [self.spaces[0].pk, self.spaces[1].pk]
+            assert await avisible_space_ids(self.user.pk) is space_ids
+            visible = Content.objects.visible_to(self.user.pk, space_ids)
+            assert await visible.acount() == 80
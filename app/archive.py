@@ -0,0 +1,636 @@
+"""
+Space, StructureとそのContentのアーカイブ (export_archive, import_archive コマンド)
+ORMで1行ずつ読み書きせず、PostgreSQLではCOPYで表ごとにまとめて転送する
+
+アーカイブ: gzipで圧縮したテキスト
+    1行目: {"format": "app-archive", "version": 1}
+    表ごとに: {"table": 名前, "columns": [列名]} の行、COPYのテキスト形式の行、"\\." の行
+書き出し: PostgreSQLは COPY (SELECT ...) TO STDOUT、それ以外はvalues_listの行を同じ形式にする
+読み込み: 1トランザクションで、新しいidを採番して参照(外部キー、referenceフィールド)を付け替える
+          PostgreSQLは COPY FROM STDIN、それ以外はチャンクごとのbulk_create相当のINSERT
+Statusは名前で対応させ、移行先にないものは作る
+Userは含めないため、AssociateのUserは移行先に同じidで存在すること
+"""
+
+import gzip
+import io
+import json
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.dateparse import parse_datetime
+
+from app.changes import record_changes
+from app.models import Associate, Content, Plan, Space, Status, Structure, User
+from app.registry import status_registry
+from app.serializer import SpaceSerializer
+from app.structures import CompiledSchema, structure_registry
+
+ARCHIVE_FORMAT = "app-archive"
+ARCHIVE_VERSION = 1
+ARCHIVE_CHUNK_SIZE = 5000
+# 圧縮率より速度を優先する
+COMPRESS_LEVEL = 1
+END_OF_DATA = "\\."
+
+SpaceContent = Space.content.through
+SpaceAssociate = Space.associate.through
+
+# 参照先の表が先になる順
+MODELS = {
+    "status": Status,
+    "structure": Structure,
+    "content": Content,
+    "space": Space,
+    "associate": Associate,
+    "space_content": SpaceContent,
+    "space_associate": SpaceAssociate,
+}
+
+
+def copy_supported():
+    return connection.vendor == "postgresql"
+
+
+def _fields(model):
+    """アーカイブの列、中間テーブルのidは移行先で採番するため含めない"""
+    return [
+        field
+        for field in model._meta.concrete_fields
+        if not (model._meta.auto_created and field.primary_key)
+    ]
+
+
+# COPYのテキスト形式 (区切りはタブ、NULLは\N)
+_UNESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+_ESCAPES = str.maketrans(
+    {"\\": "\\\\", **{char: f"\\{key}" for key, char in _UNESCAPES.items()}}
+)
+_ESCAPE = re.compile(r"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)")
+
+
+def _unescape(match):
+    value = match[1]
+    if value[0] == "x":
+        return chr(int(value[1:], 16))
+    if value[0] in "01234567":
+        return chr(int(value, 8))
+    return _UNESCAPES.get(value, value)
+
+
+def encode_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    else:
+        value = str(value)
+    return value.translate(_ESCAPES)
+
+
+def encode_row(values):
+    return "\t".join(map(encode_value, values)) + "\n"
+
+
+def decode_row(line):
+    """COPYのテキスト形式の1行を文字列(NULLはNone)のリストにする"""
+    return [
+        None if value == "\\N" else _ESCAPE.sub(_unescape, value)
+        for value in line.rstrip("\n").split("\t")
+    ]
+
+
+def _parser(field):
+    """COPYのテキストの値をPythonの値にする関数"""
+    if isinstance(field, (models.IntegerField, models.ForeignKey, models.AutoField)):
+        return int
+    if isinstance(field, models.DateTimeField):
+        return parse_datetime
+    if isinstance(field, models.JSONField):
+        return json.loads
+    if isinstance(field, models.BooleanField):
+        return lambda value: value == "t"
+    return str
+
+
+@dataclass
+class TransferResult:
+    """tables: 表ごとの(行数, 秒数)"""
+
+    tables: dict = field(default_factory=dict)
+
+    def add(self, table, rows, seconds):
+        count, elapsed = self.tables.get(table, (0, 0.0))
+        self.tables[table] = (count + rows, elapsed + seconds)
+
+    @property
+    def rows(self):
+        return sum(rows for rows, _ in self.tables.values())
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds in self.tables.values())
+
+    def lines(self):
+        """表ごとと合計の行数、行/秒"""
+        items = [*self.tables.items(), ("total", (self.rows, self.seconds))]
+        lines = []
+        for table, (rows, seconds) in items:
+            rate = rows / seconds if seconds else 0
+            lines.append(f"{table:>16} {rows:>10} rows {rate:>12,.0f} rows/s")
+        return lines
+
+
+def subtree_querysets(space_ids=(), structure_ids=()):
+    """
+    アーカイブする表ごとのクエリセット (MODELSの順)
+    Content: Spaceに属するもの、Structureのもの、SpaceのAssociateが持つもの
+    Structure: 指定したものとContentのもの
+    """
+    space_ids, structure_ids = list(space_ids), list(structure_ids)
+    associates = Associate.objects.filter(
+        pk__in=SpaceAssociate.objects.filter(space_id__in=space_ids).values(
+            "associate_id"
+        )
+    )
+    contents = Content.objects.filter(
+        Q(
+            pk__in=SpaceContent.objects.filter(space_id__in=space_ids).values(
+                "content_id"
+            )
+        )
+        | Q(model_id__in=structure_ids)
+        | Q(pk__in=associates.values("content_id"))
+    )
+    structures = Structure.objects.filter(
+        Q(pk__in=structure_ids) | Q(pk__in=contents.values("model_id"))
+    )
+    return {
+        "status": Status.objects.all(),
+        "structure": structures,
+        "content": contents,
+        "space": Space.objects.filter(pk__in=space_ids),
+        "associate": associates,
+        "space_content": SpaceContent.objects.filter(space_id__in=space_ids),
+        "space_associate": SpaceAssociate.objects.filter(space_id__in=space_ids),
+    }
+
+
+def _copy_to(queryset, fields, write):
+    """COPY (SELECT ...) TO STDOUT の出力をwriteに渡し、行数を返す"""
+    queryset = queryset.order_by("pk")
+    sql, params = queryset.values_list(
+        *[f.attname for f in fields]
+    ).query.sql_with_params()
+    rows = 0
+    with connection.cursor() as cursor:
+        with cursor.copy(f"COPY ({sql}) TO STDOUT", params) as copy:
+            for data in copy:
+                data = bytes(data)
+                rows += data.count(b"\n")
+                write(data)
+    return rows
+
+
+def _values_to(queryset, fields, write, chunk_size):
+    """values_listの行をCOPYのテキスト形式でwriteに渡し、行数を返す"""
+    queryset = queryset.order_by("pk").values_list(*[f.attname for f in fields])
+    rows = 0
+    chunk = []
+    for values in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(encode_row(values))
+        if len(chunk) >= chunk_size:
+            write("".join(chunk).encode())
+            rows += len(chunk)
+            chunk = []
+    if chunk:
+        write("".join(chunk).encode())
+        rows += len(chunk)
+    return rows
+
+
+def export_archive(out, space_ids=(), structure_ids=(), chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    space_ids, structure_idsの部分木をout(バイナリのファイル)に書き出す
+    1トランザクション内で読み、PostgreSQLでは表の間で一貫したスナップショットにする
+    @return TransferResult
+    """
+    result = TransferResult()
+    outermost = not connection.in_atomic_block
+    with (
+        transaction.atomic(),
+        gzip.GzipFile(fileobj=out, mode="wb", compresslevel=COMPRESS_LEVEL) as archive,
+    ):
+        if copy_supported() and outermost:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+                )
+        header = {"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION}
+        archive.write(json.dumps(header).encode() + b"\n")
+        for table, queryset in subtree_querysets(space_ids, structure_ids).items():
+            start = time.perf_counter()
+            fields = _fields(queryset.model)
+            section = {"table": table, "columns": [f.column for f in fields]}
+            archive.write(json.dumps(section).encode() + b"\n")
+            if copy_supported():
+                rows = _copy_to(queryset, fields, archive.write)
+            else:
+                rows = _values_to(queryset, fields, archive.write, chunk_size)
+            archive.write(END_OF_DATA.encode() + b"\n")
+            result.add(table, rows, time.perf_counter() - start)
+    return result
+
+
+def read_archive(fp, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    アーカイブを読み、(表の名前, 列名, 行のリスト)をchunk_size行ずつ返す
+    行は列のフィールドでPythonの値にしたリスト
+    """
+    lines = io.TextIOWrapper(gzip.GzipFile(fileobj=fp, mode="rb"), encoding="utf-8")
+    header = json.loads(next(lines, "null"))
+    if not isinstance(header, dict) or header.get("format") != ARCHIVE_FORMAT:
+        raise ValueError("アーカイブではありません")
+    if header.get("version") != ARCHIVE_VERSION:
+        raise ValueError(f"未対応のバージョンです: {header.get('version')}")
+    for line in lines:
+        section = json.loads(line)
+        table, columns = section["table"], section["columns"]
+        if table not in MODELS:
+            raise ValueError(f"不明な表です: {table}")
+        fields = {f.column: f for f in _fields(MODELS[table])}
+        if set(columns) - set(fields):
+            raise ValueError(f"不明な列です: {table} {set(columns) - set(fields)}")
+        parsers = [_parser(fields[column]) for column in columns]
+        chunk = []
+        for line in lines:
+            if line.rstrip("\n") == END_OF_DATA:
+                break
+            values = decode_row(line)
+            if len(values) != len(columns):
+                raise ValueError(f"列の数が違います: {table}")
+            chunk.append(
+                [None if v is None else parse(v) for parse, v in zip(parsers, values)]
+            )
+            if len(chunk) >= chunk_size:
+                yield table, columns, chunk
+                chunk = []
+        else:
+            raise ValueError(f"アーカイブが途中で終わっています: {table}")
+        yield table, columns, chunk
+
+
+class CopyWriter:
+    """PostgreSQLのCOPY FROM STDINで挿入する"""
+
+    def allocate_ids(self, model, count):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, %s))"
+                " FROM generate_series(1, %s)",
+                [model._meta.db_table, model._meta.pk.column, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def insert(self, model, columns, rows):
+        """rowsを挿入する、主キーの列があればidを採番して書き換え、新しいidを返す"""
+        pk = model._meta.pk.column
+        ids = None
+        if pk in columns:
+            ids = self.allocate_ids(model, len(rows))
+            index = columns.index(pk)
+            for row, new_id in zip(rows, ids):
+                row[index] = new_id
+        table = connection.ops.quote_name(model._meta.db_table)
+        names = ", ".join(map(connection.ops.quote_name, columns))
+        with connection.cursor() as cursor:
+            with cursor.copy(f"COPY {table} ({names}) FROM STDIN") as copy:
+                copy.write("".join(map(encode_row, rows)))
+        return ids
+
+
+class InsertWriter:
+    """
+    COPYのないデータベースでチャンクごとに複数行のINSERTで挿入する
+    bulk_createはauto_now, auto_now_addの列を現在時刻にするため、raw=Trueで値をそのまま入れる
+    """
+
+    def insert(self, model, columns, rows):
+        fields = {f.column: f for f in _fields(model)}
+        pk = model._meta.pk
+        with_pk = pk.column in columns
+        insert_fields = [fields[c] for c in columns if not (with_pk and c == pk.column)]
+        objs = []
+        for row in rows:
+            values = dict(zip(columns, row))
+            objs.append(model(**{f.attname: values[f.column] for f in insert_fields}))
+        queryset = model._base_manager.all()
+        batch_size = max(connection.ops.bulk_batch_size(insert_fields, objs), 1)
+        returning = [pk] if with_pk else None
+        ids = []
+        for start in range(0, len(objs), batch_size):
+            inserted = queryset._insert(
+                objs[start : start + batch_size],
+                fields=insert_fields,
+                returning_fields=returning,
+                raw=True,
+            )
+            if with_pk:
+                ids.extend(row[0] for row in inserted)
+        return ids if with_pk else None
+
+
+@dataclass
+class ImportResult(TransferResult):
+    """ids: 表ごとの{アーカイブのid: 新しいid}"""
+
+    ids: dict = field(default_factory=lambda: defaultdict(dict))
+
+
+class _Importer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.result = ImportResult()
+        self.ids = self.result.ids
+        # referenceフィールドのキー (新しいStructureのid -> キーのリスト)
+        self.references = {}
+        # referenceフィールドを付け替えるContent (新しいid, custom_fields, キー)
+        self.pending_references = []
+        self.space_contents = defaultdict(list)
+
+    def remap(self, table, value):
+        if value is None:
+            return None
+        try:
+            return self.ids[table][value]
+        except KeyError:
+            raise ValueError(f"アーカイブにない{table}を参照しています: {value}")
+
+    def insert(self, table, columns, rows):
+        old_ids = [row[0] for row in rows] if columns[0] == "id" else None
+        new_ids = self.writer.insert(MODELS[table], columns, rows)
+        if old_ids is not None:
+            self.ids[table].update(zip(old_ids, new_ids))
+        return new_ids
+
+    def status(self, columns, rows):
+        # Statusは名前で対応させる
+        index = columns.index("status")
+        existing = dict(Status.objects.values_list("status", "id"))
+        missing = [row[index] for row in rows if row[index] not in existing]
+        if missing:
+            created = Status.objects.bulk_create([Status(status=n) for n in missing])
+            existing.update((status.status, status.pk) for status in created)
+            # bulk_createではシグナルが送られないため、レジストリを直接破棄する
+            status_registry.invalidate()
+            transaction.on_commit(status_registry.invalidate)
+        self.ids["status"].update((row[0], existing[row[index]]) for row in rows)
+
+    def structure(self, columns, rows):
+        schema = columns.index("schema")
+        for row, new_id in zip(rows, self.insert("structure", columns, rows)):
+            # 失敗したトランザクションで同じidを読み込んでいた場合に備えて破棄する
+            structure_registry.invalidate(new_id)
+            references = CompiledSchema(row[schema] or ()).references
+            if references:
+                self.references[new_id] = references
+
+    def content(self, columns, rows):
+        model, status = columns.index("model_id"), columns.index("status_id")
+        custom_fields = columns.index("custom_fields")
+        for row in rows:
+            row[model] = self.remap("structure", row[model])
+            row[status] = self.remap("status", row[status])
+        for row, new_id in zip(rows, self.insert("content", columns, rows)):
+            keys = self.references.get(row[model])
+            if keys and any(isinstance(row[custom_fields].get(k), int) for k in keys):
+                self.pending_references.append((new_id, row[custom_fields], keys))
+
+    def space(self, columns, rows):
+        self.insert("space", columns, rows)
+
+    def associate(self, columns, rows):
+        # Userはアーカイブに含めないため、同じidのまま
+        content = columns.index("content_id")
+        for row in rows:
+            row[content] = self.remap("content", row[content])
+        self.insert("associate", columns, rows)
+
+    def space_content(self, columns, rows):
+        space, content = columns.index("space_id"), columns.index("content_id")
+        for row in rows:
+            row[space] = self.remap("space", row[space])
+            row[content] = self.remap("content", row[content])
+            self.space_contents[row[space]].append(row[content])
+        self.insert("space_content", columns, rows)
+
+    def space_associate(self, columns, rows):
+        space, associate = columns.index("space_id"), columns.index("associate_id")
+        for row in rows:
+            row[space] = self.remap("space", row[space])
+            row[associate] = self.remap("associate", row[associate])
+        self.insert("space_associate", columns, rows)
+
+    def finish(self, chunk_size):
+        """referenceフィールドを新しいidにし、Spaceの変更を記録する"""
+        contents = []
+        for pk, custom_fields, keys in self.pending_references:
+            for key in keys:
+                value = custom_fields.get(key)
+                if isinstance(value, int):
+                    # アーカイブの外のContentへの参照はidのまま残す
+                    custom_fields[key] = self.ids["content"].get(value, value)
+            contents.append(Content(pk=pk, custom_fields=custom_fields))
+        Content.objects.bulk_update(contents, ["custom_fields"], batch_size=chunk_size)
+        # bulk_createと同じく、シグナルが送られないため直接記録する
+        for space_id, content_ids in self.space_contents.items():
+            record_changes([space_id], content_ids)
+
+
+def import_archive(fp, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    アーカイブを1トランザクションで読み込み、新しいidで作成する
+    途中で失敗した場合は何も作成しない
+    @return ImportResult
+    """
+    importer = _Importer(CopyWriter() if copy_supported() else InsertWriter())
+    with transaction.atomic():
+        start = time.perf_counter()
+        for table, columns, rows in read_archive(fp, chunk_size):
+            getattr(importer, table)(columns, rows)
+            now = time.perf_counter()
+            importer.result.add(table, len(rows), now - start)
+            start = now
+        importer.finish(chunk_size)
+    return importer.result
+
+
+def _normalize(rows, content_ids=None, structure_ids=None):
+    """Contentの出力のidと参照を付け替え、idの順に並べる"""
+    content_ids, structure_ids = content_ids or {}, structure_ids or {}
+    result = []
+    for row in rows:
+        row = dict(row)
+        row["id"] = content_ids.get(row["id"], row["id"])
+        row["model"] = structure_ids.get(row["model"], row["model"])
+        related = row.get("related")
+        if isinstance(related, dict):
+            related = related["id"]
+        if related is not None:
+            row["related"] = content_ids.get(related, related)
+        result.append(row)
+    return sorted(result, key=lambda row: row["id"])
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.draft = Status.objects.create(status="draft")
+        self.review = Status.objects.create(status="review")
+        self.news = Structure.objects.create(
+            name="news",
+            description="",
+            schema=[
+                {"key": "body", "type": "multiline"},
+                {"key": "related", "type": "reference"},
+            ],
+        )
+        self.space = Space.objects.create(name="Test Space")
+        self.contents = [
+            Content.objects.create(title=f"Test Content {i}", status=self.draft)
+            for i in range(5)
+        ]
+        self.external = Content.objects.create(title="External", status=self.draft)
+        self.owned = Content.objects.create(title="Owned", status=self.review)
+        # アーカイブ内と外への参照、エスケープの必要な値
+        self.contents[0].model = self.news
+        self.contents[0].custom_fields = {
+            "body": "tab\there\nnew line \\ 日本語",
+            "related": self.contents[1].id,
+        }
+        self.contents[0].save()
+        self.contents[1].model = self.news
+        self.contents[1].custom_fields = {"related": self.external.id}
+        self.contents[1].save()
+        self.space.content.set(self.contents)
+        plan = Plan.objects.create(name="free")
+        self.user = User.objects.create(name="user", plan=plan)
+        self.associate = Associate.objects.create(
+            name="associate", user=self.user, content=self.owned
+        )
+        self.space.associate.add(self.associate)
+
+    def tearDown(self):
+        # ロールバックで消えるStatus, Structureを読み込んだレジストリを破棄する
+        status_registry.invalidate()
+        structure_registry.invalidate()
+
+    def roundtrip(self, **kwargs):
+        out = io.BytesIO()
+        exported = export_archive(out, space_ids=[self.space.id], **kwargs)
+        out.seek(0)
+        return exported, import_archive(out, **kwargs)
+
+    def test_roundtrip(self):
+        exported, imported = self.roundtrip()
+        # Spaceの5件とAssociateのContent
+        assert exported.tables["content"][0] == 6
+        assert exported.tables["space_content"][0] == 5
+        assert imported.rows == exported.rows
+
+        space = Space.objects.get(pk=imported.ids["space"][self.space.id])
+        assert space.name == "Test Space"
+        content_ids = imported.ids["content"]
+        # idと参照以外は元のSpaceと一致する(作成、更新日時も保持する)
+        expected = SpaceSerializer(self.space).data["content"]
+        actual = SpaceSerializer(space).data["content"]
+        assert _normalize(actual) == _normalize(
+            expected, content_ids, imported.ids["structure"]
+        )
+        # アーカイブ外への参照はそのまま
+        copied = Content.objects.get(pk=content_ids[self.contents[1].id])
+        assert copied.custom_fields["related"] == self.external.id
+        # AssociateとそのContentも複製する、Userは同じ
+        associate = space.associate.get()
+        assert associate.user_id == self.user.id
+        assert associate.content_id == content_ids[self.owned.id]
+        # Statusは名前で対応させ、増やさない
+        assert Status.objects.count() == 2
+        assert space.changes.count() == 5
+
+    def test_structure_subtree(self):
+        out = io.BytesIO()
+        export_archive(out, structure_ids=[self.news.id])
+        out.seek(0)
+        imported = import_archive(out)
+        assert imported.tables["content"][0] == 2
+        assert imported.tables["space"][0] == 0
+        assert Structure.objects.filter(name="news").count() == 2
+
+    def test_creates_missing_statuses(self):
+        out = io.BytesIO()
+        export_archive(out, space_ids=[self.space.id])
+        out.seek(0)
+        Status.objects.filter(status="review").update(status="reviewing")
+        imported = import_archive(out)
+        review = Status.objects.get(status="review")
+        assert imported.ids["status"][self.review.id] == review.id
+        assert status_registry.id("review") == review.id
+
+    def test_rolls_back_on_error(self):
+        out = io.BytesIO()
+        export_archive(out, space_ids=[self.space.id])
+        data = gzip.decompress(out.getvalue())
+        counts = Content.objects.count(), Space.objects.count()
+        # space_contentの途中で切れたアーカイブ
+        truncated = data[: data.index(b'"space_content"') + 60]
+        with self.assertRaises(ValueError):
+            import_archive(io.BytesIO(gzip.compress(truncated)))
+        assert (Content.objects.count(), Space.objects.count()) == counts
+        with self.assertRaises(ValueError):
+            import_archive(io.BytesIO(gzip.compress(b'{"format": "other"}\n')))
+
+    def test_chunks(self):
+        contents = Content.objects.bulk_create(
+            [Content(title=f"Bulk {i}", status=self.draft) for i in range(20)]
+        )
+        self.space.content.add(*contents)
+        _, imported = self.roundtrip(chunk_size=7)
+        assert imported.tables["content"][0] == 26
+        space = Space.objects.get(pk=imported.ids["space"][self.space.id])
+        assert space.content.count() == 25
+
+    def test_query_count(self):
+        # クエリ数はチャンクの数で決まり、行数によらない
+        counts = []
+        for rows in (10, 40):
+            space = Space.objects.create(name=f"Space {rows}")
+            space.content.add(
+                *Content.objects.bulk_create(
+                    [Content(title=f"Bulk {i}", status=self.draft) for i in range(rows)]
+                )
+            )
+            out = io.BytesIO()
+            export_archive(out, space_ids=[space.id])
+            out.seek(0)
+            with CaptureQueriesContext(connection) as queries:
+                import_archive(out)
+            counts.append(len(queries))
+        assert counts[0] == counts[1]
+
+    def test_copy_text_format(self):
+        values = [1, None, "a\tb\nc\\d\re", {"key": "値\t"}, True, ""]
+        row = decode_row(encode_row(values))
+        assert row == ["1", None, "a\tb\nc\\d\re", '{"key":"値\\t"}', "t", ""]
+        # PostgreSQLのCOPYの8進数、16進数のエスケープ
+        assert decode_row("\\101\\x42\\\\N\tx\n") == ["AB\\N", "x"]
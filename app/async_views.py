@@ -0,0 +1,272 @@
+"""
+Space, Contentの読み取りを行う非同期ビュー
+ASGI(core.asgi)で動かすとスレッドを使わずにクエリを待てる
+クエリ, キャッシュのキー, レスポンスのJSONは同期版(app.views)と同じにする
+
+DRFのビューは同期のみのため、シリアライズはFastContentSerializerで行い、
+Acceptで選んだレンダラー(app.renderers)で描画したバイト列をHttpResponseで返す
+"""
+
+import functools
+from unittest import skipIf
+
+from django.http import Http404, HttpResponse
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.views.decorators.http import require_GET
+from rest_framework.settings import api_settings
+
+from app import snapshots
+from app.cache import get_space_cache
+from app.conditional import aconditional_space
+from app.fields import project, project_space
+from app.metrics import metrics_registry, serializer_timer
+from app.models import Content, Space, Status
+from app.references import get_reference_loader
+from app.registry import status_registry
+from app.renderers import msgpack, native_datetimes, select_renderer
+from app.routers import read_replica
+from app.serializer import (
+    ContentListQuerySerializer,
+    FastContentSerializer,
+    SpaceQuerySerializer,
+)
+from app.structures import structure_registry
+from app.views import (
+    PAGE_COLUMNS,
+    cache_variant,
+    page_queryset,
+    page_response,
+    page_result,
+    space_contents,
+)
+
+
+def _renderers():
+    # DRFのビューと同じレンダラーから、HTMLのブラウザブルAPIを除く
+    return [
+        renderer()
+        for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+        if renderer.format != "api"
+    ]
+
+
+def _response(request, data, status=200):
+    renderer = request.accepted_renderer
+    return HttpResponse(
+        renderer.render(data), status=status, content_type=renderer.media_type
+    )
+
+
+def negotiate(view):
+    """
+    Acceptでレンダラーを選んでrequest.accepted_rendererに置き、
+    Http404をDRFのビューと同じ404にする
+    """
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request.accepted_renderer = select_renderer(request, _renderers())
+        try:
+            return await view(request, *args, **kwargs)
+        except Http404 as exc:
+            return _response(request, {"detail": str(exc)}, status=404)
+
+    return wrapper
+
+
+async def _fetch_rows(queryset):
+    rows = [row async for row in queryset]
+    # 同期のクエリを発行しないよう、未知のStatus, Structureを先に読み込む
+    # fields指定時は取得していない列があるため属性の有無を見る
+    await status_registry.aprepare(
+        {getattr(row, "status_id", None) for row in rows} - {None}
+    )
+    await structure_registry.aprepare(
+        {getattr(row, "model_id", None) for row in rows} - {None}
+    )
+    return rows
+
+
+async def _serialize(request, rows, fields=None):
+    # referenceフィールドは非同期のクエリで展開してから出力を絞る
+    serializer = FastContentSerializer(
+        None, fields=fields, native_datetimes=native_datetimes(request)
+    )
+    data = [serializer.to_representation(row) for row in rows]
+    data = await get_reference_loader().aresolve(data)
+    if fields is None:
+        return data
+    return [project(item, fields) for item in data]
+
+
+@require_GET
+@negotiate
+@read_replica
+@aconditional_space
+async def aspace_detail(request, pk):
+    """app.views.space_detailの非同期版"""
+    params = SpaceQuerySerializer(data=request.GET)
+    if not params.is_valid():
+        return _response(request, params.errors, status=400)
+    fields, content_fields = params.validated_data.get("fields") or (None, None)
+
+    async def build():
+        if snapshots.enabled():
+            data = await snapshots.aget_snapshot(pk)
+            return project_space(data, fields, content_fields)
+        data = {"id": pk}
+        if fields is None or "content" in fields:
+            rows = await _fetch_rows(
+                FastContentSerializer.rows(
+                    Content.objects.filter(spaces=pk), content_fields
+                )
+            )
+            with serializer_timer():
+                data["content"] = await _serialize(request, rows, content_fields)
+        return project(data, fields)
+
+    variant = cache_variant(request, request.GET.get("fields", ""))
+    return _response(
+        request, await get_space_cache().aget_or_set(pk, build, variant=variant)
+    )
+
+
+@require_GET
+@negotiate
+@read_replica
+@aconditional_space
+async def aspace_content_list(request, pk):
+    """app.views.space_content_listの非同期版"""
+    params = ContentListQuerySerializer(data=request.GET)
+    if not params.is_valid():
+        return _response(request, params.errors, status=400)
+
+    async def build():
+        return await _space_content_page(request, pk, **params.validated_data)
+
+    variant = cache_variant(request, request.GET.urlencode())
+    return _response(
+        request, await get_space_cache().aget_or_set(pk, build, variant=variant)
+    )
+
+
+async def _space_content_page(
+    request, pk, offset, limit, cursor=None, q=None, fields=None
+):
+    contents, ranked = space_contents(pk, q)
+    total = await contents.acount()
+    queryset = page_queryset(
+        FastContentSerializer.rows(contents, fields, PAGE_COLUMNS),
+        ranked,
+        offset,
+        limit,
+        cursor,
+    )
+    rows = await _fetch_rows(queryset)
+    page = page_result(rows, ranked, offset, limit, cursor, total)
+    with serializer_timer():
+        return page_response(
+            request, page, await _serialize(request, page.rows, fields)
+        )
+
+
+class TestAsyncViews(TestCase):
+    """非同期ビューのレスポンスが同期版とバイト単位で一致することを確認する"""
+
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.status = Status.objects.create(status="draft")
+        self.contents = Content.objects.bulk_create(
+            [Content(title=f"Test Content {i}", status=self.status) for i in range(12)]
+        )
+        self.space.content.set(self.contents)
+        get_space_cache().clear()
+        status_registry.invalidate()
+
+    def assert_same(self, sync_url, async_url, params=None, **headers):
+        get_space_cache().clear()
+        expected = self.client.get(sync_url, params, headers=headers)
+        get_space_cache().clear()
+        response = self.client.get(async_url, params, headers=headers)
+        assert response.status_code == expected.status_code
+        assert response["Content-Type"] == expected["Content-Type"]
+        assert response.content == expected.content
+        return response
+
+    def test_space_detail(self):
+        pk = self.space.id
+        response = self.assert_same(
+            reverse("space-detail", args=[pk]),
+            reverse("async-space-detail", args=[pk]),
+        )
+        assert len(response.json()["content"]) == 12
+        self.assert_same(
+            reverse("space-detail", args=[pk + 1]),
+            reverse("async-space-detail", args=[pk + 1]),
+        )
+
+    def test_space_detail_snapshot(self):
+        pk = self.space.id
+        with override_settings(SPACE_SNAPSHOTS=True):
+            snapshots.rebuild_snapshot(pk)
+            self.assert_same(
+                reverse("space-detail", args=[pk]),
+                reverse("async-space-detail", args=[pk]),
+            )
+
+    def test_space_content_list(self):
+        sync_url = reverse("space-content-list", args=[self.space.id])
+        async_url = reverse("async-space-content-list", args=[self.space.id])
+        body = self.assert_same(sync_url, async_url, {"limit": 5}).json()
+        self.assert_same(sync_url, async_url, {"limit": 5, "cursor": body["next"]})
+        self.assert_same(sync_url, async_url, {"offset": 3, "q": "content"})
+        self.assert_same(sync_url, async_url, {"limit": 0})
+        self.assert_same(sync_url, async_url, {"limit": 5, "fields": "id,_status"})
+        self.assert_same(sync_url, async_url, {"fields": "content.title"})
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    @override_settings(FAST_SERIALIZATION=True)
+    def test_messagepack(self):
+        pk = self.space.id
+        for name in ("space-detail", "space-content-list"):
+            response = self.assert_same(
+                reverse(name, args=[pk]),
+                reverse(f"async-{name}", args=[pk]),
+                accept="application/msgpack",
+            )
+            assert response["Content-Type"] == "application/msgpack"
+            assert "Accept" in response["Vary"]
+        # datetimeはTimestamp拡張型で返す
+        data = msgpack.unpackb(response.content, timestamp=3)["data"]
+        created_at = {content.id: content.created_at for content in self.contents}
+        assert all(row["created_at"] == created_at[row["id"]] for row in data)
+        self.assert_same(
+            reverse("space-detail", args=[pk + 1]),
+            reverse("async-space-detail", args=[pk + 1]),
+            accept="application/msgpack",
+        )
+
+    def test_space_detail_fields(self):
+        pk = self.space.id
+        sync_url = reverse("space-detail", args=[pk])
+        async_url = reverse("async-space-detail", args=[pk])
+        for fields in ("id", "content.title,content.status", "id,content", "name"):
+            self.assert_same(sync_url, async_url, {"fields": fields})
+
+    async def test_async_client(self):
+        url = reverse("async-space-content-list", args=[self.space.id])
+        response = await self.async_client.get(url, {"limit": 5})
+        assert response.status_code == 200
+        assert len(response.json()["data"]) == 5
+
+        # 2回目はキャッシュから返す(検証子の集計クエリのみ)
+        # クエリ数はQueryMetricsMiddlewareの非同期版が記録したものを見る
+        metrics_registry.clear()
+        response = await self.async_client.get(url, {"limit": 5})
+        histogram = metrics_registry.histogram("db_queries", "async-space-content-list")
+        assert (histogram.count, histogram.sum) == (1, 1)
+        response = await self.async_client.get(
+            url, {"limit": 5}, headers={"If-None-Match": response["ETag"]}
+        )
+        assert response.status_code == 304
@@ -0,0 +1,669 @@
+"""
+ベンチマーク
+python manage.py bench [name ...] で実行する
+データは各ベンチマーク内で作成し、終了時にロールバックする
+
+計測結果(dict)を返すベンチマークは --save でJSONに保存し、
+--compare で保存した結果と比べて遅くなったものを報告できる
+"""
+
+import io
+import statistics
+import time
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Count
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+from django.test import RequestFactory, override_settings
+from django.urls import resolve, reverse
+from rest_framework.renderers import JSONRenderer
+
+from app.archive import export_archive, import_archive
+from app.cache import get_space_cache
+from app.compression import CODECS, CompressionMiddleware
+from app.ingest import ingest_contents
+from app.metrics import QueryMetricsMiddleware, metrics_registry
+from app.models import Content, Plan, Space, Status, Structure, User
+from app.pagination import CONTENT_ORDERING, Cursor, keyset_page, offset_page
+from app.references import reference_scope
+from app.renderers import MessagePackRenderer, ORJSONRenderer, msgpack, orjson
+from app.search import search_contents
+from app.seed import SeedVolumes, seed_data
+from app.serializer import (
+    ContentSerializer,
+    FastContentSerializer,
+    FastSpaceSerializer,
+)
+from app.structures import (
+    custom_field_index_sql,
+    filter_custom_fields,
+    order_by_custom_field,
+)
+from app.throttling import RateLimitMiddleware, get_rate_limiter, plan_registry
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """BENCHMARKSに登録するデコレータ"""
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+def timings(func, repeat=5, clock=time.perf_counter):
+    """
+    funcをrepeat回実行し、それぞれの経過時間(秒)のリストを返す
+    clock: time.process_timeならCPU時間
+    """
+    result = []
+    for _ in range(repeat):
+        start = clock()
+        func()
+        result.append(clock() - start)
+    return result
+
+
+def measure(func, repeat=5, clock=time.perf_counter):
+    """funcをrepeat回実行し、最短の経過時間(秒)を返す"""
+    return min(timings(func, repeat, clock))
+
+
+def summarize(values):
+    """経過時間のリストの統計値(秒)、--saveで保存する形"""
+    return {
+        "min": min(values),
+        "max": max(values),
+        "mean": statistics.fmean(values),
+        "median": statistics.median(values),
+        "stddev": statistics.stdev(values) if len(values) > 1 else 0.0,
+        "rounds": len(values),
+    }
+
+
+def seed_space(rows, batch_size=5000, title="Benchmark Content {i}".format):
+    """rows件のContentを持つSpaceを作成する、title(i=行番号)でタイトルを作る"""
+    status, _ = Status.objects.get_or_create(status="draft")
+    space = Space.objects.create(name="Benchmark Space")
+    through = Space.content.through
+    for start in range(0, rows, batch_size):
+        contents = Content.objects.bulk_create(
+            [
+                Content(title=title(i=i), status=status)
+                for i in range(start, min(start + batch_size, rows))
+            ]
+        )
+        through.objects.bulk_create(
+            [through(space_id=space.id, content_id=content.id) for content in contents]
+        )
+    return space
+
+
+def compare_results(baseline, results, threshold):
+    """
+    ケースごとに(ベンチマーク.ケース, 基準, 今回, 比, 遅くなったか)を返す
+    measureと同じく最短の経過時間で比べる、基準にないケースは比べない
+    """
+    rows = []
+    for name, cases in results.items():
+        for case, stats in cases.items():
+            base = baseline.get(name, {}).get(case)
+            if base is None:
+                continue
+            ratio = stats["min"] / base["min"] if base["min"] else 1.0
+            rows.append(
+                (f"{name}.{case}", base["min"], stats["min"], ratio, ratio > threshold)
+            )
+    return rows
+
+
+def test_compare_results():
+    baseline = {"suite": {"fast": summarize([1.0, 2.0]), "gone": summarize([1.0])}}
+    results = {
+        "suite": {"fast": summarize([1.1, 1.5]), "new": summarize([1.0])},
+        "other": {"slow": summarize([3.0])},
+    }
+    assert baseline["suite"]["fast"]["median"] == 1.5
+    assert compare_results(baseline, results, 1.2) == [
+        ("suite.fast", 1.0, 1.1, 1.1, False)
+    ]
+    assert compare_results(baseline, results, 1.05)[0][-1]
+
+
+@benchmark("pagination")
+def bench_pagination(stdout, rows=100_000, limit=20):
+    """offsetとcursorで、深さごとのページ取得時間を比較する"""
+    with transaction.atomic():
+        space = seed_space(rows)
+        contents = Content.objects.filter(spaces=space.id)
+        ordered = list(
+            contents.order_by("-published_at", "-id").values_list("published_at", "id")
+        )
+
+        stdout.write(f"rows={rows} limit={limit}")
+        stdout.write(f"{'depth':>10} {'offset ms':>10} {'cursor ms':>10}")
+        depth = 0
+        while depth < rows - limit:
+            offset_time = measure(lambda: offset_page(contents, depth, limit, rows))
+            cursor = Cursor(*ordered[depth - 1]) if depth else Cursor(*ordered[0])
+            cursor_time = measure(lambda: keyset_page(contents, cursor, limit))
+            stdout.write(
+                f"{depth:>10} {offset_time * 1000:>10.2f} {cursor_time * 1000:>10.2f}"
+            )
+            depth = depth * 10 if depth else 10
+        transaction.set_rollback(True)
+
+
+@benchmark("serialization")
+def bench_serialization(stdout, rows=None):
+    """ContentSerializerとFastContentSerializerの行/秒を比較する"""
+    sizes = [rows] if rows else [1_000, 10_000, 100_000]
+    stdout.write(f"{'rows':>10} {'model rows/s':>14} {'fast rows/s':>14} {'gain':>6}")
+    for size in sizes:
+        with transaction.atomic():
+            space = seed_space(size)
+            contents = Content.objects.filter(spaces=space.id)
+            instances = list(contents)
+            values = list(FastContentSerializer.rows(contents))
+
+            model_time = measure(
+                lambda: ContentSerializer(instances, many=True).data, repeat=3
+            )
+            fast_time = measure(
+                lambda: FastContentSerializer(values, many=True).data, repeat=3
+            )
+            stdout.write(
+                f"{size:>10} {size / model_time:>14,.0f} {size / fast_time:>14,.0f}"
+                f" {model_time / fast_time:>5.1f}x"
+            )
+            transaction.set_rollback(True)
+
+
+@benchmark("ingest")
+def bench_ingest(stdout, rows=10_000):
+    """1件ずつの作成とingest_contentsの行/秒を比較する"""
+    stdout.write(f"rows={rows}")
+    data = [{"title": f"Benchmark Content {i}", "status": "draft"} for i in range(rows)]
+    with transaction.atomic():
+        status = Status.objects.create(status="draft")
+        space = Space.objects.create(name="Benchmark Space")
+
+        def naive():
+            contents = [
+                Content.objects.create(
+                    title=row["title"],
+                    status=Status.objects.get(status=row["status"]),
+                )
+                for row in data
+            ]
+            space.content.set(contents)
+
+        def bulk():
+            ingest_contents(space, data)
+
+        for name, func in (("naive", naive), ("bulk", bulk)):
+            elapsed = measure(func, repeat=1)
+            stdout.write(f"{name:>6} {rows / elapsed:>12,.0f} rows/s")
+        assert status.contents.count() == rows * 2
+        transaction.set_rollback(True)
+
+
+@benchmark("archive")
+def bench_archive(stdout, rows=100_000):
+    """
+    Spaceの複製を、1件ずつのORMでのコピーとアーカイブの書き出し・読み込みで比べる
+    PostgreSQLではCOPY、それ以外はチャンクごとのINSERTになる
+    """
+    stdout.write(f"rows={rows} vendor={connection.vendor}")
+    with transaction.atomic():
+        space = seed_space(rows)
+
+        def naive():
+            copy = Space.objects.create(name=space.name)
+            contents = []
+            for content in space.content.all():
+                content.pk = None
+                content.save()
+                contents.append(content)
+            copy.content.set(contents)
+
+        elapsed = measure(naive, repeat=1)
+        stdout.write(f"{'naive':>8} {rows / elapsed:>12,.0f} rows/s")
+        out = io.BytesIO()
+        start = time.perf_counter()
+        exported = export_archive(out, space_ids=[space.id])
+        elapsed = time.perf_counter() - start
+        stdout.write(
+            f"{'export':>8} {exported.rows / elapsed:>12,.0f} rows/s"
+            f" {out.tell() / 1024 / 1024:.1f} MiB"
+        )
+        out.seek(0)
+        start = time.perf_counter()
+        imported = import_archive(out)
+        elapsed = time.perf_counter() - start
+        stdout.write(f"{'import':>8} {imported.rows / elapsed:>12,.0f} rows/s")
+        transaction.set_rollback(True)
+
+
+@benchmark("search")
+def bench_search(stdout, rows=100_000, limit=20):
+    """qの検索(search_contents)とtitle__icontainsの1ページの取得時間を比較する"""
+    words = ["news", "release", "product", "update", "event", "report", "guide"]
+    with transaction.atomic():
+        space = seed_space(
+            rows, title=lambda i: f"{words[i % 7]} {words[i // 7 % 7]} {i}"
+        )
+        contents = Content.objects.filter(spaces=space.id)
+
+        stdout.write(f"rows={rows} vendor={connection.vendor}")
+        stdout.write(f"{'q':>16} {'search ms':>10} {'icontains ms':>13}")
+        for q in ("news", "news release", "repo", "missing"):
+            searched, _ = search_contents(contents, q)
+
+            def search():
+                searched.count()
+                list(searched.order_by(*CONTENT_ORDERING)[:limit])
+
+            def icontains():
+                queryset = contents.filter(title__icontains=q)
+                queryset.count()
+                list(queryset.order_by(*CONTENT_ORDERING)[:limit])
+
+            stdout.write(
+                f"{q:>16} {measure(search) * 1000:>10.2f}"
+                f" {measure(icontains) * 1000:>13.2f}"
+            )
+        transaction.set_rollback(True)
+
+
+@benchmark("metrics")
+def bench_metrics(stdout, rows=1000):
+    """QueryMetricsMiddlewareの1リクエストあたりのオーバーヘッドを測る"""
+    factory = RequestFactory()
+    request = factory.get("/")
+
+    def no_queries(request):
+        return HttpResponse()
+
+    def ten_queries(request):
+        for _ in range(10):
+            Status.objects.filter(pk=0).exists()
+        return HttpResponse()
+
+    stdout.write(f"requests={rows}")
+    stdout.write(f"{'view':>12} {'bare us':>10} {'metered us':>11} {'overhead us':>12}")
+    for view in (no_queries, ten_queries):
+        middleware = QueryMetricsMiddleware(view)
+        # N+1の警告の出力は計測に含めない
+        middleware.threshold = float("inf")
+
+        def bare():
+            for _ in range(rows):
+                view(request)
+
+        def metered():
+            for _ in range(rows):
+                middleware(request)
+
+        bare_time = measure(bare, repeat=3) / rows * 1e6
+        metered_time = measure(metered, repeat=3) / rows * 1e6
+        stdout.write(
+            f"{view.__name__:>12} {bare_time:>10.1f} {metered_time:>11.1f}"
+            f" {metered_time - bare_time:>12.1f}"
+        )
+    metrics_registry.clear()
+
+
+@benchmark("throttle")
+def bench_throttle(stdout, rows=10_000):
+    """
+    RateLimitMiddlewareの1リクエストあたりのオーバーヘッドを測る
+    UserのPlanは読み込み済み(DBを引かない)、上限には達しない設定で測る
+    """
+    backends = {
+        "local": {"BACKEND": "app.throttling.LocalBucketBackend"},
+        "locmem cache": {
+            "BACKEND": "app.throttling.DjangoCacheBucketBackend",
+            "OPTIONS": {"alias": "throttle"},
+        },
+    }
+    caches = {
+        **settings.CACHES,
+        "throttle": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    }
+
+    def view(request):
+        return HttpResponse()
+
+    with transaction.atomic():
+        plan = Plan.objects.get_or_create(name="free")[0]
+        user = User.objects.create(name="Benchmark User", plan=plan)
+        request = RequestFactory().get("/", headers={"x-user-id": str(user.pk)})
+        plan_registry.plan(user.pk)
+
+        def bare():
+            for _ in range(rows):
+                view(request)
+
+        stdout.write(f"requests={rows}")
+        stdout.write(
+            f"{'backend':>14} {'bare us':>10} {'limited us':>11} {'overhead us':>12}"
+        )
+        bare_time = measure(bare, repeat=3) / rows * 1e6
+        for name, backend in backends.items():
+            limits = {**backend, "PLANS": {"free": f"{rows * 10}/s"}}
+            with override_settings(RATE_LIMITS=limits, CACHES=caches):
+                middleware = RateLimitMiddleware(view)
+                assert middleware(request).has_header("RateLimit-Limit")
+
+                def limited():
+                    for _ in range(rows):
+                        middleware(request)
+
+                limited_time = measure(limited, repeat=3) / rows * 1e6
+                get_rate_limiter().backend.clear()
+            stdout.write(
+                f"{name:>14} {bare_time:>10.2f} {limited_time:>11.2f}"
+                f" {limited_time - bare_time:>12.2f}"
+            )
+        plan_registry.invalidate()
+        transaction.set_rollback(True)
+
+
+@benchmark("connections")
+def bench_connections(stdout, rows=1000):
+    """
+    接続の扱いごとの1リクエストあたりの時間を測る
+    per-request: リクエストごとに接続する(CONN_MAX_AGE=0)
+    persistent: 接続を持ち続ける(CONN_MAX_AGE, CONN_HEALTH_CHECKS)
+    pool: psycopgのConnectionPoolから借りて返す(PostgreSQLのみ)
+    """
+    default = connections["default"]
+    settings_dict = {**default.settings_dict}
+    options = {**settings_dict["OPTIONS"]}
+    pool = options.pop("pool", None) or {}
+    modes = {
+        "per-request": {"CONN_MAX_AGE": 0, "OPTIONS": options},
+        "persistent": {
+            "CONN_MAX_AGE": 600,
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": options,
+        },
+    }
+    if connection.vendor == "postgresql":
+        modes["pool"] = {
+            "CONN_MAX_AGE": 0,
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {**options, "pool": {"min_size": 1, **pool}},
+        }
+
+    stdout.write(f"requests={rows} vendor={connection.vendor}")
+    stdout.write(f"{'mode':>12} {'per request us':>15}")
+    for name, overrides in modes.items():
+        wrapper = type(default)({**settings_dict, **overrides}, alias=f"bench-{name}")
+
+        def requests():
+            for _ in range(rows):
+                # request_started, request_finishedでのclose_old_connectionsと同じ
+                wrapper.close_if_unusable_or_obsolete()
+                with wrapper.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                wrapper.close_if_unusable_or_obsolete()
+
+        try:
+            elapsed = measure(requests, repeat=3) / rows * 1e6
+        finally:
+            wrapper.close()
+            if name == "pool":
+                wrapper.close_pool()
+        stdout.write(f"{name:>12} {elapsed:>15.1f}")
+
+
+@benchmark("custom_fields")
+def bench_custom_fields(stdout, rows=1_000_000, limit=20, batch_size=5000):
+    """
+    カスタムフィールドでの絞り込みと並べ替えの時間を測る
+    PostgreSQLではGINインデックスに加え、式インデックスを作った後の時間も測る
+    """
+    with transaction.atomic():
+        status = Status.objects.create(status="draft")
+        structure = Structure.objects.create(
+            name="Benchmark Structure",
+            description="",
+            schema=[
+                {"key": "price", "type": "number", "indexed": True},
+                {"key": "category", "type": "singleline"},
+            ],
+        )
+        for start in range(0, rows, batch_size):
+            Content.objects.bulk_create(
+                [
+                    Content(
+                        title=f"Benchmark Content {i}",
+                        model=structure,
+                        status=status,
+                        custom_fields={"price": i % 10_000, "category": f"c{i % 100}"},
+                    )
+                    for i in range(start, min(start + batch_size, rows))
+                ]
+            )
+        contents = Content.objects.all()
+        cases = {
+            "price=4242": lambda: filter_custom_fields(contents, structure, price=4242),
+            "category=c42": lambda: filter_custom_fields(
+                contents, structure, category="c42"
+            ),
+            "order by price": lambda: order_by_custom_field(
+                contents, structure, "price", descending=True
+            ),
+        }
+
+        def run(queryset):
+            return lambda: list(queryset()[:limit])
+
+        timings = {name: [measure(run(query))] for name, query in cases.items()}
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                for sql in custom_field_index_sql(structure, concurrently=False):
+                    cursor.execute(sql)
+                cursor.execute("ANALYZE app_content")
+            for name, query in cases.items():
+                timings[name].append(measure(run(query)))
+
+        stdout.write(f"rows={rows} limit={limit} vendor={connection.vendor}")
+        stdout.write(f"{'query':>16} {'ms':>10} {'indexed ms':>11}")
+        for name, (plain, *indexed) in timings.items():
+            indexed = f"{indexed[0] * 1000:>11.2f}" if indexed else f"{'-':>11}"
+            stdout.write(f"{name:>16} {plain * 1000:>10.2f} {indexed}")
+        transaction.set_rollback(True)
+
+
+@benchmark("renderers")
+def bench_renderers(stdout, rows=None):
+    """
+    SpaceSerializerと同じ形の出力のエンコード時間とサイズをレンダラーごとに比べる
+    json: JSONRenderer (既定)
+    orjson: ORJSONRenderer (datetimeは文字列で渡す)
+    orjson native, msgpack: datetimeを文字列にせずに渡す
+    serialize+encode: FastContentSerializerでの組み立てを含めた時間
+    """
+    sizes = [rows] if rows else [1_000, 10_000, 100_000]
+    renderers = {
+        "json": (JSONRenderer(), False),
+        "orjson": (ORJSONRenderer(), False),
+        "orjson native": (ORJSONRenderer(), True),
+    }
+    if msgpack is not None:
+        renderers["msgpack"] = (MessagePackRenderer(), True)
+    if orjson is None:
+        stdout.write("orjson is not installed: orjson falls back to JSONRenderer")
+    stdout.write(
+        f"{'rows':>10} {'renderer':>14} {'encode ms':>10} {'total ms':>10}"
+        f" {'bytes':>12} {'gain':>6}"
+    )
+    for size in sizes:
+        with transaction.atomic():
+            space = seed_space(size)
+            values = list(FastContentSerializer.rows(space.content.all()))
+            baseline = None
+            for name, (renderer, native) in renderers.items():
+
+                def serialize():
+                    content = FastContentSerializer(
+                        values, many=True, native_datetimes=native
+                    ).data
+                    return {"id": space.id, "content": content}
+
+                data = serialize()
+                encode_time = measure(lambda: renderer.render(data), repeat=3)
+                total_time = measure(lambda: renderer.render(serialize()), repeat=3)
+                baseline = baseline or total_time
+                stdout.write(
+                    f"{size:>10} {name:>14} {encode_time * 1000:>10.2f}"
+                    f" {total_time * 1000:>10.2f} {len(renderer.render(data)):>12,}"
+                    f" {baseline / total_time:>5.1f}x"
+                )
+            transaction.set_rollback(True)
+
+
+@benchmark("compression")
+def bench_compression(stdout, rows=None):
+    """
+    Spaceの出力の1リクエストあたりのCPU時間と転送量を圧縮方式ごとに比べる
+    gzip middleware: DjangoのGZipMiddleware(毎回圧縮する)
+    cold: 初回(圧縮してキャッシュする)、cached: 同じバージョンの2回目以降
+    """
+    sizes = [rows] if rows else [100, 1_000, 10_000]
+    factory = RequestFactory()
+    requests = 50
+    stdout.write(
+        f"{'rows':>8} {'encoding':>16} {'cold us':>10} {'cached us':>10}"
+        f" {'bytes':>12} {'ratio':>6}"
+    )
+    for size in sizes:
+        with transaction.atomic():
+            space = seed_space(size)
+            body = JSONRenderer().render(FastSpaceSerializer(space).data)
+            transaction.set_rollback(True)
+
+        def view(request):
+            response = HttpResponse(body, content_type="application/json")
+            response["ETag"] = '"1-1-1"'
+            return response
+
+        def per_request(middleware, request):
+            def run():
+                for _ in range(requests):
+                    middleware(request)
+
+            return measure(run, repeat=3, clock=time.process_time) / requests * 1e6
+
+        stdout.write(
+            f"{size:>8} {'identity':>16} {'-':>10} {'-':>10} {len(body):>12,}"
+            f" {1:>5.2f}"
+        )
+        request = factory.get("/", headers={"accept-encoding": "gzip"})
+        gzipped = GZipMiddleware(view)(request).content
+        stdout.write(
+            f"{size:>8} {'gzip middleware':>16}"
+            f" {per_request(GZipMiddleware(view), request):>10.1f} {'-':>10}"
+            f" {len(gzipped):>12,} {len(gzipped) / len(body):>5.2f}"
+        )
+        for encoding in CODECS:
+            request = factory.get("/", headers={"accept-encoding": encoding})
+
+            def cold():
+                # 毎回新しいキャッシュで圧縮させる
+                for _ in range(requests):
+                    CompressionMiddleware(view)(request)
+
+            cold_time = measure(cold, repeat=3, clock=time.process_time)
+            middleware = CompressionMiddleware(view)
+            content = middleware(request).content
+            stdout.write(
+                f"{size:>8} {encoding:>16} {cold_time / requests * 1e6:>10.1f}"
+                f" {per_request(middleware, request):>10.1f} {len(content):>12,}"
+                f" {len(content) / len(body):>5.2f}"
+            )
+
+
+@benchmark("suite")
+def bench_suite(stdout, rows=10_000, repeat=20):
+    """
+    seed_dataで作ったデータで主な読み取りの経過時間を測り、結果を返す
+    --save, --compareで結果をコミット間で比べるために使う
+    space_detail, listing: ビューの呼び出しからレンダリングまで(キャッシュなし)
+    serialization: 最大のSpaceのContentの出力の組み立て
+    search: qでの絞り込みの件数と1ページ目の取得
+    """
+    factory = RequestFactory()
+    cache = get_space_cache()
+    with transaction.atomic():
+        seed_data(SeedVolumes.scaled(rows))
+        # Contentの最も多いSpace
+        space = (
+            Space.objects.annotate(contents=Count("content"))
+            .order_by("-contents")
+            .first()
+        )
+        contents = Content.objects.filter(spaces=space.id)
+        instances = list(contents.select_related("model"))
+        values = list(FastContentSerializer.rows(contents))
+
+        def view(name, **params):
+            path = reverse(name, args=[space.id])
+            request = factory.get(path, params)
+            match = resolve(path)
+
+            def run():
+                # キャッシュせずに毎回組み立てる
+                cache.clear()
+                with reference_scope():
+                    match.func(request, **match.kwargs).render()
+
+            return run
+
+        def search(q):
+            def run():
+                searched, _ = search_contents(contents, q)
+                searched.count()
+                list(searched.order_by(*CONTENT_ORDERING)[:20])
+
+            return run
+
+        cases = {
+            "space_detail": view("space-detail"),
+            "space_detail fields": view("space-detail", fields="id,content.title"),
+            "listing": view("space-content-list", limit=20),
+            "listing q": view("space-content-list", limit=20, q="news"),
+            "serialization model": lambda: ContentSerializer(instances, many=True).data,
+            "serialization fast": lambda: FastContentSerializer(values, many=True).data,
+            "search": search("news release"),
+            "search missing": search("missing"),
+        }
+        stdout.write(
+            f"rows={rows} space_rows={len(values)} repeat={repeat}"
+            f" vendor={connection.vendor}"
+        )
+        stdout.write(
+            f"{'case':>20} {'min ms':>9} {'median ms':>10} {'mean ms':>9}"
+            f" {'stddev ms':>10}"
+        )
+        results = {}
+        for name, func in cases.items():
+            # 初回(ステータス、Structureの読み込みなど)は除く
+            func()
+            results[name] = summarize(timings(func, repeat))
+            stats = {key: value * 1000 for key, value in results[name].items()}
+            stdout.write(
+                f"{name:>20} {stats['min']:>9.2f} {stats['median']:>10.2f}"
+                f" {stats['mean']:>9.2f} {stats['stddev']:>10.2f}"
+            )
+        cache.clear()
+        transaction.set_rollback(True)
+    return results
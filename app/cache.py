@@ -0,0 +1,271 @@
+"""
+Spaceの読み取り結果のキャッシュ
+キーはSpaceのidとSpaceごとのバージョンで、バージョンはapp.signalsで更新する
+バックエンドはsettings.SPACE_CACHEで切り替える
+"""
+
+import asyncio
+import pickle
+import threading
+from collections import OrderedDict
+
+import pytest
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from app.routers import use_primary
+
+
+class LRUBackend:
+    """
+    プロセス内のLRU
+    max_entries: 保持する件数の上限
+    max_bytes: 保持するデータのpickle後のサイズの合計の上限
+
+    バージョンはプロセス内に保持するため、複数プロセスで動かす場合は
+    共有キャッシュを使うDjangoCacheBackendを選ぶこと
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_version(self, space_id):
+        return self._versions.get(space_id, 0)
+
+    def incr_version(self, space_id):
+        with self._lock:
+            self._versions[space_id] = self._versions.get(space_id, 0) + 1
+
+    # プロセス内の操作でI/Oを伴わないため、非同期版は同期版をそのまま呼ぶ
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value):
+        self.set(key, value)
+
+    async def aget_version(self, space_id):
+        return self.get_version(space_id)
+
+
+class DjangoCacheBackend:
+    """
+    Djangoのキャッシュフレームワーク(settings.CACHES)を使う
+    alias: CACHESのキー
+    timeout: データの有効期限(秒)、バージョンは期限なしで保持する
+    """
+
+    def __init__(self, alias="default", timeout=None):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+    def get_version(self, space_id):
+        return self.cache.get(f"space-version:{space_id}", 0)
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value):
+        await self.cache.aset(key, value, self.timeout)
+
+    async def aget_version(self, space_id):
+        return await self.cache.aget(f"space-version:{space_id}", 0)
+
+    def incr_version(self, space_id):
+        key = f"space-version:{space_id}"
+        # 未作成ならaddで作る、他のプロセスと競合した場合はincrで進める
+        if not self.cache.add(key, 1, None):
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.set(key, 1, None)
+
+
+class SpaceCache:
+    """
+    Spaceごとのバージョン付きキャッシュ
+    hits, misses: get_or_setの結果の件数
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, space_id, variant=""):
+        version = self.backend.get_version(space_id)
+        return self._key(space_id, version, variant)
+
+    @staticmethod
+    def _key(space_id, version, variant):
+        return f"space:{space_id}:{version}:{variant}"
+
+    def get_or_set(self, space_id, build, variant=""):
+        """
+        キャッシュがあれば返し、なければbuild()の結果を保存して返す
+        variant: 同じSpaceの異なる表現(クエリパラメータなど)を区別する
+        build()はread_replicaの中でもdefaultから読む
+        (遅延したレプリカの結果を現在のバージョンで保存しないため)
+        """
+        key = self.key(space_id, variant)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        with use_primary():
+            value = build()
+        self.backend.set(key, value)
+        return value
+
+    async def aget_or_set(self, space_id, build, variant=""):
+        """get_or_setの非同期版 build()はコルーチンを返す関数"""
+        version = await self.backend.aget_version(space_id)
+        key = self._key(space_id, version, variant)
+        value = await self.backend.aget(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        with use_primary():
+            value = await build()
+        await self.backend.aset(key, value)
+        return value
+
+    def invalidate(self, *space_ids):
+        for space_id in set(space_ids):
+            self.backend.incr_version(space_id)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_space_cache = None
+
+
+def get_space_cache():
+    """settings.SPACE_CACHEから作ったSpaceCacheを返す"""
+    global _space_cache
+    if _space_cache is None:
+        config = settings.SPACE_CACHE
+        backend = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+        _space_cache = SpaceCache(backend)
+    return _space_cache
+
+
+@receiver(setting_changed)
+def reset_space_cache(setting, **kwargs):
+    global _space_cache
+    if setting in ("SPACE_CACHE", "CACHES"):
+        _space_cache = None
+
+
+def test_lru_backend_evicts_least_recently_used():
+    backend = LRUBackend(max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    assert backend.get("a") == 1
+    backend.set("c", 3)
+    assert backend.get("b") is None
+    assert backend.get("a") == 1
+    assert backend.get("c") == 3
+
+
+def test_lru_backend_max_bytes():
+    size = len(pickle.dumps("x" * 100, pickle.HIGHEST_PROTOCOL))
+    backend = LRUBackend(max_bytes=size * 2)
+    backend.set("a", "x" * 100)
+    backend.set("b", "x" * 100)
+    backend.set("c", "x" * 100)
+    assert len(backend) == 2
+    assert backend.get("a") is None
+    backend.set("too-large", "x" * 1000)
+    assert backend.get("too-large") is None
+
+
+@pytest.mark.parametrize("backend", [LRUBackend, DjangoCacheBackend])
+def test_space_cache_versions(backend):
+    cache = SpaceCache(backend())
+    calls = []
+
+    def build():
+        calls.append(1)
+        return {"id": 1, "content": []}
+
+    cache.clear()
+    assert cache.get_or_set(1, build) == {"id": 1, "content": []}
+    assert cache.get_or_set(1, build) == {"id": 1, "content": []}
+    assert cache.get_or_set(1, build, variant="limit=1") == {"id": 1, "content": []}
+    assert len(calls) == 2
+    cache.invalidate(1)
+    cache.get_or_set(1, build)
+    assert len(calls) == 3
+    assert cache.stats() == {"hits": 1, "misses": 3}
+
+
+@pytest.mark.parametrize("backend", [LRUBackend, DjangoCacheBackend])
+def test_space_cache_async(backend):
+    cache = SpaceCache(backend())
+    cache.clear()
+
+    async def build():
+        return {"id": 1, "content": []}
+
+    async def run():
+        assert await cache.aget_or_set(1, build) == {"id": 1, "content": []}
+        # 同期版と同じキーを使う
+        assert cache.get_or_set(1, lambda: None) == {"id": 1, "content": []}
+        cache.invalidate(1)
+        assert await cache.aget_or_set(1, build, variant="q=a") is not None
+
+    asyncio.run(run())
+    assert cache.stats() == {"hits": 1, "misses": 2}
@@ -0,0 +1,493 @@
+"""
+Spaceの変更の取得 (GET spaces/<pk>/changes/?since=)
+Content, Status, Structure, Spaceの所属の変更をContentChangeに追記し、
+クライアントは前回のnextより後の変更だけを受け取って手元の一覧を更新する
+
+記録は変更と同じトランザクションで行う。idは採番順でコミット順ではないため、
+idの順に読むと、後からコミットされた小さいidの記録を読み飛ばすことがある
+    PostgreSQL: 記録したトランザクションのid(xact_id、マイグレーション0010)と
+        idの順に読み、実行中で最も古いトランザクション(pg_snapshot_xmin)より前の記録だけ返す
+        それより前のトランザクションは全て終わっているため、後から記録が現れることはない
+    SQLite: 書き込みのトランザクションは1つずつ実行されるため、idの順がコミットの順になる
+読み取り位置(since, next)は"xact_id.id"の文字列で、xact_idが0(SQLite)ならidのみ
+    PostgreSQLでidのみの読み取り位置(0010より前のnext)は、そのid以下で最新の記録の
+    xact_idから読む。0010より前の記録のxact_idは全てマイグレーションのトランザクションのid
+読み取り時に同じContentの変更を1件にまとめ、現在の出力(またはdelete)を返す
+
+圧縮(compact_changes)は同じSpaceとContentの、読む順でより後の記録がある古い記録だけを消す
+Contentごとの最新の記録は残るため、どのsinceからでも再現できる
+bulk_createなどシグナルが送られない変更では、record_changes, record_updatesを直接呼ぶこと
+"""
+
+from datetime import timedelta
+from itertools import islice
+from unittest import skipUnless
+
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, Exists, OuterRef, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from app.models import Content, ContentChange, Space, Status, Structure
+from app.references import get_reference_loader, referencing_content_ids
+from app.registry import status_registry
+from app.serializer import FastContentSerializer, SpaceSerializer
+
+SpaceContent = Space.content.through
+
+RECORD_BATCH_SIZE = 1000
+COMPACT_BATCH_SIZE = 5000
+
+
+def _record_pairs(pairs, action):
+    """(space_id, content_id)のイテラブルをRECORD_BATCH_SIZE件ずつ記録する"""
+    pairs = iter(pairs)
+    while batch := list(islice(pairs, RECORD_BATCH_SIZE)):
+        ContentChange.objects.bulk_create(
+            [
+                ContentChange(space_id=space_id, content_id=content_id, action=action)
+                for space_id, content_id in batch
+            ]
+        )
+
+
+def record_changes(space_ids, content_ids, action=ContentChange.UPSERT):
+    """space_idsの全てにcontent_idsの変更を記録する"""
+    _record_pairs(
+        (
+            (space_id, content_id)
+            for space_id in space_ids
+            for content_id in content_ids
+        ),
+        action,
+    )
+
+
+def record_updates(content_ids):
+    """
+    更新されたContentのupsertを、属する全てのSpaceに記録する
+    referenceフィールドで展開しているContentも出力が変わるため記録する
+    """
+    content_ids = set(content_ids)
+    content_ids |= referencing_content_ids(content_ids)
+    _record_pairs(
+        SpaceContent.objects.filter(content_id__in=content_ids)
+        .values_list("space_id", "content_id")
+        .iterator(),
+        ContentChange.UPSERT,
+    )
+
+
+def _record_queryset(queryset):
+    # Status, Structureの変更は多くのContentに及ぶため、中間テーブルから直接読む
+    _record_pairs(
+        queryset.values_list("space_id", "content_id").iterator(),
+        ContentChange.UPSERT,
+    )
+
+
+# 実行中で最も古いトランザクションのid、これより前のトランザクションは全て終わっている
+SNAPSHOT_XMIN = "pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+
+
+def _xact_id():
+    return RawSQL(
+        f'"{ContentChange._meta.db_table}"."xact_id"',
+        (),
+        output_field=BigIntegerField(),
+    )
+
+
+def format_cursor(xact_id, pk):
+    """読み取り位置をnextの文字列にする"""
+    return f"{xact_id}.{pk}" if xact_id else str(pk)
+
+
+def _legacy_xact_id(last_id):
+    """idのみの読み取り位置に対応するxact_id、記録がなければ0"""
+    xact_id = (
+        ContentChange.objects.filter(id__lte=last_id)
+        .order_by("-id")
+        .values_list(_xact_id(), flat=True)
+        .first()
+    )
+    return xact_id or 0
+
+
+def changes_queryset(space_id, since=(0, 0)):
+    """
+    space_idのsince((xact_id, id))より後の、読める記録の(xact_id, id, content_id)
+    コミットの順に並べたクエリセット
+    xact_idがNoneならidのみの読み取り位置として扱う
+    """
+    queryset = ContentChange.objects.filter(space_id=space_id)
+    xact_id, last_id = since
+    if connection.vendor != "postgresql":
+        return (
+            queryset.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list(Value(0), "id", "content_id")
+        )
+    if xact_id is None:
+        xact_id = _legacy_xact_id(last_id) if last_id else 0
+    return (
+        queryset.annotate(xact_id=_xact_id())
+        # 実行中のトランザクションの記録は、その後のトランザクションの記録とともに読まない
+        .filter(xact_id__lt=RawSQL(SNAPSHOT_XMIN, ()))
+        .filter(Q(xact_id__gt=xact_id) | Q(xact_id=xact_id, id__gt=last_id))
+        .order_by("xact_id", "id")
+        .values_list("xact_id", "id", "content_id")
+    )
+
+
+def read_changes(space_id, since=(0, 0), limit=100, native_datetimes=False):
+    """
+    space_idのsince((xact_id, id))より後の変更を最大limit件読み、Contentごとにまとめる
+    @return {"changes": [{"seq", "action", "id", "content"}], "next", "has_more"}
+    seq: そのContentの最後の記録の番号、next: 次のsinceに渡す読み取り位置
+    """
+    entries = list(changes_queryset(space_id, since)[: limit + 1])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    # Contentごとに最後の記録の順で返す
+    latest = {}
+    for _, seq, content_id in entries:
+        latest.pop(content_id, None)
+        latest[content_id] = seq
+
+    current = {}
+    if latest:
+        rows = FastContentSerializer.rows(
+            Content.objects.filter(spaces=space_id, id__in=latest)
+        )
+        serializer = FastContentSerializer(
+            None, resolve_references=False, native_datetimes=native_datetimes
+        )
+        contents = get_reference_loader().resolve(
+            [serializer.to_representation(row) for row in rows]
+        )
+        current = {data["id"]: data for data in contents}
+
+    changes = []
+    for content_id, seq in latest.items():
+        content = current.get(content_id)
+        changes.append(
+            {
+                "seq": seq,
+                "action": (
+                    ContentChange.DELETE if content is None else ContentChange.UPSERT
+                ),
+                "id": content_id,
+                "content": content,
+            }
+        )
+    return {
+        "changes": changes,
+        "next": format_cursor(*(entries[-1][:2] if entries else since)),
+        "has_more": has_more,
+    }
+
+
+def _superseded_ids(before, batch_size):
+    """同じSpaceとContentの、読む順でより後の記録があるbeforeより前の記録のid"""
+    if connection.vendor == "postgresql":
+        table = ContentChange._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT c.id FROM {table} c
+                WHERE c.created_at < %s AND EXISTS (
+                    SELECT 1 FROM {table} n
+                    WHERE n.space_id = c.space_id AND n.content_id = c.content_id
+                    AND (n.xact_id, n.id) > (c.xact_id, c.id)
+                )
+                ORDER BY c.id LIMIT %s
+                """,
+                [before, batch_size],
+            )
+            return [pk for (pk,) in cursor.fetchall()]
+    newer = ContentChange.objects.filter(
+        space_id=OuterRef("space_id"),
+        content_id=OuterRef("content_id"),
+        id__gt=OuterRef("id"),
+    )
+    superseded = ContentChange.objects.filter(created_at__lt=before).filter(
+        Exists(newer)
+    )
+    return list(superseded.order_by("id").values_list("id", flat=True)[:batch_size])
+
+
+def compact_changes(before, batch_size=COMPACT_BATCH_SIZE):
+    """
+    before より前の記録のうち、同じSpaceとContentの読む順でより後の記録があるものを消す
+    @return 消した件数
+    """
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = _superseded_ids(before, batch_size)
+            if not ids:
+                return deleted
+            deleted += ContentChange.objects.filter(id__in=ids).delete()[0]
+
+
+def _content_space_ids(content_ids):
+    return list(
+        SpaceContent.objects.filter(content_id__in=content_ids).values_list(
+            "space_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Content)
+def content_saved(sender, instance, created, **kwargs):
+    # 作成直後はどのSpaceにも属していない
+    if not created:
+        record_updates([instance.pk])
+
+
+@receiver(pre_delete, sender=Content)
+def content_deleting(sender, instance, **kwargs):
+    # 削除後は中間テーブルの行も消えているため、削除前に集める
+    instance._change_space_ids = _content_space_ids([instance.pk])
+    instance._change_referencing_ids = referencing_content_ids([instance.pk])
+
+
+@receiver(post_delete, sender=Content)
+def content_deleted(sender, instance, **kwargs):
+    record_changes(
+        getattr(instance, "_change_space_ids", []),
+        [instance.pk],
+        ContentChange.DELETE,
+    )
+    referencing = getattr(instance, "_change_referencing_ids", set())
+    if referencing:
+        record_updates(referencing)
+
+
+@receiver(post_save, sender=Status)
+def status_saved(sender, instance, created, **kwargs):
+    # Statusの削除はContentの削除として記録される
+    if not created:
+        _record_queryset(SpaceContent.objects.filter(content__status_id=instance.pk))
+
+
+@receiver(post_save, sender=Structure)
+def structure_saved(sender, instance, created, **kwargs):
+    # schemaが変わるとそのStructureのContentの出力が変わる
+    if not created:
+        _record_queryset(SpaceContent.objects.filter(content__model_id=instance.pk))
+
+
+@receiver(m2m_changed, sender=SpaceContent)
+def space_content_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # space.content.add(...)など、instanceはSpace
+        if action == "post_add":
+            record_changes([instance.pk], pk_set)
+        elif action == "post_remove":
+            record_changes([instance.pk], pk_set, ContentChange.DELETE)
+        elif action == "pre_clear":
+            instance._cleared_content_ids = list(
+                instance.content.values_list("id", flat=True)
+            )
+        elif action == "post_clear":
+            record_changes(
+                [instance.pk],
+                getattr(instance, "_cleared_content_ids", []),
+                ContentChange.DELETE,
+            )
+    elif action == "pre_clear":
+        # content.spaces.clear()、pk_setがNoneのため消す前に集める
+        instance._cleared_change_space_ids = _content_space_ids([instance.pk])
+    elif action == "post_clear":
+        record_changes(
+            getattr(instance, "_cleared_change_space_ids", []),
+            [instance.pk],
+            ContentChange.DELETE,
+        )
+    elif action == "post_add":
+        record_changes(pk_set, [instance.pk])
+    elif action == "post_remove":
+        record_changes(pk_set, [instance.pk], ContentChange.DELETE)
+
+
+class TestChangeFeed(TestCase):
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.other = Space.objects.create(name="Other Space")
+        self.draft = Status.objects.create(status="draft")
+        self.contents = [
+            Content.objects.create(title=f"Test Content {i}", status=self.draft)
+            for i in range(5)
+        ]
+        self.space.content.set(self.contents)
+        self.url = reverse("space-changes", args=[self.space.id])
+
+    def replay(self, state=None, since="0", limit=2):
+        """変更を最後まで読んでstate(idごとのContent)に反映し、(state, next)を返す"""
+        state = {} if state is None else dict(state)
+        while True:
+            response = self.client.get(self.url, {"since": since, "limit": limit})
+            assert response.status_code == 200
+            body = response.json()
+            assert len(body["changes"]) <= limit
+            for change in body["changes"]:
+                if change["action"] == "upsert":
+                    state[change["id"]] = change["content"]
+                else:
+                    state.pop(change["id"], None)
+            since = body["next"]
+            if not body["has_more"]:
+                return state, since
+
+    def expected(self):
+        content = SpaceSerializer(Space.objects.get(pk=self.space.id)).data["content"]
+        return sorted(content, key=lambda data: data["id"])
+
+    def assert_replayed(self, state):
+        assert [state[pk] for pk in sorted(state)] == self.expected()
+
+    def mutate(self):
+        content = self.contents[0]
+        content.title = "Updated Content"
+        content.save()
+        self.space.content.remove(self.contents[1])
+        self.contents[2].spaces.clear()
+        self.contents[3].delete()
+        added = Content.objects.create(title="Added Content", status=self.draft)
+        added.spaces.add(self.space, self.other)
+        self.draft.status = "review"
+        self.draft.save()
+
+    def test_replay(self):
+        state, since = self.replay()
+        self.assert_replayed(state)
+        # 前回のnextからの差分だけで最新の状態になる
+        self.mutate()
+        state, since = self.replay(state, since)
+        self.assert_replayed(state)
+        assert {row["_status"] for row in state.values()} == {"review"}
+        # 最初から読んでも同じ
+        self.assert_replayed(self.replay(limit=3)[0])
+
+        body = self.client.get(self.url, {"since": since}).json()
+        assert body == {"changes": [], "next": since, "has_more": False}
+
+    def test_changes_are_merged_per_content(self):
+        since = self.replay()[1]
+        content = self.contents[0]
+        for i in range(3):
+            content.title = f"Updated Content {i}"
+            content.save()
+        self.space.content.remove(self.contents[1])
+        body = self.client.get(self.url, {"since": since}).json()
+        assert [(c["action"], c["id"]) for c in body["changes"]] == [
+            ("upsert", content.id),
+            ("delete", self.contents[1].id),
+        ]
+        assert body["changes"][0]["content"]["title"] == "Updated Content 2"
+        assert body["changes"][1]["content"] is None
+
+    def test_references(self):
+        news = Structure.objects.create(
+            name="news",
+            description="",
+            schema=[{"key": "related", "type": "reference"}],
+        )
+        source, target = self.contents[:2]
+        source.model = news
+        source.custom_fields = {"related": target.id}
+        source.save()
+        state, since = self.replay()
+        # 参照先の変更は参照しているContentの変更として返す
+        target.title = "Updated Target"
+        target.save()
+        state, since = self.replay(state, since)
+        assert state[source.id]["related"]["title"] == "Updated Target"
+        self.assert_replayed(state)
+
+    def test_compact(self):
+        since = self.replay()[1]
+        self.mutate()
+        for content in self.contents[:1]:
+            content.save()
+        count = ContentChange.objects.count()
+        deleted = compact_changes(timezone.now() + timedelta(seconds=1), batch_size=2)
+        assert 0 < deleted < count
+        # Space, Contentごとに1件だけ残る
+        pairs = list(ContentChange.objects.values_list("space_id", "content_id"))
+        assert len(pairs) == len(set(pairs))
+        self.assert_replayed(self.replay()[0])
+        # 圧縮前のnextからも再現できる
+        state = {data["id"]: data for data in self.expected()}
+        self.assert_replayed(self.replay(state, since)[0])
+
+    def test_compact_keeps_recent(self):
+        self.contents[0].save()
+        assert compact_changes(timezone.now() - timedelta(days=1)) == 0
+
+    def test_cursor(self):
+        body = self.client.get(self.url, {"limit": 2}).json()
+        last = ContentChange.objects.filter(space=self.space).order_by("id")[1]
+        assert body["next"] == str(last.id) == format_cursor(0, last.id)
+        assert format_cursor(12, 3) == "12.3"
+        # "xact_id.id"の形の読み取り位置も受け付ける
+        body = self.client.get(self.url, {"since": f"0.{last.id}"}).json()
+        assert [change["id"] for change in body["changes"]] == [
+            content.id for content in self.contents[2:]
+        ]
+
+    def test_query_count(self):
+        status_registry.name(self.draft.id)
+        for limit in (1, 5):
+            # Spaceの確認、記録、Contentの取得の3回で件数によらない
+            with self.assertNumQueries(3):
+                body = self.client.get(self.url, {"limit": limit}).json()
+            assert len(body["changes"]) == limit
+
+    def test_invalid_params(self):
+        for since in (-1, "a", "1.2.3", "1."):
+            assert self.client.get(self.url, {"since": since}).status_code == 400
+        assert self.client.get(self.url, {"limit": 0}).status_code == 400
+        url = reverse("space-changes", args=[self.other.id + 1])
+        assert self.client.get(url).status_code == 404
+
+
+@skipUnless(connection.vendor == "postgresql", "xact_id is PostgreSQL only")
+class TestLegacyCursor(TransactionTestCase):
+    # 実行中のトランザクションの記録は読まないため、TestCaseのトランザクションの外で書く
+    def test_legacy_cursor(self):
+        space = Space.objects.create(name="Test Space")
+        draft = Status.objects.create(status="draft")
+        contents = [
+            Content.objects.create(title=f"Test Content {i}", status=draft)
+            for i in range(3)
+        ]
+        for content in contents:
+            space.content.add(content)
+        # 0010より前の記録は全てマイグレーションのトランザクションのxact_idを持つ
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {ContentChange._meta.db_table} "
+                "SET xact_id = pg_current_xact_id()::text::bigint"
+            )
+        first, second = ContentChange.objects.order_by("id")[:2]
+        added = Content.objects.create(title="Added Content", status=draft)
+        space.content.add(added)
+        url = reverse("space-changes", args=[space.id])
+        body = self.client.get(url, {"since": str(first.id)}).json()
+        assert [change["id"] for change in body["changes"]] == [
+            content.id for content in [*contents[1:], added]
+        ]
+        # 記録が圧縮で消えていても、それより前の記録のxact_idから読む
+        second.delete()
+        body = self.client.get(url, {"since": str(second.id)}).json()
+        assert [change["id"] for change in body["changes"]] == [
+            contents[2].id,
+            added.id,
+        ]
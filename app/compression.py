@@ -0,0 +1,298 @@
+"""
+レスポンスの圧縮 (Accept-Encoding)
+gzipに加え、brotli, zstandardがインストールされていればbr, zstdも使う
+
+ETagのあるレスポンス(app.conditional)は、圧縮したバイト列を元の本文のハッシュと
+圧縮方式ごとにキャッシュし、同じ本文の2回目以降は圧縮せずに返す
+(ETagは参照先のStatusなどの変更で変わらない場合があるため、キーには使わない)
+設定はsettings.RESPONSE_COMPRESSION
+"""
+
+import gzip
+import hashlib
+import threading
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.module_loading import import_string
+
+from app.models import Content, Space, Status
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_SETTINGS = {
+    # これより小さい本文は圧縮しない(バイト)
+    "MIN_SIZE": 1024,
+    # 圧縮方式ごとのレベル
+    "LEVELS": {"zstd": 3, "br": 4, "gzip": 6},
+    # 圧縮したバイト列のキャッシュ、app.cacheのバックエンド
+    "CACHE": {"BACKEND": "app.cache.LRUBackend", "OPTIONS": {}},
+}
+
+
+def _gzip(data, level):
+    # mtimeを固定し、同じ本文からは同じバイト列を作る
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level)
+
+
+_zstd_compressors = threading.local()
+
+
+def _zstd(data, level):
+    # ZstdCompressorはスレッドセーフではないため、スレッド・レベルごとに作る
+    compressors = _zstd_compressors.__dict__
+    if level not in compressors:
+        compressors[level] = zstandard.ZstdCompressor(level=level)
+    return compressors[level].compress(data)
+
+
+def available_codecs():
+    """使える圧縮方式 {名前: compress(data, level)}、優先する順"""
+    codecs = {}
+    if zstandard is not None:
+        codecs["zstd"] = _zstd
+    if brotli is not None:
+        codecs["br"] = _brotli
+    codecs["gzip"] = _gzip
+    return codecs
+
+
+CODECS = available_codecs()
+
+
+def parse_accept_encoding(header):
+    """Accept-Encodingを{圧縮方式: q値}にする"""
+    accepted = {}
+    for item in header.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+    return accepted
+
+
+def choose_encoding(header, codecs=CODECS):
+    """
+    Accept-Encodingで受け付けられる圧縮方式のうち、q値が最大のものを返す
+    同じq値ならcodecsの順、受け付けられるものがなければNone
+    """
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    for coding in codecs:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class CompressionMiddleware:
+    """
+    MIDDLEWAREのQueryMetricsMiddlewareの直後に置き、圧縮の時間も計測に含める
+    ストリーミングレスポンス、圧縮済み、Cache-Control: no-transformは圧縮しない
+    hits, misses: 圧縮済みのキャッシュの結果の件数
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = {**DEFAULT_SETTINGS, **getattr(settings, "RESPONSE_COMPRESSION", {})}
+        self.min_size = config["MIN_SIZE"]
+        self.levels = {**DEFAULT_SETTINGS["LEVELS"], **config["LEVELS"]}
+        cache = config["CACHE"]
+        self.cache = import_string(cache["BACKEND"])(**cache.get("OPTIONS", {}))
+        self.hits = self.misses = 0
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    def process_response(self, request, response):
+        if response.streaming or response.status_code != 200:
+            return response
+        patch_vary_headers(response, ["Accept-Encoding"])
+        if (
+            response.has_header("Content-Encoding")
+            or "no-transform" in response.get("Cache-Control", "")
+            or len(response.content) < self.min_size
+        ):
+            return response
+        encoding = choose_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None:
+            return response
+
+        content = self.compress(request, response, encoding)
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response["Content-Length"] = str(len(content))
+        response["Content-Encoding"] = encoding
+        # 圧縮した表現は元の表現とバイト単位では一致しないため弱いETagにする
+        etag = response.get("ETag")
+        if etag and not etag.startswith("W/"):
+            response["ETag"] = f"W/{etag}"
+        return response
+
+    def compress(self, request, response, encoding):
+        """
+        ETagのあるレスポンスは圧縮したバイト列をキャッシュから返す
+        キーは本文のハッシュで、本文が変われば必ず別のキーになる
+        """
+        if not response.has_header("ETag"):
+            return CODECS[encoding](response.content, self.levels[encoding])
+        digest = hashlib.blake2b(response.content, digest_size=20).hexdigest()
+        key = f"{encoding}:{digest}"
+        content = self.cache.get(key)
+        if content is not None:
+            self.hits += 1
+            return content
+        self.misses += 1
+        content = CODECS[encoding](response.content, self.levels[encoding])
+        self.cache.set(key, content)
+        return content
+
+
+BODY = b'{"id":1,"content":[' + b'{"title":"Test Content"},' * 200 + b"]}"
+
+
+def _view(request):
+    response = HttpResponse(BODY, content_type="application/json")
+    response["ETag"] = '"1-1-1"'
+    return response
+
+
+def test_choose_encoding():
+    codecs = {"zstd": None, "br": None, "gzip": None}
+    assert choose_encoding("gzip, deflate, br, zstd", codecs) == "zstd"
+    assert choose_encoding("gzip;q=1.0, br;q=0.5", codecs) == "gzip"
+    assert choose_encoding("*;q=0.5, zstd;q=0", codecs) == "br"
+    assert choose_encoding("identity", codecs) is None
+    assert choose_encoding("", codecs) is None
+    assert choose_encoding("gzip;q=0", codecs) is None
+
+
+def test_compression_middleware():
+    rf = RequestFactory()
+    middleware = CompressionMiddleware(_view)
+    for encoding in CODECS:
+        request = rf.get("/spaces/1/", headers={"accept-encoding": encoding})
+        response = middleware(request)
+        assert response["Content-Encoding"] == encoding
+        assert int(response["Content-Length"]) == len(response.content) < len(BODY)
+        assert response["ETag"] == 'W/"1-1-1"'
+        assert "Accept-Encoding" in response["Vary"]
+        decompress = {
+            "gzip": gzip.decompress,
+            "br": lambda data: brotli.decompress(data),
+            "zstd": lambda data: zstandard.ZstdDecompressor().decompress(data),
+        }[encoding]
+        assert decompress(response.content) == BODY
+        # 同じバージョンの2回目以降はキャッシュした圧縮済みのバイト列を返す
+        assert middleware(request).content == response.content
+    assert (middleware.hits, middleware.misses) == (len(CODECS), len(CODECS))
+
+    assert not middleware(rf.get("/spaces/1/")).has_header("Content-Encoding")
+
+
+def test_compression_middleware_body_changed():
+    bodies = [BODY, BODY.replace(b"Test", b"Next")]
+
+    def view(request):
+        response = _view(request)
+        response.content = bodies[0]
+        return response
+
+    middleware = CompressionMiddleware(view)
+    request = RequestFactory().get("/spaces/1/", headers={"accept-encoding": "gzip"})
+    assert gzip.decompress(middleware(request).content) == BODY
+    # 同じETag・URLでも本文が変われば圧縮し直す
+    bodies.pop(0)
+    assert gzip.decompress(middleware(request).content) == bodies[0]
+    assert (middleware.hits, middleware.misses) == (0, 2)
+
+
+@override_settings(RESPONSE_COMPRESSION={"MIN_SIZE": len(BODY) + 1})
+def test_compression_middleware_min_size():
+    middleware = CompressionMiddleware(_view)
+    request = RequestFactory().get("/", headers={"accept-encoding": "gzip"})
+    response = middleware(request)
+    assert not response.has_header("Content-Encoding")
+    assert response.content == BODY
+
+
+def test_compression_middleware_levels():
+    rf = RequestFactory()
+    request = rf.get("/", headers={"accept-encoding": "gzip"})
+    sizes = []
+    for level in (1, 9):
+        with override_settings(RESPONSE_COMPRESSION={"LEVELS": {"gzip": level}}):
+            sizes.append(len(CompressionMiddleware(_view)(request).content))
+    assert sizes[0] >= sizes[1]
+
+
+class TestCompressedSpaceDetail(TestCase):
+    def setUp(self):
+        space = Space.objects.create(name="Test Space")
+        self.status = status = Status.objects.create(status="draft")
+        space.content.set(
+            Content.objects.bulk_create(
+                [Content(title=f"Test Content {i}", status=status) for i in range(30)]
+            )
+        )
+        self.url = reverse("space-detail", args=[space.id])
+
+    def test_space_detail(self):
+        plain = self.client.get(self.url)
+        response = self.client.get(self.url, headers={"accept-encoding": "gzip"})
+        assert response["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.content) == plain.content
+        assert response["ETag"] == f"W/{plain['ETag']}"
+        # 弱いETagでも条件付きGETは一致する
+        response = self.client.get(
+            self.url,
+            headers={"accept-encoding": "gzip", "if-none-match": response["ETag"]},
+        )
+        assert response.status_code == 304
+
+    def test_space_detail_status_renamed(self):
+        headers = {"accept-encoding": "gzip"}
+        self.client.get(self.url, headers=headers)
+        self.status.status = "published"
+        self.status.save()
+        plain = self.client.get(self.url)
+        assert b'"published"' in plain.content
+        response = self.client.get(self.url, headers=headers)
+        assert gzip.decompress(response.content) == plain.content
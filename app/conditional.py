@@ -0,0 +1,107 @@
+"""
+Space単位の条件付きGET (ETag / Last-Modified)
+検証子は集計クエリ1回で求め、一致すればビューを呼ばずに304を返す
+"""
+
+import functools
+
+from django.db.models import Count, Max, Sum
+from django.http import Http404
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from app.models import Space
+
+
+def _validator_queryset(pk):
+    return (
+        Space.objects.filter(pk=pk)
+        .values("updated_at")
+        .annotate(
+            content_count=Count("content"),
+            content_id_sum=Sum("content__id"),
+            content_updated_at=Max("content__updated_at"),
+        )
+    )
+
+
+def _validator_result(row):
+    if row is None:
+        return None
+    last_modified = max(
+        filter(None, [row["updated_at"], row["content_updated_at"]])
+    ).timestamp()
+    etag = quote_etag(
+        f"{row['content_count']}-{row['content_id_sum'] or 0}"
+        f"-{int(last_modified * 1_000_000)}"
+    )
+    return etag, int(last_modified)
+
+
+def space_validator(pk):
+    """
+    Spaceの(ETag, Last-Modified)を返す、Spaceがなければ None
+    ETag: Contentの件数、idの合計、Space, Contentのupdated_atの最大値
+    Last-Modified: Space, Contentのupdated_atの最大値(UNIX時間)
+    Statusの名前、参照先、schema、所属の変更ではapp.signalsがSpaceのupdated_atを進める
+    """
+    return _validator_result(next(iter(_validator_queryset(pk)), None))
+
+
+async def aspace_validator(pk):
+    """space_validatorの非同期版"""
+    row = None
+    async for row in _validator_queryset(pk):
+        break
+    return _validator_result(row)
+
+
+def _set_validator_headers(response, etag, last_modified):
+    if response.status_code in (200, 304):
+        response.headers.setdefault("ETag", etag)
+        response.headers.setdefault("Last-Modified", http_date(last_modified))
+        # 形式はAcceptで選ぶため(app.renderers)、キャッシュは形式ごとに分ける
+        patch_vary_headers(response, ["Accept"])
+    return response
+
+
+def conditional_space(view):
+    """
+    view(request, pk)にETag, Last-Modifiedを付ける
+    If-None-Match / If-Modified-Sinceが一致すればviewを呼ばずに304を返す
+    Spaceがなければ404にする
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, pk, *args, **kwargs):
+        validator = space_validator(pk)
+        if validator is None:
+            raise Http404("Space does not exist")
+        etag, last_modified = validator
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = view(request, pk, *args, **kwargs)
+        return _set_validator_headers(response, etag, last_modified)
+
+    return wrapper
+
+
+def aconditional_space(view):
+    """conditional_spaceの非同期ビュー版"""
+
+    @functools.wraps(view)
+    async def wrapper(request, pk, *args, **kwargs):
+        validator = await aspace_validator(pk)
+        if validator is None:
+            raise Http404("Space does not exist")
+        etag, last_modified = validator
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = await view(request, pk, *args, **kwargs)
+        return _set_validator_headers(response, etag, last_modified)
+
+    return wrapper
@@ -0,0 +1,264 @@
+"""
+fields=クエリパラメータによる出力の絞り込み (sparse fieldsets)
+fields=id,title のようにカンマ区切りでキーを指定する
+Spaceのエンドポイントでは content.title のようにContentのキーを指定できる
+
+出力を絞るだけでなく、取得する列もContentのクエリの.only()/.values_list()で絞る
+referenceフィールドの展開とページングに使う列は、指定がなくても取得して出力から除く
+"""
+
+import json
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from app.cache import get_space_cache
+from app.models import Content, Space, Status, Structure
+from app.registry import status_registry
+from app.structures import structure_registry
+
+# Contentの出力のキー: 取得する列 (FastContentSerializerの出力の順)
+CONTENT_COLUMNS = {
+    "id": "id",
+    "_status": "status_id",
+    "title": "title",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+    "published_at": "published_at",
+    "model": "model_id",
+    "status": "status_id",
+}
+
+# カスタムフィールドの出力に必要な列
+CUSTOM_FIELD_COLUMNS = ("model_id", "custom_fields")
+
+SPACE_KEYS = ("id", "content")
+
+
+def parse_fields(value):
+    """
+    fields=の値をキーのタプル(重複なし、指定順)にする
+    空の値はNone(絞り込みなし)
+    """
+    if value is None or not value.strip():
+        return None
+    keys = [key.strip() for key in value.split(",")]
+    if not all(keys):
+        raise ValueError("fieldsに空のキーがあります")
+    return tuple(dict.fromkeys(keys))
+
+
+def parse_content_fields(value):
+    """Contentのエンドポイントのfields=、入れ子のキーは指定できない"""
+    fields = parse_fields(value)
+    if fields and any("." in key for key in fields):
+        raise ValueError("Contentのキーに.は使えません")
+    return fields
+
+
+def parse_space_fields(value):
+    """
+    Spaceのエンドポイントのfields=を(Spaceのキー, Contentのキー)にする
+    Contentのキーは content.<キー> の指定がなければNone(全てのキー)
+    """
+    fields = parse_fields(value)
+    if fields is None:
+        return None, None
+    space_fields = []
+    content_fields = []
+    whole_content = False
+    for key in fields:
+        name, _, nested = key.partition(".")
+        if name not in SPACE_KEYS or (nested and name != "content"):
+            raise ValueError(f"不明なキーです: {key}")
+        if name not in space_fields:
+            space_fields.append(name)
+        if name == "content":
+            if nested:
+                content_fields.append(nested)
+            else:
+                whole_content = True
+    content_fields = parse_content_fields(",".join(content_fields))
+    return tuple(space_fields), None if whole_content else content_fields
+
+
+def content_keys(fields):
+    """
+    fieldsの出力を組み立てるのに必要なキー
+    idはreferenceの循環の検出に、modelはカスタムフィールドのschemaの参照に使う
+    """
+    keys = {"id", *fields}
+    if not keys <= CONTENT_COLUMNS.keys():
+        keys.add("model")
+    return keys
+
+
+def content_columns(fields, extra=()):
+    """
+    fieldsの出力に必要なContentの列 (CONTENT_COLUMNS, CUSTOM_FIELD_COLUMNSの順)
+    extra: ページングなど出力以外に必要な列
+    """
+    columns = {
+        CONTENT_COLUMNS[key] for key in content_keys(fields) if key in CONTENT_COLUMNS
+    }
+    columns.update(extra)
+    if not set(fields) <= CONTENT_COLUMNS.keys():
+        columns.update(CUSTOM_FIELD_COLUMNS)
+    order = list(dict.fromkeys([*CONTENT_COLUMNS.values(), *CUSTOM_FIELD_COLUMNS]))
+    return tuple(sorted(columns, key=order.index))
+
+
+def project(data, fields):
+    """dataのうちfieldsのキーのみを出力の順のまま残す"""
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def project_space(data, fields, content_fields):
+    """Spaceの出力(SpaceSerializerの形)をfields, content_fieldsで絞る"""
+    if data is None:
+        return None
+    data = project(data, fields)
+    if content_fields is not None and "content" in data:
+        data["content"] = [project(row, content_fields) for row in data["content"]]
+    return data
+
+
+def test_parse_fields():
+    assert parse_fields(None) is None
+    assert parse_fields("") is None
+    assert parse_fields("id, title,id") == ("id", "title")
+    assert parse_space_fields("id,content.title,content.id") == (
+        ("id", "content"),
+        ("title", "id"),
+    )
+    assert parse_space_fields("content,content.title") == (("content",), None)
+    assert parse_space_fields("id") == (("id",), None)
+    for value in ("id,,title", "content.title.x"):
+        try:
+            parse_space_fields(value)
+        except ValueError:
+            continue
+        raise AssertionError(value)
+    try:
+        parse_space_fields("name")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("name")
+
+
+def test_content_columns():
+    assert content_columns(("title",)) == ("id", "title")
+    assert content_columns(("_status",), extra=("published_at",)) == (
+        "id",
+        "status_id",
+        "published_at",
+    )
+    # カスタムフィールドはmodel_idとcustom_fieldsから組み立てる
+    assert content_columns(("price",)) == ("id", "model_id", "custom_fields")
+
+
+class TestSparseFieldsets(TestCase):
+    """fields=の指定で出力とSELECTする列が同時に減ることを確認する"""
+
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.status = Status.objects.create(status="draft")
+        self.news = Structure.objects.create(
+            name="news",
+            description="",
+            schema=[
+                {"key": "body", "type": "multiline"},
+                {"key": "price", "type": "number"},
+            ],
+        )
+        contents = Content.objects.bulk_create(
+            [
+                Content(
+                    title=f"Test Content {i}",
+                    status=self.status,
+                    model=self.news,
+                    custom_fields={"body": "本文" * 100, "price": i},
+                )
+                for i in range(5)
+            ]
+        )
+        self.space.content.set(contents)
+        status_registry.name(self.status.id)
+        structure_registry.get(self.news.id)
+
+    def get(self, name, fields):
+        """
+        レスポンスのJSONと、Contentの行を取得したSELECTの列の集合を返す
+        FAST_SERIALIZATIONの有無で出力と列が同じであることも確認する
+        """
+        results = []
+        for fast in (False, True):
+            get_space_cache().clear()
+            with override_settings(FAST_SERIALIZATION=fast):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(
+                        reverse(name, args=[self.space.id]), {"fields": fields}
+                    )
+            assert response.status_code == 200, response.content
+            results.append((response.content, self.content_columns(queries)))
+        assert results[0] == results[1]
+        return json.loads(results[0][0]), results[0][1]
+
+    def content_columns(self, queries):
+        selects = [
+            query["sql"].split(" FROM ")[0]
+            for query in queries.captured_queries
+            if '"app_content"."id"' in query["sql"].split(" FROM ")[0]
+        ]
+        if not selects:
+            return None
+        (select,) = selects
+        # .only()はモデルの定義順、.values_list()は指定順のため集合で比べる
+        return {
+            column.split(" AS ")[0].removeprefix('"app_content".').strip('"')
+            for column in select.removeprefix("SELECT ").split(", ")
+            if column.startswith('"app_content".')
+        }
+
+    def test_content_list(self):
+        body, columns = self.get("space-content-list", "title,_status")
+        assert [list(row) for row in body["data"]] == [["_status", "title"]] * 5
+        # published_atはキーセットのページングに使う
+        assert columns == {"id", "status_id", "title", "published_at"}
+
+        body, columns = self.get("space-content-list", "id,price")
+        assert body["data"][0] == {"id": body["data"][0]["id"], "price": 4}
+        assert columns == {"id", "published_at", "model_id", "custom_fields"}
+
+        body, columns = self.get("space-content-list", "")
+        assert "custom_fields" in columns
+        assert "body" in body["data"][0]
+
+    def test_space_detail(self):
+        body, columns = self.get("space-detail", "content.title")
+        assert body == {"content": [{"title": f"Test Content {i}"} for i in range(5)]}
+        assert columns == {"id", "title"}
+
+        body, columns = self.get("space-detail", "id")
+        assert body == {"id": self.space.id}
+        # Contentは取得しない
+        assert columns is None
+
+        assert self.get("space-detail", "id,content") == self.get("space-detail", "")
+
+    def test_invalid_fields(self):
+        for name, fields in (
+            ("space-detail", "name"),
+            ("space-detail", "content.title.id"),
+            ("space-content-list", "content.title"),
+        ):
+            response = self.client.get(
+                reverse(name, args=[self.space.id]), {"fields": fields}
+            )
+            assert response.status_code == 400
+            assert "fields" in response.json()
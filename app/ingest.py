@@ -0,0 +1,214 @@
+"""
+Contentの一括登録
+入力をbatch_size件ずつ検証し、Contentと中間テーブルの行をbulk_createで作る
+バッチごとに1トランザクションで、失敗した行は行番号とエラーを返す
+"""
+
+import json
+from dataclasses import dataclass, field
+from itertools import islice
+
+import pytest
+from django.db import DatabaseError, transaction
+from rest_framework.exceptions import ValidationError
+
+from app.changes import record_changes
+from app.models import Content, Space, Status, Structure
+from app.registry import status_registry
+from app.serializer import ContentIngestSerializer
+from app.signals import invalidate_spaces
+from app.snapshots import update_snapshots
+from app.structures import structure_registry
+
+INGEST_BATCH_SIZE = 1000
+
+
+@dataclass
+class IngestResult:
+    """
+    created: 作成したContentの件数
+    errors: [{"row": 入力の行番号(0始まり), "errors": エラー}]
+    """
+
+    created: int = 0
+    errors: list = field(default_factory=list)
+
+    def as_dict(self):
+        return {"created": self.created, "errors": self.errors}
+
+
+def iter_ndjson(lines):
+    """
+    NDJSONを1行ずつ読む、空行は飛ばす
+    解析できない行は文字列のまま返し、検証でエラーにする
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode()
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line
+
+
+def ingest_contents(space, rows, batch_size=INGEST_BATCH_SIZE):
+    """rows(dictのイテラブル)をContentとしてspaceに追加する"""
+    result = IngestResult()
+    rows = iter(rows)
+    start = 0
+    while batch := list(islice(rows, batch_size)):
+        _ingest_batch(space, batch, start, result)
+        start += len(batch)
+    return result
+
+
+def _ingest_batch(space, batch, start, result):
+    validator = ContentIngestSerializer()
+    valid = []
+    for row, data in enumerate(batch, start):
+        try:
+            valid.append((row, validator.run_validation(data)))
+        except ValidationError as exc:
+            result.errors.append({"row": row, "errors": exc.detail})
+    if not valid:
+        return
+
+    # Status, Structureはレジストリから引き、未読み込みのStructureはバッチで1回読む
+    names = {data["status"] for _, data in valid if data.get("status")}
+    status_ids = {name: status_registry.id(name) for name in names}
+    structure_registry.prepare({data.get("model") for _, data in valid})
+
+    contents = []
+    for row, data in valid:
+        errors = {}
+        if data.get("status") and status_ids[data["status"]] is None:
+            errors["status"] = [f"不明なStatusです: {data['status']}"]
+        schema = structure_registry.get(data.get("model"))
+        if schema is None:
+            errors["model"] = [f"不明なStructureです: {data['model']}"]
+        else:
+            try:
+                custom_fields = schema.clean(data.get("custom_fields", {}))
+            except ValidationError as exc:
+                errors["custom_fields"] = exc.detail
+        if errors:
+            result.errors.append({"row": row, "errors": errors})
+            continue
+        content = Content(
+            title=data["title"],
+            model_id=data.get("model"),
+            custom_fields=custom_fields,
+            scheduled_at=data.get("scheduled_at"),
+        )
+        if data.get("status"):
+            content.status_id = status_ids[data["status"]]
+        contents.append((row, content))
+    if not contents:
+        return
+
+    try:
+        with transaction.atomic():
+            created = Content.objects.bulk_create([content for _, content in contents])
+            Space.content.through.objects.bulk_create(
+                [
+                    Space.content.through(space_id=space.pk, content_id=content.pk)
+                    for content in created
+                ]
+            )
+            content_ids = [content.pk for content in created]
+            update_snapshots([space.pk], content_ids)
+            record_changes([space.pk], content_ids)
+    except DatabaseError as exc:
+        result.errors.extend(
+            {"row": row, "errors": {"non_field_errors": [str(exc)]}}
+            for row, _ in contents
+        )
+        return
+    result.created += len(created)
+    # bulk_createではシグナルが送られないため、キャッシュを直接無効化する
+    # 追加したContentで件数とidの合計が変わるため、Spaceのupdated_atは進めない
+    invalidate_spaces([space.pk], touch=False)
+
+
+@pytest.fixture
+def space():
+    Status.objects.create(status="draft")
+    Status.objects.create(status="published")
+    return Space.objects.create(name="Test Space")
+
+
+@pytest.mark.django_db
+def test_ingest_contents(space):
+    rows = [{"title": f"Test Content {i}", "status": "published"} for i in range(5)]
+    result = ingest_contents(space, rows, batch_size=2)
+    assert result.as_dict() == {"created": 5, "errors": []}
+    assert space.content.count() == 5
+    assert set(space.content.values_list("status__status", flat=True)) == {"published"}
+
+
+@pytest.mark.django_db
+def test_ingest_contents_errors(space):
+    structure = Structure.objects.create(name="news", description="")
+    rows = [
+        {"title": "Test Content"},
+        {"title": "Unknown Status", "status": "unknown"},
+        {"status": "draft"},
+        {"title": "Unknown Model", "model": structure.id + 1},
+        {"title": "News", "model": structure.id, "status": "draft"},
+        "broken",
+    ]
+    result = ingest_contents(space, rows, batch_size=4)
+    assert result.created == 2
+    assert sorted(error["row"] for error in result.errors) == [1, 2, 3, 5]
+    assert space.content.filter(model=structure).count() == 1
+
+
+@pytest.mark.django_db
+def test_ingest_contents_custom_fields(space):
+    structure = Structure.objects.create(
+        name="news",
+        description="",
+        schema=[{"key": "price", "type": "number", "required": True}],
+    )
+    rows = [
+        {"title": "Valid", "model": structure.id, "custom_fields": {"price": 10}},
+        {"title": "Missing", "model": structure.id},
+        {"title": "Invalid", "model": structure.id, "custom_fields": {"price": "x"}},
+        {"title": "No Model", "custom_fields": {"price": 10}},
+    ]
+    result = ingest_contents(space, rows)
+    assert result.created == 1
+    assert [error["row"] for error in result.errors] == [1, 2, 3]
+    assert result.errors[0]["errors"] == {"custom_fields": {"price": ["必須です"]}}
+    assert space.content.get().custom_fields == {"price": 10}
+
+
+@pytest.mark.django_db
+def test_ingest_contents_query_count(space, django_assert_num_queries):
+    rows = [{"title": f"Test Content {i}", "status": "draft"} for i in range(10)]
+    status_registry.id("draft")
+    # Contentの作成, 中間テーブルの作成, 変更の記録, SAVEPOINTの作成と解放
+    # (Statusはレジストリから引き、modelの指定がないためStructureは引かない)
+    with django_assert_num_queries(5):
+        ingest_contents(space, rows, batch_size=10)
+
+
+def test_iter_ndjson():
+    lines = [b'{"title": "a"}\n', b"\n", b"broken\n", '{"title": "b"}']
+    assert list(iter_ndjson(lines)) == [{"title": "a"}, "broken", {"title": "b"}]
+
+
+@pytest.mark.django_db
+def test_ingest_contents_scheduled(space):
+    rows = [
+        {"title": "Scheduled", "status": "draft", "scheduled_at": "2030-01-01T00:00Z"},
+        {"title": "Now", "status": "draft"},
+    ]
+    result = ingest_contents(space, rows)
+    assert result.created == 2
+    scheduled = space.content.get(title="Scheduled").scheduled_at
+    assert scheduled.isoformat() == "2030-01-01T00:00:00+00:00"
+    assert space.content.get(title="Now").scheduled_at is None
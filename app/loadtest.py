@@ -0,0 +1,175 @@
+"""
+負荷試験
+python manage.py loadtest でWSGI(gunicorn)とASGI(uvicorn)のサーバーを起動し、
+同期版と非同期版のビューのrps, p99を同時接続数ごとに比較する
+クライアントは標準ライブラリのasyncioでkeep-aliveの接続を張り続ける
+"""
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from app.metrics import Histogram
+
+# 名前: (起動コマンド, 計測するURL名)
+SERVERS = {
+    "wsgi": (
+        ["gunicorn", "core.wsgi:application", "--workers", "{workers}"]
+        + ["--threads", "{threads}", "--bind", "127.0.0.1:{port}"],
+        "space-content-list",
+    ),
+    "asgi": (
+        ["uvicorn", "core.asgi:application", "--workers", "{workers}"]
+        + ["--port", "{port}", "--no-access-log"],
+        "async-space-content-list",
+    ),
+}
+
+
+@dataclass
+class LoadResult:
+    concurrency: int
+    requests: int
+    errors: int
+    duration: float
+    latency: Histogram
+
+    @property
+    def rps(self):
+        return self.requests / self.duration if self.duration else 0.0
+
+    @property
+    def p99(self):
+        return self.latency.quantile(0.99)
+
+
+async def _read_response(reader):
+    """ステータスコードを返し、本文はContent-Lengthの分だけ読み捨てる"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def _worker(url, deadline, latency, counts):
+    parts = urlsplit(url)
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    request = (
+        f"GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+        "Connection: keep-alive\r\n\r\n"
+    ).encode()
+    writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    parts.hostname, parts.port
+                )
+            start = time.perf_counter()
+            writer.write(request)
+            status = await _read_response(reader)
+            latency.record(time.perf_counter() - start)
+            counts["requests"] += 1
+            if status != 200:
+                counts["errors"] += 1
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            counts["errors"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(url, concurrency, duration):
+    """concurrency本の接続でduration秒間GETし続ける"""
+    latency = Histogram()
+    counts = {"requests": 0, "errors": 0}
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(_worker(url, start + duration, latency, counts) for _ in range(concurrency))
+    )
+    return LoadResult(
+        concurrency,
+        counts["requests"],
+        counts["errors"],
+        time.perf_counter() - start,
+        latency,
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"server did not start on port {port}")
+
+
+def start_server(name, workers, threads=1):
+    """
+    SERVERS[name]のサーバーを起動し、(process, port)を返す
+    設定(DJANGO_SETTINGS_MODULE)は現在のプロセスのものを引き継ぐ
+    クライアントは同じIPからヘッダーなしで送るため、レート制限は外す(RATE_LIMIT=0)
+    """
+    command, _ = SERVERS[name]
+    port = free_port()
+    args = [arg.format(workers=workers, threads=threads, port=port) for arg in command]
+    process = subprocess.Popen(
+        [sys.executable, "-m", *args],
+        env={**os.environ, "RATE_LIMIT": "0"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+    except TimeoutError:
+        process.terminate()
+        raise
+    return process, port
+
+
+def test_run_load():
+    async def handle(reader, writer):
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await run_load(f"http://127.0.0.1:{port}/", 4, 0.2)
+
+    result = asyncio.run(run())
+    assert result.requests > 0
+    assert result.errors == 0
+    assert result.latency.count == result.requests
+    assert result.p99 > 0
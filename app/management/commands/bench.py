@@ -0,0 +1,99 @@
+import json
+import platform
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from app.benchmarks import BENCHMARKS, compare_results
+
+
+def _commit():
+    """現在のコミット、gitがなければNone"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "ベンチマークを実行する (データはロールバックされる)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help=", ".join(BENCHMARKS))
+        parser.add_argument("--rows", type=int, help="作成するContentの件数")
+        parser.add_argument("--save", help="計測結果を保存するJSONのパス")
+        parser.add_argument("--compare", help="比べる計測結果のJSONのパス")
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=1.2,
+            help="最短の経過時間がこの倍率を超えたら遅くなったとする",
+        )
+
+    def handle(self, *args, names, rows, save, compare, threshold, **options):
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"unknown benchmark: {', '.join(sorted(unknown))}")
+        baseline = None
+        if compare:
+            with open(compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+
+        results = {}
+        for name in names or BENCHMARKS:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            kwargs = {"rows": rows} if rows else {}
+            result = BENCHMARKS[name](self.stdout, **kwargs)
+            if result is not None:
+                results[name] = result
+
+        if save:
+            with open(save, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "commit": _commit(),
+                        "created_at": timezone.now().isoformat(),
+                        "python": platform.python_version(),
+                        "machine": platform.machine(),
+                        "vendor": connection.vendor,
+                        "rows": rows,
+                        "benchmarks": results,
+                    },
+                    f,
+                    indent=2,
+                )
+        if baseline is not None:
+            self.report(baseline, results, rows, threshold)
+
+    def report(self, baseline, results, rows, threshold):
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"compare with {baseline.get('commit')} (rows={baseline.get('rows')})"
+            )
+        )
+        if baseline.get("vendor") != connection.vendor:
+            self.stderr.write(
+                f"baseline vendor is {baseline.get('vendor')}, now {connection.vendor}"
+            )
+        if baseline.get("rows") != rows:
+            self.stderr.write(f"baseline rows is {baseline.get('rows')}, now {rows}")
+        compared = compare_results(baseline["benchmarks"], results, threshold)
+        self.stdout.write(
+            f"{'case':>32} {'base min ms':>12} {'now min ms':>11} {'ratio':>6}"
+        )
+        for case, base, now, ratio, slower in compared:
+            line = f"{case:>32} {base * 1000:>12.2f} {now * 1000:>11.2f} {ratio:>5.2f}x"
+            self.stdout.write(self.style.ERROR(line) if slower else line)
+        regressions = [case for case, *_, slower in compared if slower]
+        if regressions:
+            raise CommandError(
+                f"{len(regressions)} case(s) slower than {threshold}x: "
+                + ", ".join(regressions)
+            )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Space
+from app.snapshots import diff_snapshot, rebuild_snapshot
+
+
+class Command(BaseCommand):
+    help = "Spaceのスナップショットを現在のシリアライズ結果と比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("space_ids", nargs="*", type=int, help="省略時は全て")
+        parser.add_argument(
+            "--repair", action="store_true", help="差分があれば作り直す"
+        )
+
+    def handle(self, *args, space_ids, repair, **options):
+        spaces = Space.objects.order_by("id")
+        if space_ids:
+            spaces = spaces.filter(id__in=space_ids)
+        inconsistent = 0
+        for space_id in spaces.values_list("id", flat=True).iterator():
+            differences = diff_snapshot(space_id)
+            if not differences:
+                continue
+            inconsistent += 1
+            for difference in differences:
+                self.stderr.write(f"space {space_id}: {difference}")
+            if repair:
+                rebuild_snapshot(space_id)
+        if inconsistent and not repair:
+            raise CommandError(f"{inconsistent} snapshot(s) are inconsistent")
+        self.stdout.write(f"inconsistent={inconsistent}")
@@ -0,0 +1,24 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.changes import COMPACT_BATCH_SIZE, compact_changes
+
+
+class Command(BaseCommand):
+    help = "変更の記録のうち、同じContentのより新しい記録がある古いものを消す"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=float, default=1.0, help="これより新しい記録は残す"
+        )
+        parser.add_argument("--batch-size", type=int, default=COMPACT_BATCH_SIZE)
+
+    def handle(self, *args, days, batch_size, **options):
+        start = time.perf_counter()
+        before = timezone.now() - timedelta(days=days)
+        deleted = compact_changes(before, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"deleted={deleted} elapsed={elapsed:.2f}s")
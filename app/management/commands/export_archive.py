@@ -0,0 +1,27 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.archive import ARCHIVE_CHUNK_SIZE, export_archive
+
+
+class Command(BaseCommand):
+    help = "Space, StructureとそのContentをアーカイブに書き出す (app.archive)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="書き出すパス、-なら標準出力")
+        parser.add_argument("--space", type=int, action="append", default=[])
+        parser.add_argument("--structure", type=int, action="append", default=[])
+        parser.add_argument("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE)
+
+    def handle(self, *args, output, space, structure, chunk_size, **options):
+        if not space and not structure:
+            raise CommandError("--space か --structure を指定してください")
+        if output == "-":
+            result = export_archive(sys.stdout.buffer, space, structure, chunk_size)
+        else:
+            with open(output, "wb") as out:
+                result = export_archive(out, space, structure, chunk_size)
+        # 標準出力はアーカイブに使うため、結果は標準エラー出力に書く
+        for line in result.lines():
+            self.stderr.write(line)
@@ -0,0 +1,30 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.archive import ARCHIVE_CHUNK_SIZE, import_archive
+
+
+class Command(BaseCommand):
+    help = "アーカイブを新しいidで読み込む (1トランザクション、app.archive)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="読み込むパス、-なら標準入力")
+        parser.add_argument("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE)
+
+    def handle(self, *args, input, chunk_size, **options):
+        try:
+            if input == "-":
+                result = import_archive(sys.stdin.buffer, chunk_size)
+            else:
+                with open(input, "rb") as fp:
+                    result = import_archive(fp, chunk_size)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        for line in result.lines():
+            self.stdout.write(line)
+        spaces = ", ".join(
+            f"{old}->{new}" for old, new in result.ids.get("space", {}).items()
+        )
+        if spaces:
+            self.stdout.write(f"spaces {spaces}")
@@ -0,0 +1,51 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.ingest import INGEST_BATCH_SIZE, ingest_contents, iter_ndjson
+from app.models import Space
+
+
+class Command(BaseCommand):
+    help = "JSON配列またはNDJSONからContentを一括登録する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("space_id", type=int)
+        parser.add_argument("path", help="入力ファイル、-なら標準入力")
+        parser.add_argument(
+            "--format",
+            choices=["json", "ndjson"],
+            help="省略時は拡張子が.ndjson/.jsonlならndjson、それ以外はjson",
+        )
+        parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+
+    def handle(self, *args, space_id, path, format, batch_size, **options):
+        try:
+            space = Space.objects.get(pk=space_id)
+        except Space.DoesNotExist:
+            raise CommandError(f"Space {space_id} does not exist")
+        if format is None:
+            format = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "json"
+
+        start = time.perf_counter()
+        if path == "-":
+            result = self.ingest(space, sys.stdin, format, batch_size)
+        else:
+            with open(path, encoding="utf-8") as stream:
+                result = self.ingest(space, stream, format, batch_size)
+        elapsed = time.perf_counter() - start
+
+        for error in result.errors:
+            self.stderr.write(
+                f"row {error['row']}: {json.dumps(error['errors'], ensure_ascii=False)}"
+            )
+        self.stdout.write(
+            f"created={result.created} errors={len(result.errors)}"
+            f" rows/s={result.created / elapsed:,.0f}"
+        )
+
+    def ingest(self, space, stream, format, batch_size):
+        rows = iter_ndjson(stream) if format == "ndjson" else json.load(stream)
+        return ingest_contents(space, rows, batch_size=batch_size)
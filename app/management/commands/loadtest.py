@@ -0,0 +1,66 @@
+import asyncio
+import importlib.util
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from app.benchmarks import seed_space
+from app.loadtest import SERVERS, run_load, start_server
+from app.models import Content
+
+
+class Command(BaseCommand):
+    help = "WSGIとASGIのサーバーを起動し、一覧のrps, p99を比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("servers", nargs="*", help=", ".join(SERVERS))
+        parser.add_argument("--rows", type=int, default=1000)
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[100, 1000])
+        parser.add_argument("--duration", type=float, default=10, help="秒")
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--threads", type=int, default=4, help="WSGIのみ")
+
+    def handle(self, *args, servers, rows, limit, concurrency, duration, **options):
+        servers = servers or list(SERVERS)
+        unknown = set(servers) - set(SERVERS)
+        if unknown:
+            raise CommandError(f"unknown server: {', '.join(sorted(unknown))}")
+        for name in servers:
+            module = SERVERS[name][0][0]
+            if importlib.util.find_spec(module) is None:
+                raise CommandError(f"{module} is not installed")
+
+        # サーバーは別プロセスのため、データはコミットして最後に削除する
+        space = seed_space(rows)
+        try:
+            self.stdout.write(
+                f"rows={rows} limit={limit} duration={duration}s "
+                f"workers={options['workers']}"
+            )
+            self.stdout.write(
+                f"{'server':>6} {'conns':>6} {'requests':>9} {'errors':>7}"
+                f" {'rps':>9} {'p99 ms':>9}"
+            )
+            for name in servers:
+                self.run_server(name, space.id, limit, concurrency, duration, options)
+        finally:
+            Content.objects.filter(spaces=space.id).delete()
+            space.delete()
+
+    def run_server(self, name, space_id, limit, concurrency, duration, options):
+        process, port = start_server(name, options["workers"], options["threads"])
+        try:
+            path = reverse(SERVERS[name][1], args=[space_id])
+            url = f"http://127.0.0.1:{port}{path}?limit={limit}"
+            for connections in concurrency:
+                result = asyncio.run(run_load(url, connections, duration))
+                self.stdout.write(
+                    f"{name:>6} {connections:>6} {result.requests:>9}"
+                    f" {result.errors:>7} {result.rps:>9.1f}"
+                    f" {result.p99 * 1000:>9.2f}"
+                )
+        finally:
+            process.terminate()
+            process.wait()
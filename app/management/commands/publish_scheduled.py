@@ -0,0 +1,36 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.scheduler import PUBLISH_BATCH_SIZE, run_worker
+
+
+class Command(BaseCommand):
+    help = "予約日時を過ぎたContentを公開し続ける (複数同時に起動できる)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=PUBLISH_BATCH_SIZE)
+        parser.add_argument(
+            "--interval", type=float, default=5.0, help="予約がないときに待つ秒数"
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="予約がなくなったら終了する"
+        )
+
+    def handle(self, *args, batch_size, interval, once, **options):
+        stop = threading.Event()
+        # SIGTERM, SIGINTでは処理中のバッチをコミットしてから終了する
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stop.set())
+        try:
+            total = run_worker(
+                batch_size=batch_size,
+                interval=interval,
+                once=once,
+                stop=stop,
+                log=self.stdout.write,
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(f"published={total}")
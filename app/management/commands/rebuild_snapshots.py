@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.snapshots import rebuild_all
+
+
+class Command(BaseCommand):
+    help = "Spaceのスナップショットを並列に作り直す (settings.SPACE_SNAPSHOTS)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("space_ids", nargs="*", type=int, help="省略時は全て")
+        parser.add_argument("--workers", type=int, default=4)
+
+    def handle(self, *args, space_ids, workers, **options):
+        start = time.perf_counter()
+        count = rebuild_all(space_ids or None, workers=workers)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"rebuilt={count} elapsed={elapsed:.2f}s")
@@ -0,0 +1,35 @@
+import time
+from dataclasses import fields
+
+from django.core.management.base import BaseCommand
+
+from app.seed import SeedVolumes, seed_data
+
+
+class Command(BaseCommand):
+    help = "ベンチマーク用のデータを作成する (コミットされる)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scale",
+            type=int,
+            help="Contentの件数、他の件数はこれに合わせる(個別の指定が優先)",
+        )
+        for field in fields(SeedVolumes):
+            parser.add_argument(f"--{field.name}", type=int)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, scale, seed, batch_size, **options):
+        volumes = SeedVolumes.scaled(scale) if scale else SeedVolumes()
+        for field in fields(SeedVolumes):
+            if options[field.name] is not None:
+                setattr(volumes, field.name, options[field.name])
+
+        start = time.perf_counter()
+        counts = seed_data(volumes, seed=seed, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            " ".join(f"{name}={count}" for name, count in counts.items())
+            + f" seconds={elapsed:.1f}"
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from app.models import Structure
+from app.structures import sync_custom_field_indexes
+
+
+class Command(BaseCommand):
+    help = "Structure.schemaのindexedなフィールドの式インデックスを作成・削除する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("structure_ids", nargs="*", type=int, help="省略時は全て")
+
+    def handle(self, *args, structure_ids, **options):
+        structures = Structure.objects.order_by("id")
+        if structure_ids:
+            structures = structures.filter(id__in=structure_ids)
+        for structure in structures:
+            for sql in sync_custom_field_indexes(structure):
+                self.stdout.write(sql)
@@ -0,0 +1,324 @@
+"""
+リクエストごとの計測
+QueryMetricsMiddlewareがURL名ごとにクエリ数, DB時間, シリアライズ時間, 全体の時間を
+プロセス内のヒストグラムに記録し、/metricsでPrometheusのテキスト形式で返す
+同じSQLが1リクエスト内で繰り返された場合はN+1として警告を出す
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import pytest
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.urls import reverse
+
+from app.cache import get_space_cache
+from app.models import Status
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    HDR形式のヒストグラム
+    2のべき乗ごとの範囲をsub_buckets個に分け、相対誤差を1/sub_buckets以下に抑える
+    件数は使われたバケットだけを持つ
+    """
+
+    def __init__(self, sub_buckets=16):
+        self.sub_buckets = sub_buckets
+        self.buckets = Counter()
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    ZERO = (-math.inf, 0)
+
+    def _bucket(self, value):
+        if value <= 0:
+            return self.ZERO
+        mantissa, exponent = math.frexp(value)
+        return (exponent, int((mantissa - 0.5) * 2 * self.sub_buckets))
+
+    def _upper_bound(self, bucket):
+        if bucket == self.ZERO:
+            return 0.0
+        exponent, sub = bucket
+        return math.ldexp(0.5 + (sub + 1) / (2 * self.sub_buckets), exponent)
+
+    def record(self, value):
+        bucket = self._bucket(value)
+        with self._lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """q(0〜1)分位の値をバケットの上限で返す"""
+        with self._lock:
+            buckets = sorted(self.buckets.items())
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= rank:
+                return self._upper_bound(bucket)
+        return self._upper_bound(buckets[-1][0])
+
+
+class MetricsRegistry:
+    """URL名ごとのヒストグラムとN+1の検出件数"""
+
+    QUANTILES = (0.5, 0.9, 0.99)
+    METRICS = {
+        "duration": ("app_request_duration_seconds", "リクエスト全体の時間"),
+        "db_queries": ("app_request_db_queries", "リクエストごとのクエリ数"),
+        "db_duration": ("app_request_db_duration_seconds", "リクエストごとのDB時間"),
+        "serializer_duration": (
+            "app_request_serializer_duration_seconds",
+            "リクエストごとのシリアライズ時間",
+        ),
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self.n_plus_one = Counter()
+        self._lock = threading.Lock()
+
+    def histogram(self, metric, view):
+        key = (metric, view)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, view, recorder, duration):
+        self.histogram("duration", view).record(duration)
+        self.histogram("db_queries", view).record(recorder.queries)
+        self.histogram("db_duration", view).record(recorder.db_time)
+        self.histogram("serializer_duration", view).record(recorder.serializer_time)
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.n_plus_one.clear()
+
+    def render(self):
+        """Prometheusのテキスト形式(summary)で返す"""
+        lines = []
+        for metric, (name, help_text) in self.METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} summary")
+            for (key, view), histogram in sorted(self.histograms.items()):
+                if key != metric:
+                    continue
+                label = f'view="{view}"'
+                for q in self.QUANTILES:
+                    lines.append(
+                        f'{name}{{{label},quantile="{q}"}} {histogram.quantile(q):.6g}'
+                    )
+                lines.append(f"{name}_sum{{{label}}} {histogram.sum:.6g}")
+                lines.append(f"{name}_count{{{label}}} {histogram.count}")
+
+        lines.append("# HELP app_n_plus_one_total 同じSQLの繰り返しを検出した件数")
+        lines.append("# TYPE app_n_plus_one_total counter")
+        for view, count in sorted(self.n_plus_one.items()):
+            lines.append(f'app_n_plus_one_total{{view="{view}"}} {count}')
+
+        stats = get_space_cache().stats()
+        lines.append("# HELP app_space_cache_total Spaceキャッシュの参照結果")
+        lines.append("# TYPE app_space_cache_total counter")
+        lines.append(f'app_space_cache_total{{result="hit"}} {stats["hits"]}')
+        lines.append(f'app_space_cache_total{{result="miss"}} {stats["misses"]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+
+class RequestRecorder:
+    """
+    1リクエストのクエリ数, DB時間, シリアライズ時間を集める
+    connection.execute_wrapperとして使う
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.templates = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            # パラメータはプレースホルダのままなので、SQLがそのままテンプレートになる
+            self.templates[sql] += 1
+
+    def repeated_templates(self, threshold):
+        return [(sql, n) for sql, n in self.templates.items() if n >= threshold]
+
+
+_recorder = ContextVar("recorder", default=None)
+
+
+def _dispatch(execute, sql, params, many, context):
+    """現在のコンテキストのRequestRecorderに渡す"""
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_recorder(connection, **kwargs):
+    # DB接続はスレッドごとのため、非同期のクエリを実行するスレッドの接続にも入れておく
+    # RequestRecorderはContextVarで渡るので、sync_to_asyncのスレッドでも記録される
+    if _dispatch not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_dispatch)
+
+
+@contextmanager
+def record_queries():
+    """全てのDB接続のクエリをRequestRecorderに集める"""
+    for alias in connections:
+        install_recorder(connections[alias])
+    recorder = RequestRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+@contextmanager
+def serializer_timer():
+    """ブロック内の時間を現在のリクエストのシリアライズ時間に加える"""
+    recorder = _recorder.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if recorder is not None:
+            recorder.serializer_time += time.perf_counter() - start
+
+
+class QueryMetricsMiddleware:
+    """
+    MIDDLEWAREの先頭に置き、URL名ごとに記録する
+    ストリーミングレスポンスはビューが返るまでの時間を記録する
+    同期・非同期のどちらでも動き、ASGIでは非同期ビューをスレッドに移さずに呼ぶ
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, "METRICS_N_PLUS_ONE_THRESHOLD", 5)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        self.observe(request, recorder, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with record_queries() as recorder:
+            response = await self.get_response(request)
+        self.observe(request, recorder, time.perf_counter() - start)
+        return response
+
+    def observe(self, request, recorder, duration):
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        metrics_registry.observe(view, recorder, duration)
+
+        repeated = recorder.repeated_templates(self.threshold)
+        if repeated:
+            metrics_registry.n_plus_one[view] += 1
+            for sql, count in repeated:
+                logger.warning("N+1 on %s: %d x %s", view, count, sql)
+
+
+def metrics(request):
+    return HttpResponse(
+        metrics_registry.render(), content_type="text/plain; version=0.0.4"
+    )
+
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value / 1000)
+    assert histogram.count == 1000
+    assert histogram.sum == pytest.approx(500.5)
+    # 相対誤差は1/16以下
+    assert histogram.quantile(0.5) == pytest.approx(0.5, rel=1 / 16)
+    assert histogram.quantile(0.99) == pytest.approx(0.99, rel=1 / 16)
+    assert histogram.quantile(1.0) >= 1.0
+    histogram.record(0)
+    assert Histogram().quantile(0.5) == 0.0
+
+
+@pytest.mark.django_db
+def test_record_queries():
+    with record_queries() as recorder:
+        for _ in range(3):
+            list(Status.objects.filter(status="draft"))
+        with serializer_timer():
+            time.sleep(0.001)
+    assert recorder.queries == 3
+    assert recorder.db_time > 0
+    assert recorder.serializer_time >= 0.001
+    assert len(recorder.repeated_templates(3)) == 1
+    assert recorder.repeated_templates(4) == []
+
+
+def _repeated_queries_view(request):
+    for _ in range(5):
+        Status.objects.count()
+    return HttpResponse()
+
+
+@pytest.mark.django_db
+def test_query_metrics_middleware(client, caplog, rf):
+    metrics_registry.clear()
+    response = client.get(reverse("space-content-list", args=[1]))
+    assert response.status_code == 404
+
+    with caplog.at_level(logging.WARNING, logger=__name__):
+        QueryMetricsMiddleware(_repeated_queries_view)(rf.get("/"))
+    assert "N+1 on unresolved: 5 x" in caplog.text
+
+    body = client.get(reverse("metrics")).content.decode()
+    assert 'app_request_db_queries_count{view="space-content-list"} 1' in body
+    assert (
+        'app_request_duration_seconds{view="space-content-list",quantile="0.99"}'
+        in body
+    )
+    assert 'app_n_plus_one_total{view="unresolved"} 1' in body
+    assert 'app_space_cache_total{result="miss"}' in body
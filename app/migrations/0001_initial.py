@@ -0,0 +1,150 @@
+# Generated by Django 6.1.2 on 2026-10-18 19:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="Content",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("title", models.CharField(max_length=100)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("published_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Plan",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        choices=[
+                            ("free", "Free"),
+                            ("standard", "Standard"),
+                            ("premium", "Premium"),
+                        ],
+                        max_length=100,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Status",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("status", models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Structure",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("name", models.CharField(max_length=100)),
+                ("description", models.TextField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Associate",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("name", models.CharField(max_length=100)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "content",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="associates",
+                        to="app.content",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Space",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("name", models.CharField(max_length=100)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "associate",
+                    models.ManyToManyField(
+                        blank=True, null=True, related_name="spaces", to="app.associate"
+                    ),
+                ),
+                (
+                    "content",
+                    models.ManyToManyField(
+                        blank=True, null=True, related_name="spaces", to="app.content"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="content",
+            name="status",
+            field=models.ForeignKey(
+                default=1,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="contents",
+                to="app.status",
+            ),
+        ),
+        migrations.AddField(
+            model_name="content",
+            name="model",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="contents",
+                to="app.structure",
+            ),
+        ),
+        migrations.CreateModel(
+            name="User",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("name", models.CharField(max_length=100)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "plan",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="users",
+                        to="app.plan",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="associate",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="associates",
+                to="app.user",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.1.2 on 2026-10-18 19:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(
+                fields=["published_at", "id"], name="content_published_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,71 @@
+from django.db import migrations
+
+from app.operations import RunPostgreSQL
+
+# app_content.search_vectorはモデルに定義せず、トリガーで維持する
+# title(重みA)とStructureのname, description(重みB)から作る
+CONTENT_SEARCH_VECTOR = """
+    setweight(to_tsvector('simple', coalesce({content}.title, '')), 'A')
+    || setweight(to_tsvector('simple', coalesce((
+        SELECT s.name || ' ' || s.description
+        FROM app_structure s WHERE s.id = {content}.model_id
+    ), '')), 'B')
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0002_content_published_id_idx"),
+    ]
+
+    operations = [
+        RunPostgreSQL(
+            sql=[
+                "ALTER TABLE app_content ADD COLUMN search_vector tsvector",
+                f"""
+                CREATE FUNCTION app_content_search_vector() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := {CONTENT_SEARCH_VECTOR.format(content="NEW")};
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE TRIGGER app_content_search_vector
+                BEFORE INSERT OR UPDATE OF title, model_id ON app_content
+                FOR EACH ROW EXECUTE FUNCTION app_content_search_vector()
+                """,
+                f"""
+                CREATE FUNCTION app_structure_search_vector() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE app_content c
+                    SET search_vector = {CONTENT_SEARCH_VECTOR.format(content="c")}
+                    WHERE c.model_id = NEW.id;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE TRIGGER app_structure_search_vector
+                AFTER UPDATE OF name, description ON app_structure
+                FOR EACH ROW EXECUTE FUNCTION app_structure_search_vector()
+                """,
+                f"""
+                UPDATE app_content
+                SET search_vector = {CONTENT_SEARCH_VECTOR.format(content="app_content")}
+                """,
+                """
+                CREATE INDEX content_search_vector_idx
+                ON app_content USING gin (search_vector)
+                """,
+            ],
+            reverse_sql=[
+                "DROP TRIGGER app_structure_search_vector ON app_structure",
+                "DROP FUNCTION app_structure_search_vector()",
+                "DROP TRIGGER app_content_search_vector ON app_content",
+                "DROP FUNCTION app_content_search_vector()",
+                "ALTER TABLE app_content DROP COLUMN search_vector",
+            ],
+        ),
+    ]
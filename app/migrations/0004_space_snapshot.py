@@ -0,0 +1,31 @@
+# Generated by Django 6.1.2 on 2026-10-18 20:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0003_content_search_vector"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpaceSnapshot",
+            fields=[
+                (
+                    "space",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="snapshot",
+                        serialize=False,
+                        to="app.space",
+                    ),
+                ),
+                ("content", models.JSONField(default=list)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 6.1.2 on 2026-10-18 20:04
+
+from django.db import migrations, models
+
+from app.operations import RunPostgreSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0004_space_snapshot"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="content",
+            name="custom_fields",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name="structure",
+            name="schema",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        # custom_fields @> {...} (app.structures.filter_custom_fields)用
+        # 並べ替えに使うフィールドの式インデックスはsync_custom_field_indexesで作る
+        RunPostgreSQL(
+            sql="""
+            CREATE INDEX content_custom_fields_idx
+            ON app_content USING GIN (custom_fields jsonb_path_ops)
+            """,
+            reverse_sql="DROP INDEX content_custom_fields_idx",
+        ),
+    ]
@@ -0,0 +1,121 @@
+# Generated by Django 6.1.2 on 2026-10-18 20:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def _merge_duplicates(apps, model_name, field, referrer_name, referrer_field):
+    """
+    fieldが同じ行を最小のidの行にまとめ、参照元を付け替えてから残りを消す
+    一意制約の追加前に既存の重複を解消する
+    """
+    model = apps.get_model("app", model_name)
+    referrer = apps.get_model("app", referrer_name)
+    duplicates = (
+        model.objects.values(field)
+        .annotate(count=Count("id"), keep=Min("id"))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        others = model.objects.filter(**{field: row[field]}).exclude(id=row["keep"])
+        referrer.objects.filter(**{f"{referrer_field}__in": others}).update(
+            **{referrer_field: row["keep"]}
+        )
+        others.delete()
+
+
+def merge_duplicate_names(apps, schema_editor):
+    _merge_duplicates(apps, "Plan", "name", "User", "plan")
+    _merge_duplicates(apps, "Status", "status", "Content", "status")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0005_custom_fields"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="content",
+            name="model",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="contents",
+                to="app.structure",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="content",
+            name="status",
+            field=models.ForeignKey(
+                db_index=False,
+                default=1,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="contents",
+                to="app.status",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="user",
+            name="plan",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="users",
+                to="app.plan",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(
+                fields=["status", "published_at", "id"],
+                name="content_status_published_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(
+                condition=models.Q(("model__isnull", False)),
+                fields=["model", "published_at", "id"],
+                name="content_model_published_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="user",
+            index=models.Index(
+                fields=["plan", "created_at"], name="user_plan_created_idx"
+            ),
+        ),
+        # 重複があると一意制約を追加できないため、先に最小のidの行にまとめる
+        migrations.RunPython(merge_duplicate_names, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="plan",
+            constraint=models.UniqueConstraint(
+                fields=("name",), name="plan_name_unique"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="status",
+            constraint=models.UniqueConstraint(
+                fields=("status",), name="status_status_unique"
+            ),
+        ),
+        # 自動で作られる中間テーブルにはMeta.indexesを書けないためSQLで作る
+        # 逆向きの参照(Associate, ContentからSpace)をインデックスのみで返す
+        migrations.RunSQL(
+            sql=[
+                "CREATE INDEX space_associate_reverse_idx"
+                " ON app_space_associate (associate_id, space_id)",
+                "CREATE INDEX space_content_reverse_idx"
+                " ON app_space_content (content_id, space_id)",
+            ],
+            reverse_sql=[
+                "DROP INDEX space_associate_reverse_idx",
+                "DROP INDEX space_content_reverse_idx",
+            ],
+        ),
+    ]
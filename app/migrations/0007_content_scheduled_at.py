@@ -0,0 +1,32 @@
+# Generated by Django 6.1.2 on 2026-10-18 20:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0006_indexes_and_constraints"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="content",
+            name="scheduled_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="content",
+            name="published_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(
+                condition=models.Q(("scheduled_at__isnull", False)),
+                fields=["scheduled_at", "id"],
+                name="content_scheduled_idx",
+            ),
+        ),
+    ]
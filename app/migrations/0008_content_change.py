@@ -0,0 +1,69 @@
+# Generated by Django 6.1.2 on 2026-10-18 20:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0007_content_scheduled_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ContentChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("content_id", models.IntegerField()),
+                (
+                    "action",
+                    models.CharField(
+                        choices=[
+                            ("upsert", "Upsert"),
+                            ("delete", "Delete"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "space",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="changes",
+                        to="app.space",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["space", "id"], name="contentchange_space_id_idx"
+                    ),
+                    models.Index(
+                        fields=["space", "content_id", "id"],
+                        name="contentchange_content_idx",
+                    ),
+                ],
+            },
+        ),
+        # 既存のSpaceの所属をupsertとして記録し、since=0から全件を再現できるようにする
+        migrations.RunSQL(
+            """
+            INSERT INTO app_contentchange (space_id, content_id, action, created_at)
+            SELECT space_id, content_id, 'upsert', CURRENT_TIMESTAMP
+            FROM app_space_content ORDER BY space_id, content_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+from app.operations import RunPostgreSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0008_content_change"),
+    ]
+
+    operations = [
+        # text::timestamptzはTimeZone, DateStyleに依存するためSTABLEで、
+        # 式インデックスに使えない
+        # custom_fieldsのdatetimeはタイムゾーン付きのISO 8601に検証済み
+        # (app.structures)で、設定によらず同じ値になるのでIMMUTABLEとして包む
+        RunPostgreSQL(
+            sql="""
+            CREATE FUNCTION app_custom_field_timestamptz(text) RETURNS timestamptz
+            AS $$ SELECT $1::timestamptz $$
+            LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+            """,
+            reverse_sql="DROP FUNCTION app_custom_field_timestamptz(text)",
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+from app.operations import RunPostgreSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0009_custom_field_timestamptz"),
+    ]
+
+    operations = [
+        # 記録したトランザクションのid、変更の取得(app.changes)をコミット順で読むために使う
+        # モデルには定義せず、INSERTで省略してデフォルトで埋める
+        RunPostgreSQL(
+            sql=[
+                "ALTER TABLE app_contentchange ADD COLUMN xact_id bigint NOT NULL"
+                " DEFAULT pg_current_xact_id()::text::bigint",
+                "CREATE INDEX contentchange_space_xact_idx"
+                " ON app_contentchange (space_id, xact_id, id)",
+            ],
+            reverse_sql=[
+                "DROP INDEX contentchange_space_xact_idx",
+                "ALTER TABLE app_contentchange DROP COLUMN xact_id",
+            ],
+        ),
+    ]
@@ -1,5 +1,6 @@
 import pytest
 from django.db import models
+from django.utils import timezone
 
 
 class Structure(models.Model):
@@ -8,9 +9,22 @@ class Structure(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=100)
     description = models.TextField()
+    # カスタムフィールドの定義のリスト (app.structures)
+    schema = models.JSONField(default=list, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def clean(self):
+        # app.structuresはこのモジュールをimportするため、ここで読み込む
+        from app.structures import validate_schema
+
+        validate_schema(self.schema)
+
+    def save(self, *args, **kwargs):
+        # 不正なschemaは読み取り時の500ではなく保存時に拒否する
+        self.clean()
+        super().save(*args, **kwargs)
+
 
 @pytest.fixture
 def structure():
@@ -36,19 +50,88 @@ class Status(models.Model):
     id = models.AutoField(primary_key=True)
     status = models.CharField(max_length=100)
 
+    class Meta:
+        constraints = [
+            # 名前からidを引くため(app.registry)一意にする
+            models.UniqueConstraint(fields=["status"], name="status_status_unique"),
+        ]
+
+
+class ContentQuerySet(models.QuerySet):
+    def visible_to(self, user, space_ids=None):
+        """
+        user(Userかid)がAssociateを通じて属するSpaceのContent
+        中間テーブルへの準結合(id IN サブクエリ) 1つで絞り込み、行ごとの確認や重複は生じない
+        相関したEXISTSはSQLiteでは全件を走査して行ごとに評価されるため、INで書く
+        (PostgreSQLではどちらも同じ準結合になる)
+        space_ids: userのSpaceのid(app.access)、省略時はサブクエリで求める
+        """
+        if space_ids is None:
+            space_ids = Space.associate.through.objects.filter(
+                associate__user=user
+            ).values("space_id")
+        elif not space_ids:
+            return self.none()
+        return self.filter(
+            pk__in=Space.content.through.objects.filter(space_id__in=space_ids).values(
+                "content_id"
+            )
+        )
+
 
 class Content(models.Model):
     id = models.AutoField(primary_key=True)
+    # 単独のインデックスは作らず、Meta.indexesの複合インデックスの先頭の列で引く
     model = models.ForeignKey(
-        Structure, related_name="contents", on_delete=models.CASCADE, null=True
+        Structure,
+        related_name="contents",
+        on_delete=models.CASCADE,
+        null=True,
+        db_index=False,
     )
     title = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    published_at = models.DateTimeField(auto_now=True)
+    # 公開日時、保存では更新しない。予約公開ではscheduled_atの値になる (app.scheduler)
+    published_at = models.DateTimeField(default=timezone.now)
+    # 予約公開の日時、公開後はNone
+    scheduled_at = models.DateTimeField(null=True, blank=True)
     status = models.ForeignKey(
-        Status, related_name="contents", on_delete=models.CASCADE, default=1
+        Status,
+        related_name="contents",
+        on_delete=models.CASCADE,
+        default=1,
+        db_index=False,
     )
+    # modelのschemaで定義したカスタムフィールドの値 (app.structures)
+    custom_fields = models.JSONField(default=dict, blank=True)
+
+    objects = ContentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 一覧のキーセットページング(published_at, id)用
+            models.Index(
+                fields=["published_at", "id"], name="content_published_id_idx"
+            ),
+            # Statusでの絞り込み(公開中の一覧など)を一覧と同じ順で返す
+            models.Index(
+                fields=["status", "published_at", "id"],
+                name="content_status_published_idx",
+            ),
+            # Structureでの絞り込み(app.structures)、Structureのない行は含めない
+            models.Index(
+                fields=["model", "published_at", "id"],
+                name="content_model_published_idx",
+                condition=models.Q(model__isnull=False),
+            ),
+            # 公開日時になった予約を探す(app.scheduler)、予約のない行は含めない
+            models.Index(
+                fields=["scheduled_at", "id"],
+                name="content_scheduled_idx",
+                condition=models.Q(scheduled_at__isnull=False),
+            ),
+        ]
 
 
 @pytest.fixture
@@ -115,6 +198,11 @@ class Plan(models.Model):
 
     name = models.CharField(max_length=100, choices=PLAN_OPTIONS)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["name"], name="plan_name_unique"),
+        ]
+
 
 class User(models.Model):
     """
@@ -125,7 +213,15 @@ class User(models.Model):
     name = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    plan = models.ForeignKey(Plan, related_name="users", on_delete=models.CASCADE)
+    plan = models.ForeignKey(
+        Plan, related_name="users", on_delete=models.CASCADE, db_index=False
+    )
+
+    class Meta:
+        indexes = [
+            # プランごとのUserを作成順に返す
+            models.Index(fields=["plan", "created_at"], name="user_plan_created_idx"),
+        ]
 
 
 class Associate(models.Model):
@@ -160,3 +256,47 @@ class Space(models.Model):
     content = models.ManyToManyField(
         Content, related_name="spaces", blank=True, null=True
     )
+
+
+class SpaceSnapshot(models.Model):
+    """
+    Spaceの読み取り結果をあらかじめシリアライズして保持する(app.snapshots)
+    content: Contentごとの出力をキーの順に並べた配列の、idの昇順の配列
+    """
+
+    space = models.OneToOneField(
+        Space, primary_key=True, related_name="snapshot", on_delete=models.CASCADE
+    )
+    content = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ContentChange(models.Model):
+    """
+    SpaceごとのContentの変更の追記専用のログ (app.changes)
+    id: 単調増加の番号、変更の取得のsince=に渡す
+    content_id: 削除後も墓標を残すため外部キーにしない
+    action: upsert(作成・更新・Spaceへの追加), delete(削除・Spaceからの除外)
+    """
+
+    UPSERT = "upsert"
+    DELETE = "delete"
+    ACTIONS = [(UPSERT, "Upsert"), (DELETE, "Delete")]
+
+    space = models.ForeignKey(
+        Space, related_name="changes", on_delete=models.CASCADE, db_index=False
+    )
+    content_id = models.IntegerField()
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Spaceのsince=以降の変更を番号順に読む
+            models.Index(fields=["space", "id"], name="contentchange_space_id_idx"),
+            # 圧縮で同じContentのより新しい変更を探す
+            models.Index(
+                fields=["space", "content_id", "id"],
+                name="contentchange_content_idx",
+            ),
+        ]
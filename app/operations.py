@@ -0,0 +1,21 @@
+"""
+マイグレーション用の操作
+"""
+
+from django.db import migrations
+
+
+class RunPostgreSQL(migrations.RunSQL):
+    """
+    PostgreSQLの場合だけ実行するRunSQL
+    tsvector, GINインデックス, トリガーなどPostgreSQL固有の定義に使い、
+    SQLite(テスト)ではスキップする
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
@@ -0,0 +1,176 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import NamedTuple
+
+import pytest
+from django.db.models import Q
+from django.utils import timezone
+
+from app.models import Content, Status
+
+# Contentの一覧は(published_at, id)の降順で返す
+# app.models.Contentの複合インデックスと対応している
+CONTENT_ORDERING = ("-published_at", "-id")
+
+
+class Cursor(NamedTuple):
+    """
+    キーセットページングの位置
+    published_at, id: 基準となる行
+    reverse: Trueなら基準行より前(previous)を取得する
+    """
+
+    published_at: datetime
+    id: int
+    reverse: bool = False
+
+    def encode(self):
+        payload = json.dumps(
+            [self.published_at.isoformat(), self.id, int(self.reverse)],
+            separators=(",", ":"),
+        )
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, value):
+        """不正なカーソルはValueErrorを送出する"""
+        try:
+            padded = value + "=" * (-len(value) % 4)
+            published_at, pk, reverse = json.loads(base64.urlsafe_b64decode(padded))
+            return cls(datetime.fromisoformat(published_at), int(pk), bool(reverse))
+        except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as exc:
+            raise ValueError("invalid cursor") from exc
+
+
+def _cursor_for(row, reverse=False):
+    return Cursor(row.published_at, row.id, reverse).encode()
+
+
+def offset_page(queryset, offset, limit, total):
+    """
+    offset/limitでページを取得する
+    次ページ以降はキーセットに切り替えられるようにカーソルも返す
+    @return (rows, next, previous)
+    """
+    rows = list(offset_queryset(queryset, offset, limit))
+    return offset_result(rows, offset, limit, total)
+
+
+def offset_queryset(queryset, offset, limit):
+    return queryset.order_by(*CONTENT_ORDERING)[offset : offset + limit]
+
+
+def offset_result(rows, offset, limit, total):
+    next_cursor = _cursor_for(rows[-1]) if rows and offset + limit < total else None
+    previous_cursor = _cursor_for(rows[0], reverse=True) if rows and offset else None
+    return rows, next_cursor, previous_cursor
+
+
+def keyset_page(queryset, cursor, limit):
+    """
+    cursorの位置からlimit件を取得する
+    OFFSETを使わないため、深いページでも取得コストが一定になる
+    @return (rows, next, previous)
+    """
+    rows = list(keyset_queryset(queryset, cursor, limit))
+    return keyset_result(rows, cursor, limit)
+
+
+def keyset_queryset(queryset, cursor, limit):
+    """次ページの有無を判定するためlimit+1件を取得するクエリセットを返す"""
+    if cursor.reverse:
+        # published_at >= p AND (published_at > p OR id > i)
+        # 先頭の条件をインデックスの範囲条件として使わせる
+        queryset = queryset.filter(
+            Q(published_at__gte=cursor.published_at)
+            & (Q(published_at__gt=cursor.published_at) | Q(id__gt=cursor.id))
+        ).order_by("published_at", "id")
+    else:
+        queryset = queryset.filter(
+            Q(published_at__lte=cursor.published_at)
+            & (Q(published_at__lt=cursor.published_at) | Q(id__lt=cursor.id))
+        ).order_by(*CONTENT_ORDERING)
+    return queryset[: limit + 1]
+
+
+def keyset_result(rows, cursor, limit):
+    """keyset_querysetの結果からページとカーソルを作る"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if cursor.reverse:
+        rows.reverse()
+        next_cursor = (
+            _cursor_for(rows[-1]) if rows else cursor._replace(reverse=False).encode()
+        )
+        previous_cursor = _cursor_for(rows[0], reverse=True) if has_more else None
+    else:
+        next_cursor = _cursor_for(rows[-1]) if has_more else None
+        previous_cursor = (
+            _cursor_for(rows[0], reverse=True)
+            if rows
+            else cursor._replace(reverse=True).encode()
+        )
+    return rows, next_cursor, previous_cursor
+
+
+def test_cursor_roundtrip():
+    cursor = Cursor(timezone.now(), 42, reverse=True)
+    assert Cursor.decode(cursor.encode()) == cursor
+
+
+@pytest.mark.parametrize("value", ["", "not-a-cursor", "W10", "WzEsMl0"])
+def test_cursor_decode_invalid(value):
+    with pytest.raises(ValueError):
+        Cursor.decode(value)
+
+
+@pytest.fixture
+def contents():
+    status = Status.objects.create(status="draft")
+    rows = Content.objects.bulk_create(
+        [Content(title=f"Test Content {i}", status=status) for i in range(7)]
+    )
+    # 同時刻の行を作り、published_atが同じ場合にidで並ぶことを確認する
+    Content.objects.filter(id__in=[row.id for row in rows[:3]]).update(
+        published_at=timezone.now()
+    )
+    return list(Content.objects.order_by(*CONTENT_ORDERING))
+
+
+@pytest.mark.django_db
+def test_keyset_page_traversal(contents):
+    queryset = Content.objects.all()
+    rows, next_cursor, previous_cursor = offset_page(queryset, 0, 3, len(contents))
+    pages = [rows]
+    while next_cursor is not None:
+        rows, next_cursor, previous_cursor = keyset_page(
+            queryset, Cursor.decode(next_cursor), 3
+        )
+        pages.append(rows)
+    assert pages == [contents[:3], contents[3:6], contents[6:]]
+
+    # 最終ページから先頭へ戻る
+    rows, next_cursor, previous_cursor = keyset_page(
+        queryset, Cursor.decode(previous_cursor), 3
+    )
+    assert rows == contents[3:6]
+    rows, next_cursor, previous_cursor = keyset_page(
+        queryset, Cursor.decode(previous_cursor), 3
+    )
+    assert rows == contents[:3]
+    assert previous_cursor is None
+    assert keyset_page(queryset, Cursor.decode(next_cursor), 3)[0] == contents[3:6]
+
+
+@pytest.mark.django_db
+def test_offset_page_cursors(contents):
+    rows, next_cursor, previous_cursor = offset_page(
+        Content.objects.all(), 3, 3, len(contents)
+    )
+    assert rows == contents[3:6]
+    assert Cursor.decode(next_cursor) == Cursor(rows[-1].published_at, rows[-1].id)
+    assert Cursor.decode(previous_cursor) == Cursor(
+        rows[0].published_at, rows[0].id, reverse=True
+    )
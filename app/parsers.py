@@ -0,0 +1,15 @@
+from rest_framework.parsers import BaseParser
+
+from app.ingest import iter_ndjson
+
+
+class NDJSONParser(BaseParser):
+    """
+    application/x-ndjson
+    本文を一度に読み込まず、1行ずつ解析するイテレータを返す
+    """
+
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return iter_ndjson(stream)
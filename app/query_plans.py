@@ -0,0 +1,201 @@
+"""
+主なクエリの実行計画の回帰テスト
+データを投入してANALYZEした後、EXPLAINで大きいテーブルの全件走査がないことを確認する
+
+PostgreSQL: EXPLAIN (FORMAT JSON) の Seq Scan
+SQLite: EXPLAIN QUERY PLAN の SCAN <table> (インデックス順の走査も全件を読むため含める)
+"""
+
+import json
+import re
+
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from app.changes import changes_queryset
+from app.conditional import _validator_queryset
+from app.models import (
+    Associate,
+    Content,
+    ContentChange,
+    Plan,
+    Space,
+    Status,
+    Structure,
+    User,
+)
+from app.pagination import CONTENT_ORDERING, Cursor, keyset_queryset
+from app.references import referencing_contents
+from app.scheduler import due_contents
+
+# 全件走査を許さないテーブル
+LARGE_TABLES = {
+    Content._meta.db_table,
+    Space._meta.db_table,
+    Space.content.through._meta.db_table,
+    Space.associate.through._meta.db_table,
+    Associate._meta.db_table,
+    User._meta.db_table,
+    ContentChange._meta.db_table,
+}
+
+
+def _postgresql_scans(plan):
+    """EXPLAIN (FORMAT JSON) のノードを辿り、Seq Scanのテーブルを返す"""
+    scans = []
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if node["Node Type"] == "Seq Scan":
+            scans.append(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return scans
+
+
+# 絞り込みにインデックスを使う場合はSEARCHになる
+_SQLITE_SCAN = re.compile(r"\bSCAN (\w+)")
+# サブクエリなどの別名 "app_content" "U0"、SQLiteの計画には別名で出る
+_SQL_ALIAS = re.compile(r'"(\w+)" "(\w+)"')
+
+
+def _sqlite_scans(queryset):
+    """EXPLAIN QUERY PLANのSCANのテーブル、別名はSQLから元のテーブルに戻す"""
+    sql = str(queryset.query)
+    aliases = {alias: table for table, alias in _SQL_ALIAS.findall(sql)}
+    return [
+        aliases.get(match[1], match[1])
+        for line in queryset.explain().splitlines()
+        if (match := _SQLITE_SCAN.search(line))
+    ]
+
+
+def sequential_scans(queryset):
+    """querysetの実行計画で全件走査しているLARGE_TABLESのテーブルのリスト"""
+    if connection.vendor == "postgresql":
+        scans = _postgresql_scans(json.loads(queryset.explain(format="json")))
+    else:
+        scans = _sqlite_scans(queryset)
+    return sorted(set(scans) & LARGE_TABLES)
+
+
+class TestQueryPlans(TestCase):
+    """
+    Spaceの読み取り、一覧、シグナルなど主な経路のクエリを確認する
+    行数はPostgreSQLのプランナーがインデックスを選ぶ程度にする
+    """
+
+    CONTENTS = 20_000
+    SPACES = 200
+    USERS = 2_000
+
+    @classmethod
+    def setUpTestData(cls):
+        statuses = Status.objects.bulk_create(
+            [Status(status=name) for name in ("draft", "review", "published")]
+        )
+        cls.published = statuses[2]
+        cls.structure = Structure.objects.create(
+            name="news",
+            description="",
+            schema=[{"key": "related", "type": "reference"}],
+        )
+        contents = Content.objects.bulk_create(
+            [
+                Content(
+                    title=f"Content {i}",
+                    status=statuses[i % 3],
+                    # Structureを持つContentは一部のみ
+                    model=cls.structure if i % 10 == 0 else None,
+                    custom_fields={"related": i - 10} if i % 10 == 0 else {},
+                )
+                for i in range(cls.CONTENTS)
+            ],
+            batch_size=5000,
+        )
+        plans = Plan.objects.bulk_create(
+            [Plan(name=name) for name, _ in Plan.PLAN_OPTIONS]
+        )
+        users = User.objects.bulk_create(
+            [
+                User(name=f"User {i}", plan=plans[i % len(plans)])
+                for i in range(cls.USERS)
+            ]
+        )
+        associates = Associate.objects.bulk_create(
+            [
+                Associate(name=f"Associate {i}", user=user, content=contents[i])
+                for i, user in enumerate(users)
+            ]
+        )
+        spaces = Space.objects.bulk_create(
+            [Space(name=f"Space {i}") for i in range(cls.SPACES)]
+        )
+        Space.content.through.objects.bulk_create(
+            [
+                Space.content.through(
+                    space_id=spaces[i % cls.SPACES].id, content_id=content.id
+                )
+                for i, content in enumerate(contents)
+            ],
+            batch_size=5000,
+        )
+        Space.associate.through.objects.bulk_create(
+            [
+                Space.associate.through(
+                    space_id=spaces[i % cls.SPACES].id, associate_id=associate.id
+                )
+                for i, associate in enumerate(associates)
+            ]
+        )
+        cls.space = spaces[0]
+        cls.content = contents[100]
+        cls.associate = associates[0]
+        cls.plan = plans[0]
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def queries(self):
+        """名前: クエリセット"""
+        space_contents = Content.objects.filter(spaces=self.space.id)
+        cursor = Cursor(self.content.published_at, self.content.id)
+        return {
+            "space content page": space_contents.order_by(*CONTENT_ORDERING)[:20],
+            "space content keyset page": keyset_queryset(space_contents, cursor, 20),
+            "space validator": _validator_queryset(self.space.id),
+            "contents by status": Content.objects.filter(
+                status=self.published
+            ).order_by(*CONTENT_ORDERING)[:20],
+            "contents by structure": Content.objects.filter(
+                model=self.structure
+            ).order_by(*CONTENT_ORDERING)[:20],
+            "spaces of content": Space.content.through.objects.filter(
+                content_id__in=[self.content.id]
+            ).values_list("space_id", flat=True),
+            "spaces by associate": Space.objects.filter(associate=self.associate),
+            "users by plan": User.objects.filter(plan=self.plan).order_by("created_at")[
+                :20
+            ],
+            "referencing contents": referencing_contents([self.content.id]),
+            "due scheduled contents": due_contents(timezone.now())[:500],
+            "visible contents": Content.objects.visible_to(
+                self.associate.user_id
+            ).order_by(*CONTENT_ORDERING)[:20],
+            "space changes": changes_queryset(self.space.id)[:100],
+            "visible contents by space ids": Content.objects.visible_to(
+                self.associate.user_id, [self.space.id]
+            ).order_by(*CONTENT_ORDERING)[:20],
+        }
+
+    def test_no_sequential_scans(self):
+        for name, queryset in self.queries().items():
+            with self.subTest(name):
+                assert sequential_scans(queryset) == [], queryset.explain()
+
+    def test_detects_sequential_scan(self):
+        # titleにはインデックスがないため全件走査になる
+        queryset = Content.objects.filter(title="Content 1")
+        assert sequential_scans(queryset) == [Content._meta.db_table]
+        # サブクエリ内の全件走査も別名から元のテーブルを求めて検出する
+        queryset = Content.objects.filter(pk__in=queryset.values("pk"))
+        assert sequential_scans(queryset) == [Content._meta.db_table]
@@ -0,0 +1,299 @@
+"""
+referenceフィールドの展開
+ページ内の参照先のidを深さごとにまとめ、1段につき1回のid__inクエリで取得する
+取得したContentはリクエストの間ReferenceLoaderに保持する
+
+REFERENCE_MAX_DEPTH段まで展開し、それより深い参照と循環する参照はidのまま返す
+展開するのはschemaの最上位のreferenceフィールドのみ
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+
+from app import serializer
+from app.cache import get_space_cache
+from app.models import Content, Space, Status, Structure
+from app.registry import status_registry
+from app.structures import structure_registry
+
+
+class ReferenceLoader:
+    """
+    参照先のContentの出力(参照は未展開)をidごとに保持する
+    max_depth: 展開する深さ、省略時はsettings.REFERENCE_MAX_DEPTH
+    """
+
+    def __init__(self, max_depth=None):
+        if max_depth is None:
+            max_depth = getattr(settings, "REFERENCE_MAX_DEPTH", 2)
+        self.max_depth = max_depth
+        self._contents = {}
+
+    def _reference_keys(self, data):
+        schema = structure_registry.get(data.get("model"))
+        return [
+            key
+            for key in getattr(schema, "references", ())
+            if isinstance(data.get(key), int)
+        ]
+
+    def _queryset(self, content_ids):
+        return serializer.FastContentSerializer.rows(
+            Content.objects.filter(id__in=content_ids)
+        )
+
+    def _missing(self, content_ids):
+        return {pk for pk in content_ids if pk not in self._contents}
+
+    def _store(self, missing, rows):
+        fast = serializer.FastContentSerializer(None, resolve_references=False)
+        for row in rows:
+            self._contents[row.id] = fast.to_representation(row)
+        # 削除されたContentはidのまま返す
+        for pk in missing:
+            self._contents.setdefault(pk, None)
+
+    def load(self, content_ids):
+        missing = self._missing(content_ids)
+        if missing:
+            rows = list(self._queryset(missing))
+            structure_registry.prepare({row.model_id for row in rows})
+            self._store(missing, rows)
+
+    async def aload(self, content_ids):
+        missing = self._missing(content_ids)
+        if missing:
+            rows = [row async for row in self._queryset(missing)]
+            await structure_registry.aprepare({row.model_id for row in rows})
+            self._store(missing, rows)
+
+    def _levels(self, items):
+        """深さごとに、読み込むべき参照先のidを返すジェネレータ"""
+        level = items
+        for _ in range(self.max_depth):
+            content_ids = {
+                data[key] for data in level for key in self._reference_keys(data)
+            }
+            if not content_ids:
+                return
+            yield content_ids
+            level = [self._contents[pk] for pk in content_ids if self._contents[pk]]
+
+    def resolve(self, items):
+        """items(Contentの出力のリスト)の参照を展開したリストを返す"""
+        for content_ids in self._levels(items):
+            self.load(content_ids)
+        return [self._embed(data, 0, (data["id"],)) for data in items]
+
+    async def aresolve(self, items):
+        """resolveの非同期版"""
+        for content_ids in self._levels(items):
+            await self.aload(content_ids)
+        return [self._embed(data, 0, (data["id"],)) for data in items]
+
+    def _embed(self, data, depth, ancestors):
+        keys = self._reference_keys(data)
+        if not keys or depth >= self.max_depth:
+            return data
+        data = dict(data)
+        for key in keys:
+            pk = data[key]
+            target = self._contents.get(pk)
+            if target is None or pk in ancestors:
+                continue
+            data[key] = self._embed(target, depth + 1, ancestors + (pk,))
+        return data
+
+
+_loader = ContextVar("reference_loader", default=None)
+
+
+def get_reference_loader():
+    """現在のリクエストのReferenceLoader、リクエスト外では呼び出しごとに作る"""
+    return _loader.get() or ReferenceLoader()
+
+
+@contextmanager
+def reference_scope():
+    """ブロック内で1つのReferenceLoaderを共有する"""
+    token = _loader.set(ReferenceLoader())
+    try:
+        yield
+    finally:
+        _loader.reset(token)
+
+
+class ReferenceLoaderMiddleware:
+    """リクエストごとにReferenceLoaderを作る"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with reference_scope():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with reference_scope():
+            return await self.get_response(request)
+
+
+def _reference_fields():
+    """referenceフィールドの(Structureのid, キー)のリスト"""
+    return structure_registry.reference_fields()
+
+
+def referencing_contents(content_ids, fields=None):
+    """
+    content_idsを直接参照しているContentのクエリセット
+    PostgreSQLでは@>(custom_fields__contains)でGINインデックスを使う
+    """
+    if fields is None:
+        fields = _reference_fields()
+    condition = Q()
+    for structure_id, key in fields:
+        if connection.vendor == "postgresql":
+            for pk in content_ids:
+                condition |= Q(model_id=structure_id, custom_fields__contains={key: pk})
+        else:
+            condition |= Q(
+                model_id=structure_id, **{f"custom_fields__{key}__in": content_ids}
+            )
+    if not condition:
+        return Content.objects.none()
+    return Content.objects.filter(condition)
+
+
+def referencing_content_ids(content_ids, max_depth=None):
+    """
+    content_idsをmax_depth段までに参照しているContentのid
+    参照先の変更でキャッシュを破棄するために使う
+    referenceフィールドを持つStructureがなければクエリを発行しない
+    """
+    if max_depth is None:
+        max_depth = getattr(settings, "REFERENCE_MAX_DEPTH", 2)
+    fields = _reference_fields()
+    found = set()
+    content_ids = set(content_ids)
+    for _ in range(max_depth):
+        if not fields or not content_ids:
+            break
+        queryset = referencing_contents(content_ids, fields)
+        content_ids = set(queryset.values_list("id", flat=True)) - found
+        found |= content_ids
+    return found
+
+
+@override_settings(REFERENCE_MAX_DEPTH=2)
+class TestReferenceLoader(TestCase):
+    def setUp(self):
+        self.status = Status.objects.create(status="draft")
+        self.news = Structure.objects.create(
+            name="news",
+            description="",
+            schema=[
+                {"key": "related", "type": "reference"},
+                {"key": "body", "type": "multiline"},
+            ],
+        )
+
+    def create(self, title, related=None):
+        return Content.objects.create(
+            title=title,
+            model=self.news,
+            status=self.status,
+            custom_fields={"related": related, "body": title},
+        )
+
+    def chain(self, length, count=10):
+        """length段の参照の連鎖をcount本作り、先頭のContentのリストを返す"""
+        heads = []
+        for i in range(count):
+            related = None
+            for depth in reversed(range(length)):
+                related = self.create(f"Content {i}-{depth}", related and related.pk)
+            heads.append(related)
+        return heads
+
+    def serialize(self, contents, fast):
+        queryset = Content.objects.filter(id__in=[c.pk for c in contents])
+        queryset = queryset.order_by("id")
+        if fast:
+            return serializer.FastContentSerializer(queryset, many=True).data
+        return serializer.ContentSerializer(queryset, many=True).data
+
+    def test_query_count_per_depth(self):
+        status_registry.name(self.status.id)
+        for length, depth_queries in ((1, 0), (2, 1), (3, 2), (5, 2)):
+            heads = self.chain(length)
+            structure_registry.get(self.news.pk)
+            for fast in (False, True):
+                # ページの取得1回と、展開する深さごとに1回
+                with self.assertNumQueries(1 + depth_queries):
+                    data = self.serialize(heads, fast)
+                assert len(data) == 10
+            Content.objects.all().delete()
+
+    def test_embed_and_max_depth(self):
+        head = self.chain(4, count=1)[0]
+        data = serializer.ContentSerializer(head).data
+        assert data["related"]["title"] == "Content 0-1"
+        assert data["related"]["related"]["title"] == "Content 0-2"
+        # 3段目はidのまま
+        assert isinstance(data["related"]["related"]["related"], int)
+        fast = serializer.FastContentSerializer(
+            serializer.FastContentSerializer.rows(
+                Content.objects.filter(pk=head.pk)
+            ).get()
+        ).data
+        assert fast == data
+
+    def test_cycle(self):
+        first = self.create("first")
+        second = self.create("second", first.pk)
+        first.custom_fields["related"] = second.pk
+        first.save()
+        data = serializer.ContentSerializer(first).data
+        assert data["related"]["title"] == "second"
+        # firstへの参照は循環するためidのまま
+        assert data["related"]["related"] == first.pk
+
+    def test_memoized_within_scope(self):
+        heads = self.chain(2)
+        structure_registry.get(self.news.pk)
+        status_registry.name(self.status.id)
+        with reference_scope():
+            self.serialize(heads, fast=True)
+            with self.assertNumQueries(1):
+                self.serialize(heads, fast=True)
+
+    def test_referencing_content_ids(self):
+        head = self.chain(3, count=1)[0]
+        tail = Content.objects.get(title="Content 0-2")
+        middle = Content.objects.get(title="Content 0-1")
+        assert referencing_content_ids([tail.pk]) == {middle.pk, head.pk}
+        assert referencing_content_ids([tail.pk], max_depth=1) == {middle.pk}
+
+    def test_referenced_change_invalidates_space(self):
+        head = self.chain(2, count=1)[0]
+        tail = Content.objects.get(title="Content 0-1")
+        space = Space.objects.create(name="space")
+        space.content.add(head)
+        cache = get_space_cache()
+        key = cache.key(space.pk)
+        tail.title = "changed"
+        tail.save()
+        assert cache.key(space.pk) != key
@@ -0,0 +1,161 @@
+"""
+Statusのプロセス内レジストリ
+Statusは数行しかないため全行を1回のクエリで読み込み、
+Contentごとの結合や遅延読み込みの代わりに使う
+保存・削除時はapp.signalsで破棄し、次の参照で読み直す
+他のプロセスでの変更はttl秒後の読み直しで反映する
+"""
+
+import threading
+import time
+from typing import NamedTuple
+
+import pytest
+
+from app.models import Status
+
+
+class _Loaded(NamedTuple):
+    """
+    読み込んだStatus
+    missing: 読み直しても見つからなかった("names", id), ("ids", 名前)、期限まで引かない
+    """
+
+    names: dict
+    ids: dict
+    expires: float
+    missing: set
+
+
+class StatusRegistry:
+    """
+    ttl: 他のプロセスでの変更(名前の変更、作成)を反映するまでの秒数
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    def _queryset(self):
+        return Status.objects.order_by("-id").values_list("id", "status")
+
+    def _set(self, names, missing=None):
+        # 同名のStatusがある場合は最も小さいidを使う
+        ids = {name: pk for pk, name in names.items()}
+        loaded = _Loaded(names, ids, time.monotonic() + self.ttl, missing or set())
+        with self._lock:
+            self._loaded = loaded
+        return loaded
+
+    def _load(self, missing=None):
+        return self._set(dict(self._queryset()), missing)
+
+    def _current(self):
+        """期限内の読み込み結果、なければNone"""
+        loaded = self._loaded
+        if loaded is None or loaded.expires <= time.monotonic():
+            return None
+        return loaded
+
+    def _get(self, attr, key):
+        loaded = self._current()
+        fresh = loaded is None
+        if fresh:
+            loaded = self._load()
+        values = getattr(loaded, attr)
+        if key in values:
+            return values[key]
+        if (attr, key) in loaded.missing:
+            return None
+        if not fresh:
+            # 他のプロセスで作成されたStatusの可能性があるため1回だけ読み直す
+            loaded = self._load(loaded.missing)
+            values = getattr(loaded, attr)
+            if key in values:
+                return values[key]
+        loaded.missing.add((attr, key))
+        return None
+
+    async def aprepare(self, status_ids=()):
+        """
+        非同期ビュー用
+        未読み込み、またはstatus_idsに未知のidがあれば非同期のクエリで読み込み、
+        以降のname()が同期のクエリを発行しないようにする
+        """
+        loaded = self._current()
+        if loaded is not None and all(
+            pk in loaded.names or ("names", pk) in loaded.missing for pk in status_ids
+        ):
+            return
+        missing = loaded.missing if loaded is not None else None
+        loaded = self._set({pk: name async for pk, name in self._queryset()}, missing)
+        loaded.missing.update(
+            ("names", pk) for pk in status_ids if pk not in loaded.names
+        )
+
+    def name(self, status_id):
+        """idからStatusの名前を返す、存在しなければNone"""
+        return self._get("names", status_id)
+
+    def id(self, name):
+        """名前からStatusのidを返す、存在しなければNone"""
+        return self._get("ids", name)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = None
+
+
+status_registry = StatusRegistry()
+
+
+@pytest.mark.django_db
+def test_status_registry(django_assert_num_queries):
+    registry = StatusRegistry()
+    draft = Status.objects.create(status="draft")
+    published = Status.objects.create(status="published")
+    with django_assert_num_queries(1):
+        assert registry.name(draft.id) == "draft"
+        assert registry.name(published.id) == "published"
+        assert registry.id("published") == published.id
+
+    review = Status.objects.create(status="review")
+    with django_assert_num_queries(1):
+        assert registry.name(review.id) == "review"
+    # 未知のidと名前はそれぞれ1回だけ読み直す
+    with django_assert_num_queries(2):
+        assert registry.name(review.id + 1) is None
+        assert registry.id("unknown") is None
+    # 見つからなかったidと名前は期限まで引き直さない
+    with django_assert_num_queries(0):
+        for _ in range(3):
+            assert registry.name(review.id + 1) is None
+            assert registry.id("unknown") is None
+
+
+@pytest.mark.django_db
+def test_status_registry_ttl(django_assert_num_queries):
+    draft = Status.objects.create(status="draft")
+    registry = StatusRegistry(ttl=60)
+    assert registry.name(draft.id) == "draft"
+    # シグナルが送られない、他のプロセスでの変更に相当する
+    Status.objects.filter(pk=draft.pk).update(status="review")
+    assert registry.name(draft.id) == "draft"
+    # 期限が切れると読み直す
+    expired = StatusRegistry(ttl=0)
+    with django_assert_num_queries(2):
+        assert expired.name(draft.id) == "review"
+        assert expired.id("review") == draft.id
+
+
+@pytest.mark.django_db
+def test_status_registry_invalidated_on_save(django_assert_num_queries):
+    draft = Status.objects.create(status="draft")
+    assert status_registry.name(draft.id) == "draft"
+    draft.status = "review"
+    draft.save()
+    assert status_registry.name(draft.id) == "review"
+    assert status_registry.id("draft") is None
+    draft.delete()
+    assert status_registry.name(draft.id) is None
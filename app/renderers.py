@@ -0,0 +1,140 @@
+"""
+Acceptヘッダーで選ぶレスポンスの形式
+ORJSONRenderer: JSONRendererと同じバイト列をorjsonで作る
+MessagePackRenderer: application/msgpack
+
+orjson, msgpackは任意の依存で、なければORJSONRendererはJSONRendererと同じ処理になり、
+MessagePackRendererは使えない (settings.REST_FRAMEWORKに含めない)
+
+native_datetimesのレンダラーはdatetimeを文字列にせずに受け取る
+(FastContentSerializer(native_datetimes=True)で組み立てた出力)
+"""
+
+import datetime
+
+import pytest
+from django.utils import timezone
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _default(obj):
+    # orjson, msgpackが扱えない型(Decimal, 遅延評価の文字列など)はJSONRendererと同じにする
+    return encoders.JSONEncoder().default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRendererと同じ設定(UNICODE_JSON, COMPACT_JSON)のときにorjsonでエンコードする
+    datetimeはorjsonがJSONEncoderと同じ形(UTCはZ)で書き出す
+    1e16以上の浮動小数点数の指数表記とNaN, Infinityのみ出力が異なる
+    """
+
+    native_datetimes = orjson is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None
+            or data is None
+            or self.ensure_ascii
+            or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z)
+        except orjson.JSONEncodeError:
+            # 64ビットを超える整数など
+            return super().render(data, accepted_media_type, renderer_context)
+        # JSONRendererと同じくU+2028, U+2029はエスケープする
+        return ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+            b"\xe2\x80\xa9", b"\\u2029"
+        )
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    application/msgpack
+    datetimeはMessagePackのTimestamp拡張型で書き出す
+    """
+
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+    native_datetimes = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, default=_default, datetime=True)
+
+
+def native_datetimes(request):
+    """requestで選ばれたレンダラーがdatetimeをそのまま受け取れるか"""
+    renderer = getattr(request, "accepted_renderer", None)
+    return getattr(renderer, "native_datetimes", False)
+
+
+def select_renderer(request, renderers):
+    """
+    DRFのビューではないHttpRequestで、Acceptを満たす最初のレンダラーを返す
+    満たすものがなければ先頭のレンダラー
+    """
+    for renderer in renderers:
+        if request.accepts(renderer.media_type):
+            return renderer
+    return renderers[0]
+
+
+SAMPLE = {
+    "id": 1,
+    "title": "テスト\u2028Content\u2029",
+    "price": 10.5,
+    "tags": ["a", None, True],
+    "created_at": datetime.datetime(2024, 1, 2, 3, 4, 5, 678900, datetime.UTC),
+    "published_at": datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.UTC),
+    "nested": {"empty": [], "ratio": 0.1},
+}
+
+
+def test_orjson_renderer_matches_json_renderer():
+    expected = JSONRenderer().render(SAMPLE)
+    assert ORJSONRenderer().render(SAMPLE) == expected
+    assert b'"2024-01-02T03:04:05.678900Z"' in expected
+    assert b"\\u2028" in expected
+    # indentの指定はJSONRendererに任せる
+    media_type = "application/json; indent=2"
+    assert ORJSONRenderer().render(SAMPLE, media_type) == (
+        JSONRenderer().render(SAMPLE, media_type)
+    )
+    assert ORJSONRenderer().render(None) == b""
+    # orjsonで扱えない値はJSONRendererでエンコードする
+    large = {"large": 2**64}
+    assert ORJSONRenderer().render(large) == JSONRenderer().render(large)
+
+
+def test_orjson_renderer_other_timezone():
+    data = {"at": timezone.now()}
+    data["local"] = data["at"].astimezone(
+        datetime.timezone(datetime.timedelta(hours=9))
+    )
+    assert ORJSONRenderer().render(data) == JSONRenderer().render(data)
+
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack is not installed")
+def test_messagepack_renderer():
+    data = dict(SAMPLE)
+    content = MessagePackRenderer().render(data)
+    decoded = msgpack.unpackb(content, timestamp=3)
+    assert decoded == data
@@ -0,0 +1,143 @@
+"""
+読み取りレプリカへの振り分け
+read_replicaを付けたビューの中の読み取りだけをsettings.DATABASE_REPLICASに送る
+それ以外の読み取りと全ての書き込みはdefaultで行う
+キャッシュに保存する結果はuse_primaryでdefaultから作る(app.cache.SpaceCache)
+"""
+
+import asyncio
+import functools
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import pytest
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connections, transaction
+from django.test import override_settings
+
+from app.models import Space
+
+_use_replica = ContextVar("use_replica", default=False)
+
+
+@contextmanager
+def use_replica():
+    """ブロック内の読み取りをレプリカに送る"""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """
+    ブロック内の読み取りをdefaultに戻す
+    レプリカの遅延で古い結果を新しいバージョンのキャッシュに保存しないために使う
+    """
+    token = _use_replica.set(False)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def read_replica(view):
+    """
+    view内の読み取りをレプリカに送るデコレータ(同期・非同期のビュー)
+    ContextVarで渡すため、非同期ビューのsync_to_asyncのスレッドにも引き継がれる
+    """
+    if iscoroutinefunction(view):
+
+        @functools.wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            with use_replica():
+                return await view(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas or not _use_replica.get():
+            return None
+        # トランザクション内では自身の書き込みが見えるようにdefaultで読む
+        if connections["default"].in_atomic_block:
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはdefaultの複製なので、どのDBのオブジェクトも関連付けられる
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+@override_settings(DATABASE_REPLICAS=["replica0"])
+def test_read_replica_router():
+    router = ReadReplicaRouter()
+    assert router.db_for_read(Space) is None
+    with use_replica():
+        assert router.db_for_read(Space) == "replica0"
+    assert router.db_for_write(Space) == "default"
+    assert router.allow_migrate("default", "app")
+    assert not router.allow_migrate("replica0", "app")
+    with use_replica(), use_primary():
+        assert router.db_for_read(Space) is None
+
+
+@override_settings(DATABASE_REPLICAS=["replica0"])
+def test_space_cache_builds_on_primary():
+    from app.cache import LRUBackend, SpaceCache
+
+    router = ReadReplicaRouter()
+    cache = SpaceCache(LRUBackend())
+
+    def build():
+        return {"db": router.db_for_read(Space)}
+
+    async def abuild():
+        return build()
+
+    with use_replica():
+        # キャッシュミス時の読み取りはレプリカに送らない
+        assert cache.get_or_set(1, build) == {"db": None}
+        assert asyncio.run(cache.aget_or_set(2, abuild)) == {"db": None}
+        assert router.db_for_read(Space) == "replica0"
+
+
+@pytest.mark.django_db
+@override_settings(DATABASE_REPLICAS=["replica0"])
+def test_read_replica_decorator():
+    router = ReadReplicaRouter()
+
+    @read_replica
+    def view():
+        return router.db_for_read(Space)
+
+    @read_replica
+    async def async_view():
+        return router.db_for_read(Space)
+
+    # テストはトランザクション内で動くためdefaultで読む
+    assert view() is None
+    with transaction.atomic():
+        assert view() is None
+    assert _use_replica.get() is False
+    # イベントループ上の接続はテストのトランザクションとは別になる
+    assert asyncio.run(async_view()) == "replica0"
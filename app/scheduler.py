@@ -0,0 +1,244 @@
+"""
+予約公開
+scheduled_atを過ぎたdraft, reviewのContentをpublishedにする
+python manage.py publish_scheduled で常駐させる
+
+batch_size件ずつ SELECT ... FOR UPDATE SKIP LOCKED で確保し、UPDATE 1回で公開する
+他のワーカーが確保中の行は飛ばすため、複数のワーカーを同時に動かしても二重に処理しない
+バッチごとに、影響するSpaceのキャッシュとスナップショットをSpaceごとに1回だけ更新する
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from app import snapshots
+from app.cache import get_space_cache
+from app.changes import record_updates
+from app.models import Content, Space, SpaceSnapshot, Status
+from app.references import referencing_content_ids
+from app.registry import status_registry
+from app.signals import invalidate_spaces
+from app.snapshots import get_snapshot, lock_snapshots, update_snapshots
+from app.structures import structure_registry
+
+logger = logging.getLogger(__name__)
+
+SCHEDULED_STATUSES = ("draft", "review")
+PUBLISHED_STATUS = "published"
+PUBLISH_BATCH_SIZE = 500
+
+
+def _status_ids(names):
+    status_ids = {name: status_registry.id(name) for name in names}
+    missing = [name for name, pk in status_ids.items() if pk is None]
+    if missing:
+        raise ValueError(f"Statusがありません: {', '.join(missing)}")
+    return status_ids
+
+
+def due_contents(now):
+    """公開日時になった予約のContent (予約日時、idの順)"""
+    status_ids = _status_ids(SCHEDULED_STATUSES).values()
+    return Content.objects.filter(
+        scheduled_at__lte=now, status_id__in=status_ids
+    ).order_by("scheduled_at", "id")
+
+
+def publish_due(now=None, batch_size=PUBLISH_BATCH_SIZE):
+    """
+    公開日時になったContentを最大batch_size件公開し、公開したContentのidを返す
+    published_atは予約日時にし、scheduled_atはNoneに戻す
+    """
+    now = now or timezone.now()
+    published = _status_ids([PUBLISHED_STATUS])[PUBLISHED_STATUS]
+    with transaction.atomic():
+        content_ids = list(
+            due_contents(now)
+            .select_for_update(skip_locked=True)
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not content_ids:
+            return []
+        # querysetのupdateではauto_nowが働かないため、updated_atも設定する
+        Content.objects.filter(id__in=content_ids).update(
+            status_id=published,
+            published_at=F("scheduled_at"),
+            scheduled_at=None,
+            updated_at=now,
+        )
+        _invalidate(content_ids)
+        record_updates(content_ids)
+    return content_ids
+
+
+def _invalidate(content_ids):
+    """
+    公開したContentのSpaceのスナップショットとキャッシュをSpaceごとに1回更新する
+    querysetのupdateではシグナルが送られないため直接行う (変更の記録はrecord_updates)
+    """
+    SpaceContent = Space.content.through
+    by_space = defaultdict(list)
+    for space_id, content_id in SpaceContent.objects.filter(
+        content_id__in=content_ids
+    ).values_list("space_id", "content_id"):
+        by_space[space_id].append(content_id)
+    # referenceフィールドで展開しているContentのSpaceも出力が変わる
+    referencing = referencing_content_ids(content_ids)
+    space_ids = set(by_space)
+    if referencing:
+        space_ids.update(
+            SpaceContent.objects.filter(content_id__in=referencing).values_list(
+                "space_id", flat=True
+            )
+        )
+    # Content.save()と同じくSpace(idの順)、スナップショットの順にロックし、
+    # ワーカーや保存とのデッドロックを防ぐ
+    invalidate_spaces(space_ids)
+    if snapshots.enabled() and by_space:
+        list(lock_snapshots(by_space).values_list("space_id", flat=True))
+    for space_id in sorted(by_space):
+        update_snapshots([space_id], by_space[space_id])
+
+
+def run_worker(
+    batch_size=PUBLISH_BATCH_SIZE, interval=5.0, once=False, stop=None, log=None
+):
+    """
+    予約がなくなるまでバッチを繰り返し、なくなったらinterval秒待って再開する
+    once: 予約がなくなったら終了する
+    stop: threading.Event、セットされたら次のバッチの前に終了する
+    @return 公開した件数
+    """
+    stop = stop or threading.Event()
+    log = log or logger.info
+    total = 0
+    while not stop.is_set():
+        content_ids = publish_due(batch_size=batch_size)
+        total += len(content_ids)
+        if content_ids:
+            log(f"published={len(content_ids)} total={total}")
+        if len(content_ids) < batch_size:
+            if once:
+                break
+            stop.wait(interval)
+    return total
+
+
+class TestPublishScheduled(TestCase):
+    def setUp(self):
+        self.draft, self.review, self.published = Status.objects.bulk_create(
+            [Status(status=name) for name in ("draft", "review", "published")]
+        )
+        self.archived = Status.objects.create(status="archived")
+        self.now = timezone.now()
+        self.spaces = Space.objects.bulk_create(
+            [Space(name=f"Space {i}") for i in range(2)]
+        )
+
+    def schedule(self, count, minutes=-1, status=None):
+        contents = Content.objects.bulk_create(
+            [
+                Content(
+                    title=f"Content {i}",
+                    status=status or self.draft,
+                    scheduled_at=self.now + timedelta(minutes=minutes, seconds=i),
+                )
+                for i in range(count)
+            ]
+        )
+        for space in self.spaces:
+            space.content.add(*contents)
+        return contents
+
+    def test_publish_due(self):
+        due = self.schedule(3) + self.schedule(2, status=self.review)
+        future = self.schedule(2, minutes=10)
+        archived = self.schedule(1, status=self.archived)
+        assert sorted(publish_due(self.now)) == sorted(c.pk for c in due)
+        for content in due:
+            content.refresh_from_db()
+            assert content.status_id == self.published.pk
+            assert content.scheduled_at is None
+            # 公開日時は予約日時
+            assert content.published_at < self.now
+            assert content.updated_at == self.now
+        for content in future + archived:
+            content.refresh_from_db()
+            assert content.scheduled_at is not None
+            assert content.status_id != self.published.pk
+        # 公開済みのContentは再び処理しない
+        assert publish_due(self.now) == []
+
+    def test_batches(self):
+        self.schedule(5)
+        status_registry.id("draft")
+        structure_registry.reference_fields()
+        batches = []
+        counts = []
+        for _ in range(3):
+            with CaptureQueriesContext(connection) as queries:
+                batches.append(publish_due(self.now, batch_size=2))
+            counts.append(len(queries))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        # クエリ数はバッチの件数によらない
+        assert len(set(counts)) == 1
+        assert run_worker(batch_size=2, once=True) == 0
+
+    def test_invalidates_each_space_once(self):
+        self.schedule(4)
+        cache = get_space_cache()
+        versions = [cache.backend.get_version(space.pk) for space in self.spaces]
+        publish_due(self.now)
+        assert [cache.backend.get_version(space.pk) for space in self.spaces] == [
+            version + 1 for version in versions
+        ]
+
+    def test_space_detail_after_publish(self):
+        contents = self.schedule(2)
+        url = reverse("space-detail", args=[self.spaces[0].pk])
+        before = self.client.get(url)
+        publish_due(self.now)
+        after = self.client.get(url, headers={"if-none-match": before["ETag"]})
+        assert after.status_code == 200
+        statuses = {row["id"]: row["_status"] for row in after.json()["content"]}
+        assert statuses == {content.pk: "published" for content in contents}
+
+    @override_settings(SPACE_SNAPSHOTS=True)
+    def test_snapshots(self):
+        for space in self.spaces:
+            SpaceSnapshot.objects.create(space=space)
+        contents = self.schedule(2)
+        with CaptureQueriesContext(connection) as queries:
+            publish_due(self.now)
+        # Spaceを先にidの順にロックし、次に全てのスナップショットをspace_idの順にロックする
+        sqls = [q["sql"] for q in queries]
+        space_table = Space._meta.db_table
+        table = SpaceSnapshot._meta.db_table
+        space_lock = next(
+            i for i, sql in enumerate(sqls) if sql.startswith(f'SELECT "{space_table}"')
+        )
+        first = next(i for i, sql in enumerate(sqls) if f'FROM "{table}"' in sql)
+        assert space_lock < first
+        assert "ORDER BY" in sqls[space_lock]
+        first_space, second_space = self.spaces
+        assert f"IN ({first_space.pk}, {second_space.pk})" in sqls[first]
+        assert "ORDER BY" in sqls[first]
+        for space in self.spaces:
+            payload = get_snapshot(space.pk)
+            assert {row["id"]: row["_status"] for row in payload["content"]} == {
+                content.pk: "published" for content in contents
+            }
+
+    def test_missing_status(self):
+        self.published.delete()
+        with self.assertRaises(ValueError):
+            publish_due(self.now)
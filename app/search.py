@@ -0,0 +1,95 @@
+"""
+Contentの全文検索 (クエリパラメータ q)
+PostgreSQL: トリガーで維持するsearch_vector(GINインデックス)への前方一致検索と順位付け
+SQLite: title, Structureのname, descriptionの語の前方一致 (テスト用、順位付けなし)
+"""
+
+import re
+
+import pytest
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVectorField,
+)
+from django.db import connection
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
+
+from app.models import Content, Status, Structure
+
+SEARCH_CONFIG = "simple"
+
+
+def search_terms(q):
+    """qを単語に分ける、tsqueryの演算子などの記号は捨てる"""
+    return re.findall(r"\w+", q)
+
+
+def prefix_tsquery(terms):
+    """["foo", "bar"] -> "foo:* & bar:*" (すべての語の前方一致)"""
+    return " & ".join(f"{term}:*" for term in terms)
+
+
+def search_contents(queryset, q):
+    """
+    Contentのクエリセットをqで絞り込む
+    @return (queryset, ranked) rankedがTrueならsearch_rankで並べ替えられる
+    """
+    terms = search_terms(q)
+    if not terms:
+        return queryset.none(), False
+
+    if connection.vendor == "postgresql":
+        query = SearchQuery(
+            prefix_tsquery(terms), search_type="raw", config=SEARCH_CONFIG
+        )
+        queryset = (
+            queryset.annotate(
+                search_vector=RawSQL(
+                    f'"{Content._meta.db_table}"."search_vector"',
+                    [],
+                    output_field=SearchVectorField(),
+                )
+            )
+            .filter(search_vector=query)
+            .annotate(search_rank=SearchRank(F("search_vector"), query))
+        )
+        return queryset, True
+
+    # 語の前方一致に近づけるため、先頭または空白の直後での一致を探す
+    for term in terms:
+        condition = Q()
+        for field in ("title", "model__name", "model__description"):
+            condition |= Q(**{f"{field}__istartswith": term})
+            condition |= Q(**{f"{field}__icontains": f" {term}"})
+        queryset = queryset.filter(condition)
+    return queryset, False
+
+
+def test_search_terms():
+    assert search_terms("foo bar") == ["foo", "bar"]
+    assert search_terms("foo & !bar:*") == ["foo", "bar"]
+    assert search_terms("ニュース 2024") == ["ニュース", "2024"]
+    assert prefix_tsquery(["foo", "bar"]) == "foo:* & bar:*"
+
+
+@pytest.mark.django_db
+def test_search_contents():
+    status = Status.objects.create(status="draft")
+    news = Structure.objects.create(name="news", description="Company announcements")
+    hello = Content.objects.create(title="Hello World", status=status)
+    helios = Content.objects.create(title="Helios", status=status)
+    release = Content.objects.create(title="Release", model=news, status=status)
+
+    def search(q):
+        queryset, _ = search_contents(Content.objects.all(), q)
+        return set(queryset)
+
+    assert search("hel") == {hello, helios}
+    assert search("hello wor") == {hello}
+    assert search("announce") == {release}
+    assert search("news release") == {release}
+    assert search("orld") == set()
+    assert search("missing") == set()
+    assert search("&") == set()
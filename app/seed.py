@@ -0,0 +1,250 @@
+"""
+ベンチマーク・負荷試験用のデータ生成
+Plan, User, Associate, Space, Structure, Contentを指定の件数だけbulk_createで作る
+python manage.py seed_data で実行する
+
+Spaceごとの件数は偏らせる(少数のSpaceに多くのContentが集まる)
+Contentは1〜3個のSpaceに、Associateは1〜4個のSpaceに属する
+同じseedなら同じデータを作る
+"""
+
+import random
+from dataclasses import asdict, dataclass, replace
+from itertools import accumulate
+
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from app.models import Associate, Content, Plan, Space, Status, Structure, User
+from app.structures import structure_registry
+
+STATUSES = ("draft", "review", "published", "archived")
+# Contentの状態の割合
+STATUS_WEIGHTS = (2, 1, 6, 1)
+# Userのプランの割合 (Plan.PLAN_OPTIONSの順)
+PLAN_WEIGHTS = (7, 2, 1)
+
+WORDS = ("news", "release", "product", "update", "event", "report", "guide")
+
+# Structureのschema、Structureごとに順に使う
+SCHEMAS = (
+    [
+        {"key": "body", "type": "multiline"},
+        {"key": "related", "type": "reference"},
+    ],
+    [
+        {"key": "price", "type": "number", "indexed": True},
+        {"key": "category", "type": "singleline"},
+        {"key": "on_sale", "type": "boolean"},
+    ],
+    [
+        {"key": "summary", "type": "singleline"},
+        {"key": "starts_at", "type": "datetime"},
+    ],
+)
+
+
+@dataclass
+class SeedVolumes:
+    """作る件数、Planは名前が一意のためPLAN_OPTIONSの分だけ"""
+
+    users: int = 1_000
+    associates: int = 2_000
+    spaces: int = 100
+    structures: int = 3
+    contents: int = 100_000
+
+    @classmethod
+    def scaled(cls, contents):
+        """contentsの件数に合わせて他の件数を決める"""
+        return cls(
+            users=max(contents // 100, 1),
+            associates=max(contents // 50, 1),
+            spaces=max(contents // 1000, 1),
+            structures=len(SCHEMAS),
+            contents=contents,
+        )
+
+
+def _weighted(rng, count):
+    """0..count-1をパレート分布で偏らせて選ぶ関数を返す"""
+    cumulative = list(accumulate(1 / (i + 1) for i in range(count)))
+
+    def choose(k):
+        return set(rng.choices(range(count), cum_weights=cumulative, k=k))
+
+    return choose
+
+
+def _custom_fields(rng, schema, i, content_ids):
+    values = {}
+    for definition in schema:
+        key, kind = definition["key"], definition["type"]
+        if kind == "reference":
+            # 一部のContentのみ、前のバッチまでに作成したContentを参照する
+            if content_ids and rng.random() < 0.3:
+                values[key] = rng.choice(content_ids)
+        elif kind == "number":
+            values[key] = rng.randrange(10_000)
+        elif kind == "boolean":
+            values[key] = rng.random() < 0.2
+        elif kind == "datetime":
+            values[key] = f"2024-{i % 12 + 1:02}-01T00:00:00Z"
+        elif kind == "multiline":
+            values[key] = "\n".join(rng.choices(WORDS, k=20))
+        else:
+            values[key] = rng.choice(WORDS)
+    return values
+
+
+def seed_data(volumes=None, seed=0, batch_size=5000):
+    """volumes(SeedVolumes)の件数のデータを作り、作成した件数のdictを返す"""
+    volumes = volumes or SeedVolumes()
+    rng = random.Random(seed)
+    with transaction.atomic():
+        statuses = [Status.objects.get_or_create(status=name)[0] for name in STATUSES]
+        plans = [
+            Plan.objects.get_or_create(name=name)[0] for name, _ in Plan.PLAN_OPTIONS
+        ]
+        structures = Structure.objects.bulk_create(
+            [
+                Structure(
+                    name=f"Structure {i}",
+                    description="",
+                    schema=SCHEMAS[i % len(SCHEMAS)],
+                )
+                for i in range(volumes.structures)
+            ]
+        )
+        # bulk_createはシグナルを送らないため、referenceフィールドの一覧を読み直させる
+        structure_registry.invalidate()
+        users = User.objects.bulk_create(
+            [
+                User(
+                    name=f"User {i}",
+                    plan=rng.choices(plans, weights=PLAN_WEIGHTS)[0],
+                )
+                for i in range(volumes.users)
+            ],
+            batch_size=batch_size,
+        )
+        spaces = Space.objects.bulk_create(
+            [Space(name=f"Space {i}") for i in range(volumes.spaces)],
+            batch_size=batch_size,
+        )
+
+        choose_spaces = _weighted(rng, len(spaces))
+        content_ids = []
+        links = 0
+        through = Space.content.through
+        for start in range(0, volumes.contents, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, volumes.contents)):
+                # 3割のContentはStructureを持たない
+                structure = (
+                    rng.choice(structures)
+                    if structures and rng.random() < 0.7
+                    else None
+                )
+                batch.append(
+                    Content(
+                        title=" ".join(rng.choices(WORDS, k=3)) + f" {i}",
+                        status=rng.choices(statuses, weights=STATUS_WEIGHTS)[0],
+                        model=structure,
+                        custom_fields=(
+                            _custom_fields(rng, structure.schema, i, content_ids)
+                            if structure
+                            else {}
+                        ),
+                    )
+                )
+            contents = Content.objects.bulk_create(batch)
+            rows = [
+                through(space_id=spaces[index].id, content_id=content.id)
+                for content in contents
+                for index in choose_spaces(rng.randint(1, 3))
+            ]
+            through.objects.bulk_create(rows)
+            links += len(rows)
+            content_ids.extend(content.id for content in contents)
+
+        associates = Associate.objects.bulk_create(
+            (
+                [
+                    Associate(
+                        name=f"Associate {i}",
+                        user=users[i % len(users)],
+                        content_id=rng.choice(content_ids),
+                    )
+                    for i in range(volumes.associates)
+                ]
+                if users and content_ids
+                else []
+            ),
+            batch_size=batch_size,
+        )
+        through = Space.associate.through
+        rows = [
+            through(space_id=spaces[index].id, associate_id=associate.id)
+            for associate in associates
+            for index in choose_spaces(rng.randint(1, 4))
+        ]
+        through.objects.bulk_create(rows, batch_size=batch_size)
+
+    return {
+        **asdict(volumes),
+        "associates": len(associates),
+        "plans": len(plans),
+        "space_contents": links,
+        "space_associates": len(rows),
+    }
+
+
+class TestSeedData(TestCase):
+    VOLUMES = SeedVolumes(users=20, associates=40, spaces=10, contents=500)
+
+    def test_seed_data(self):
+        counts = seed_data(self.VOLUMES, batch_size=100)
+        assert Content.objects.count() == counts["contents"] == 500
+        assert Space.objects.count() == 10
+        assert Associate.objects.count() == counts["associates"] == 40
+        assert Plan.objects.count() == counts["plans"] == 3
+        assert Space.content.through.objects.count() == counts["space_contents"]
+        # Contentは1〜3個のSpaceに属する
+        assert 500 <= counts["space_contents"] <= 1500
+        # Spaceごとの件数は偏る
+        per_space = [space.content.count() for space in Space.objects.all()]
+        assert max(per_space) > 2 * min(per_space)
+
+    def test_seed_data_query_count(self):
+        # Status, Planを作成済みにする
+        seed_data(replace(self.VOLUMES, contents=0))
+        counts = []
+        for contents in (500, 1000):
+            with CaptureQueriesContext(connection) as queries:
+                seed_data(replace(self.VOLUMES, contents=contents), batch_size=100)
+            counts.append(len(queries))
+        # Contentの100件ごとにContentと中間テーブルの2回のINSERTのみ増える
+        assert counts[1] - counts[0] == 5 * 2
+
+    def test_seed_data_references(self):
+        # 参照先は前のバッチまでに作成したContent
+        seed_data(self.VOLUMES, batch_size=100)
+        content_ids = set(Content.objects.values_list("id", flat=True))
+        references = [
+            fields["related"]
+            for fields in Content.objects.filter(
+                custom_fields__has_key="related"
+            ).values_list("custom_fields", flat=True)
+        ]
+        assert references
+        assert set(references) <= content_ids
+
+    def test_seed_data_deterministic(self):
+        seed_data(self.VOLUMES, seed=1)
+        first = list(Content.objects.order_by("id").values_list("title", flat=True))
+        Content.objects.all().delete()
+        seed_data(self.VOLUMES, seed=1)
+        second = list(Content.objects.order_by("id").values_list("title", flat=True))
+        assert first == second
@@ -1,27 +1,217 @@
 import pytest
-from rest_framework import serializers
+from django.db.models import QuerySet
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
 
-from app.models import Content, Space, Status
+from app import references
+from app.fields import (
+    CONTENT_COLUMNS,
+    content_columns,
+    content_keys,
+    parse_content_fields,
+    parse_space_fields,
+    project,
+)
+from app.models import Content, Space, Status, Structure
+from app.pagination import Cursor
+from app.registry import status_registry
+from app.structures import EMPTY_SCHEMA, structure_registry
 
 
 class ResponseSerializer(serializers.Serializer):
     """
-    offset: 結果のオフセット <- クエリパラメータ offset
+    offset: 結果のオフセット <- クエリパラメータ offset, cursor指定時はnull
     limit: 結果の制限 <- クエリパラメータ limit
+    next, previous: 前後のページのカーソル <- クエリパラメータ cursor
     total: SpaceSerializer
     data: SpaceSerializer, []
     """
 
+    total = serializers.IntegerField()
+    offset = serializers.IntegerField()
+    limit = serializers.IntegerField()
+    next = serializers.CharField(allow_null=True)
+    previous = serializers.CharField(allow_null=True)
+    data = serializers.ListField()
+
     class Meta:
         model = ""
-        fields = ["total", "offset", "limit"]
+        fields = ["total", "offset", "limit", "next", "previous", "data"]
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data["query_params"] = self.context["request"].query_params.get("q")
+        request = self.context["request"]
+        # 非同期ビューではDRFのRequestではなくHttpRequestが渡される
+        query_params = getattr(request, "query_params", None) or request.GET
+        data["query_params"] = query_params.get("q")
         return data
 
 
+class ContentListQuerySerializer(serializers.Serializer):
+    """
+    一覧系エンドポイントのクエリパラメータを検証する
+    offset: 0以上
+    limit: 1以上MAX_LIMIT以下
+    cursor: next/previousで返したカーソル、offsetとは併用できない
+    q: 検索語
+    fields: 出力するContentのキー (app.fields)
+    """
+
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+
+    offset = serializers.IntegerField(min_value=0, default=0)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=MAX_LIMIT, default=DEFAULT_LIMIT
+    )
+    cursor = serializers.CharField(required=False)
+    q = serializers.CharField(required=False, allow_blank=True)
+    fields = serializers.CharField(required=False, allow_blank=True)
+
+    def validate_cursor(self, value):
+        try:
+            return Cursor.decode(value)
+        except ValueError:
+            raise serializers.ValidationError("不正なカーソルです")
+
+    def validate_fields(self, value):
+        try:
+            return parse_content_fields(value)
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
+    def validate(self, attrs):
+        if "cursor" in attrs and "offset" in self.initial_data:
+            raise serializers.ValidationError("offsetとcursorは併用できません")
+        return attrs
+
+
+def test_content_list_query_serializer_defaults():
+    serializer = ContentListQuerySerializer(data={})
+    assert serializer.is_valid()
+    assert serializer.validated_data == {"offset": 0, "limit": 20}
+
+
+def test_content_list_query_serializer_rejects_large_limit():
+    serializer = ContentListQuerySerializer(data={"limit": 1000})
+    assert not serializer.is_valid()
+    assert "limit" in serializer.errors
+
+
+def test_content_list_query_serializer_cursor():
+    cursor = Cursor(timezone.now(), 1)
+    serializer = ContentListQuerySerializer(data={"cursor": cursor.encode()})
+    assert serializer.is_valid()
+    assert serializer.validated_data["cursor"] == cursor
+
+    serializer = ContentListQuerySerializer(data={"cursor": "broken"})
+    assert not serializer.is_valid()
+    assert "cursor" in serializer.errors
+
+    serializer = ContentListQuerySerializer(
+        data={"cursor": cursor.encode(), "offset": 10}
+    )
+    assert not serializer.is_valid()
+
+
+def test_content_list_query_serializer_fields():
+    serializer = ContentListQuerySerializer(data={"fields": "id,title"})
+    assert serializer.is_valid()
+    assert serializer.validated_data["fields"] == ("id", "title")
+    serializer = ContentListQuerySerializer(data={"fields": "content.title"})
+    assert not serializer.is_valid()
+    assert "fields" in serializer.errors
+
+
+class SpaceQuerySerializer(serializers.Serializer):
+    """
+    Spaceのエンドポイントのクエリパラメータを検証する
+    fields: 出力するキー、content.titleのようにContentのキーも指定できる (app.fields)
+    """
+
+    fields = serializers.CharField(required=False, allow_blank=True)
+
+    def validate_fields(self, value):
+        try:
+            return parse_space_fields(value)
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
+
+class ChangeFeedQuerySerializer(serializers.Serializer):
+    """
+    変更の取得(app.changes)のクエリパラメータを検証する
+    since: 前回のレスポンスのnext("xact_id.id"かid)、0なら最初から
+        (xact_id, id)のタプルにする、idのみならxact_idはNone(app.changes)
+    limit: 1回に読む記録の件数、1以上MAX_LIMIT以下
+    """
+
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    since = serializers.RegexField(r"^\d+(\.\d+)?$", default="0")
+    limit = serializers.IntegerField(
+        min_value=1, max_value=MAX_LIMIT, default=DEFAULT_LIMIT
+    )
+
+    def validate_since(self, value):
+        xact_id, _, pk = value.rpartition(".")
+        return int(xact_id) if xact_id else None, int(pk)
+
+
+class ContentIngestSerializer(serializers.Serializer):
+    """
+    一括登録(app.ingest)の1行を検証する
+    title: Contentのタイトル
+    model: Structureのid
+    status: Statusの名前 (draft, review, published, archived)、省略時はContentの既定値
+    custom_fields: modelのschemaで定義したフィールドの値
+    scheduled_at: 予約公開の日時 (app.scheduler)
+    Structure, Statusの存在確認とcustom_fieldsの検証はバッチ単位でまとめて行う
+    """
+
+    title = serializers.CharField(max_length=100)
+    model = serializers.IntegerField(required=False, allow_null=True)
+    status = serializers.CharField(required=False, max_length=100)
+    custom_fields = serializers.DictField(required=False)
+    scheduled_at = serializers.DateTimeField(required=False, allow_null=True)
+
+
+def test_content_ingest_serializer():
+    serializer = ContentIngestSerializer(
+        data={"title": "Test Content", "status": "draft"}
+    )
+    assert serializer.is_valid()
+    serializer = ContentIngestSerializer(data={"title": "x" * 101, "model": "news"})
+    assert not serializer.is_valid()
+    assert set(serializer.errors) == {"title", "model"}
+
+
+class StatusNameField(serializers.Field):
+    """status_idをStatusRegistryで名前に変換する (Statusへのクエリなし)"""
+
+    def __init__(self, **kwargs):
+        kwargs.update(source="status_id", read_only=True)
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return status_registry.name(value)
+
+
+class ContentListSerializer(serializers.ListSerializer):
+    """ページ内の全てのContentのreferenceフィールドをまとめて展開する"""
+
+    def to_representation(self, data):
+        items = super().to_representation(data)
+        items = references.get_reference_loader().resolve(items)
+        fields = self.child.selected_fields
+        if fields is None:
+            return items
+        return [project(item, fields) for item in items]
+
+
 class ContentSerializer(serializers.ModelSerializer):
     """
     dataを返すシリアライザ
@@ -109,9 +299,37 @@ class ContentSerializer(serializers.ModelSerializer):
     ]
     """
 
+    _status = StatusNameField()
+
     class Meta:
         model = Content
-        fields = "__all__"
+        # カスタムフィールドはto_representationで同じ階層に展開する
+        # 予約公開の日時は出力しない (app.scheduler)
+        exclude = ["custom_fields", "scheduled_at"]
+        list_serializer_class = ContentListSerializer
+
+    def __init__(self, *args, fields=None, **kwargs):
+        """fields: 出力するキー、Noneなら全て (app.fields)"""
+        super().__init__(*args, **kwargs)
+        self.selected_fields = fields
+        self.with_custom_fields = True
+        if fields is not None:
+            # 出力に使わないフィールドを除き、.only()で取得していない列を読まない
+            keys = content_keys(fields)
+            for name in set(self.fields) - keys:
+                self.fields.pop(name)
+            self.with_custom_fields = not keys <= CONTENT_COLUMNS.keys()
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.with_custom_fields:
+            schema = structure_registry.get(instance.model_id) or EMPTY_SCHEMA
+            data.update(schema.represent(instance.custom_fields))
+        if not isinstance(self.parent, ContentListSerializer):
+            # 1件のみの場合もreferenceフィールドを展開する
+            data = references.get_reference_loader().resolve([data])[0]
+            data = project(data, self.selected_fields)
+        return data
 
 
 @pytest.mark.django_db
@@ -134,6 +352,7 @@ def test_content_serializer():
         "updated_at": content.updated_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
         "published_at": content.published_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
         "status": status.id,
+        "_status": "draft",
     }
 
 
@@ -159,6 +378,20 @@ class SpaceSerializer(serializers.ModelSerializer):
         model = Space
         fields = "id", "content"
 
+    def __init__(self, *args, fields=None, content_fields=None, **kwargs):
+        """
+        fields: 出力するSpaceのキー、content_fields: 出力するContentのキー
+        Noneなら全て (app.fields)
+        """
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+        if content_fields is not None and "content" in self.fields:
+            self.fields["content"] = ContentSerializer(
+                read_only=True, many=True, fields=content_fields
+            )
+
 
 class TestSpaceSerializer:
     """
@@ -252,6 +485,249 @@ class TestSpaceSerializer:
                         "%Y-%m-%dT%H:%M:%S.%fZ"
                     ),
                     "status": self.content.status.id,
+                    "_status": "draft",
                 }
             ],
         }
+
+
+def datetime_formatter(native=False):
+    """
+    DateTimeField.to_representationと同じ文字列を返す関数を作る
+    UTCのISO 8601(デフォルト設定)ではタイムゾーン変換と設定の参照を省略する
+    native: UTCのISO 8601ならdatetimeのまま返す(レンダラーが同じ文字列にする)
+    """
+    field = serializers.DateTimeField()
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    field_timezone = field.default_timezone()
+    if (
+        output_format is None
+        or output_format.lower() != ISO_8601
+        or getattr(field_timezone, "key", None) != "UTC"
+    ):
+        return field.to_representation
+    if native:
+        return _native_datetime
+
+    def format_utc(value):
+        if value is None:
+            return None
+        value = value.isoformat()
+        if value.endswith("+00:00"):
+            return value[:-6] + "Z"
+        return value
+
+    return format_utc
+
+
+def _native_datetime(value):
+    return value
+
+
+class FastContentSerializer:
+    """
+    ContentSerializerと同じ出力を.values_list()の行から組み立てる
+    フィールドオブジェクトを経由しないため、大量の行を返すときに使う(opt-in)
+    settings.FAST_SERIALIZATIONで一覧系のビューが切り替わる
+
+    instance: Contentのクエリセット、またはcolumns順の行
+    resolve_references: referenceフィールドを展開する(app.references)
+    fields: 出力するキー、指定時の行はrows(queryset, fields)で取得する(app.fields)
+    native_datetimes: datetimeを文字列にしない(app.renderers)
+    """
+
+    columns = (
+        "id",
+        "title",
+        "created_at",
+        "updated_at",
+        "published_at",
+        "model_id",
+        "status_id",
+        "custom_fields",
+    )
+
+    def __init__(
+        self,
+        instance,
+        many=False,
+        resolve_references=True,
+        fields=None,
+        native_datetimes=False,
+    ):
+        self.instance = instance
+        self.many = many
+        self.resolve_references = resolve_references
+        self.fields = fields
+        self.keys = None if fields is None else content_keys(fields)
+        self.format_datetime = datetime_formatter(native_datetimes)
+
+    @classmethod
+    def rows(cls, queryset, fields=None, extra=()):
+        """
+        (published_at, id)を属性で参照できる行のクエリセットを返す
+        fields: 出力するキー、必要な列とextraの列のみを取得する
+        """
+        if fields is None:
+            return queryset.values_list(*cls.columns, named=True)
+        return queryset.values_list(*content_columns(fields, extra), named=True)
+
+    def to_representation(self, row):
+        if self.keys is not None:
+            return self._partial_representation(row._asdict())
+        (
+            pk,
+            title,
+            created_at,
+            updated_at,
+            published_at,
+            model_id,
+            status_id,
+            custom_fields,
+        ) = row
+        format_datetime = self.format_datetime
+        # ModelSerializerと同じく、id, 宣言したフィールド, 通常のフィールド, 外部キーの順
+        data = {
+            "id": pk,
+            "_status": status_registry.name(status_id),
+            "title": title,
+            "created_at": format_datetime(created_at),
+            "updated_at": format_datetime(updated_at),
+            "published_at": format_datetime(published_at),
+            "model": model_id,
+            "status": status_id,
+        }
+        if model_id is not None:
+            schema = structure_registry.get(model_id) or EMPTY_SCHEMA
+            data.update(schema.represent(custom_fields))
+        return data
+
+    def _partial_representation(self, values):
+        """fields指定時、取得した列のみから出力を組み立てる"""
+        data = {}
+        for key, column in CONTENT_COLUMNS.items():
+            if key not in self.keys:
+                continue
+            value = values[column]
+            if key == "_status":
+                value = status_registry.name(value)
+            elif column.endswith("_at"):
+                value = self.format_datetime(value)
+            data[key] = value
+        model_id = values.get("model_id")
+        if model_id is not None and "custom_fields" in values:
+            schema = structure_registry.get(model_id) or EMPTY_SCHEMA
+            data.update(schema.represent(values["custom_fields"]))
+        return data
+
+    @property
+    def data(self):
+        if not self.many:
+            items = [self.to_representation(self.instance)]
+        else:
+            rows = self.instance
+            if isinstance(rows, QuerySet) and not rows._fields:
+                rows = self.rows(rows, self.fields)
+            items = [self.to_representation(row) for row in rows]
+        if self.resolve_references:
+            items = references.get_reference_loader().resolve(items)
+        if self.fields is not None:
+            items = [project(item, self.fields) for item in items]
+        return items if self.many else items[0]
+
+
+class FastSpaceSerializer:
+    """SpaceSerializerと同じ出力をFastContentSerializerで組み立てる"""
+
+    def __init__(
+        self, instance, fields=None, content_fields=None, native_datetimes=False
+    ):
+        self.instance = instance
+        self.fields = fields
+        self.content_fields = content_fields
+        self.native_datetimes = native_datetimes
+
+    @property
+    def data(self):
+        data = {}
+        if self.fields is None or "id" in self.fields:
+            data["id"] = self.instance.id
+        if self.fields is None or "content" in self.fields:
+            data["content"] = FastContentSerializer(
+                self.instance.content.all(),
+                many=True,
+                fields=self.content_fields,
+                native_datetimes=self.native_datetimes,
+            ).data
+        return data
+
+
+class TestFastSerializer:
+    """
+    FastContentSerializer, FastSpaceSerializerの出力が
+    ContentSerializer, SpaceSerializerとJSONでバイト単位で一致することを確認する
+    """
+
+    def setup_method(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.status = Status.objects.create(status="draft")
+        self.contents = [
+            Content.objects.create(title="Test Content", status=self.status),
+            Content.objects.create(title="テスト Content", status=self.status),
+        ]
+        self.space.content.set(self.contents)
+
+    @pytest.mark.django_db
+    def test_fast_content_serializer(self):
+        queryset = Content.objects.order_by("id")
+        renderer = JSONRenderer()
+        assert renderer.render(
+            FastContentSerializer(queryset, many=True).data
+        ) == renderer.render(ContentSerializer(queryset, many=True).data)
+
+    @pytest.mark.django_db
+    def test_fast_content_serializer_custom_fields(self):
+        news = Structure.objects.create(
+            name="news",
+            description="",
+            schema=[
+                {"key": "body", "type": "multiline"},
+                {"key": "price", "type": "number"},
+            ],
+        )
+        Content.objects.filter(pk=self.contents[0].pk).update(
+            model=news, custom_fields={"price": 10, "body": "本文"}
+        )
+        queryset = Content.objects.order_by("id")
+        renderer = JSONRenderer()
+        expected = renderer.render(ContentSerializer(queryset, many=True).data)
+        assert renderer.render(FastContentSerializer(queryset, many=True).data) == (
+            expected
+        )
+        assert b'"status":%d,"body":"' % self.status.id in expected
+
+    @pytest.mark.django_db
+    def test_fast_content_serializer_row(self):
+        row = FastContentSerializer.rows(Content.objects.filter(pk=self.contents[0].pk))
+        assert (
+            FastContentSerializer(row.get()).data
+            == ContentSerializer(self.contents[0]).data
+        )
+
+    @pytest.mark.django_db
+    def test_fast_space_serializer(self):
+        renderer = JSONRenderer()
+        assert renderer.render(FastSpaceSerializer(self.space).data) == renderer.render(
+            SpaceSerializer(self.space).data
+        )
+
+
+def test_datetime_formatter():
+    value = timezone.now()
+    field = serializers.DateTimeField()
+    assert datetime_formatter()(value) == field.to_representation(value)
+    assert datetime_formatter()(value.replace(microsecond=0)) == (
+        field.to_representation(value.replace(microsecond=0))
+    )
+    assert datetime_formatter()(None) is None
+    assert datetime_formatter(native=True)(value) is value
@@ -0,0 +1,184 @@
+"""
+モデルの変更をSpaceのキャッシュとStatus, Structure, Planのレジストリに伝える
+"""
+
+import pytest
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from app.cache import get_space_cache
+from app.conditional import space_validator
+from app.models import Content, Plan, Space, Status, Structure, User
+from app.references import referencing_content_ids
+from app.registry import status_registry
+from app.structures import structure_registry
+from app.throttling import plan_registry
+
+SpaceContent = Space.content.through
+
+
+def invalidate_spaces(space_ids, touch=True):
+    """
+    Spaceのバージョンを直後とコミット時の2回進める
+    直後: 同じトランザクション内で古いデータを読まないようにする
+    コミット時: コミット前に他のリクエストが保存したデータを捨てる
+    touch: Spaceのupdated_atを進め、検証子(app.conditional)を変える
+           Statusの名前、参照先、schema、所属の変更はContentのupdated_atに現れないため
+           Spaceの行は書き込みが集中するため、Content自身の変更では進めない
+    """
+    space_ids = set(space_ids)
+    if not space_ids:
+        return
+    if touch:
+        touch_spaces(space_ids)
+    cache = get_space_cache()
+    cache.invalidate(*space_ids)
+    transaction.on_commit(lambda: cache.invalidate(*space_ids))
+
+
+def touch_spaces(space_ids):
+    """
+    Spaceのupdated_atを進める
+    UPDATEの行ロックの順序は決まらないため、先にidの順にロックしてデッドロックを防ぐ
+    """
+    with transaction.atomic():
+        locked = list(
+            Space.objects.select_for_update()
+            .filter(pk__in=space_ids)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        Space.objects.filter(pk__in=locked).update(updated_at=timezone.now())
+
+
+def _content_space_ids(content_ids):
+    return SpaceContent.objects.filter(content_id__in=content_ids).values_list(
+        "space_id", flat=True
+    )
+
+
+def _affected_space_ids(content_id):
+    """
+    @return (Contentが属するSpace, 参照フィールドで展開しているContentのSpace)
+    """
+    space_ids = set(_content_space_ids([content_id]))
+    referencing = referencing_content_ids([content_id])
+    if not referencing:
+        return space_ids, set()
+    return space_ids, set(_content_space_ids(referencing)) - space_ids
+
+
+def _invalidate_affected(space_ids, referencing_space_ids, touch=False):
+    # 属するSpaceの検証子はContentのupdated_at、件数、idの合計で変わる
+    invalidate_spaces(space_ids, touch=touch)
+    invalidate_spaces(referencing_space_ids)
+
+
+@receiver(post_save, sender=Space)
+@receiver(post_delete, sender=Space)
+def space_changed(sender, instance, **kwargs):
+    # 保存でupdated_atは進んでいる
+    invalidate_spaces([instance.pk], touch=False)
+
+
+@receiver(post_save, sender=Content)
+def content_saved(sender, instance, created, update_fields=None, **kwargs):
+    # 作成直後はどのSpaceにも属していない
+    if not created:
+        # update_fieldsにupdated_atがなければauto_nowが働かない
+        touch = update_fields is not None and "updated_at" not in update_fields
+        _invalidate_affected(*_affected_space_ids(instance.pk), touch=touch)
+
+
+@receiver(pre_delete, sender=Content)
+def content_deleting(sender, instance, **kwargs):
+    # 削除後は中間テーブルの行も消えているため、削除前にSpaceを集める
+    instance._space_ids = _affected_space_ids(instance.pk)
+
+
+@receiver(post_delete, sender=Content)
+def content_deleted(sender, instance, **kwargs):
+    _invalidate_affected(*getattr(instance, "_space_ids", ((), ())))
+
+
+@receiver(post_save, sender=Status)
+@receiver(post_delete, sender=Status)
+def status_changed(sender, instance, **kwargs):
+    status_registry.invalidate()
+    transaction.on_commit(status_registry.invalidate)
+    invalidate_spaces(
+        SpaceContent.objects.filter(content__status_id=instance.pk)
+        .values_list("space_id", flat=True)
+        .distinct()
+    )
+
+
+@receiver(post_save, sender=Structure)
+@receiver(post_delete, sender=Structure)
+def structure_changed(sender, instance, **kwargs):
+    # schemaが変わるとContentの出力が変わる
+    structure_registry.invalidate(instance.pk)
+    transaction.on_commit(lambda: structure_registry.invalidate(instance.pk))
+    invalidate_spaces(
+        SpaceContent.objects.filter(content__model_id=instance.pk)
+        .values_list("space_id", flat=True)
+        .distinct()
+    )
+
+
+@receiver(m2m_changed, sender=SpaceContent)
+def space_content_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # space.content.add(...)など、instanceはSpace
+        if action in ("post_add", "post_remove", "post_clear"):
+            invalidate_spaces([instance.pk])
+    elif action == "pre_clear":
+        # content.spaces.clear()、pk_setがNoneのため消す前に集める
+        instance._cleared_space_ids = list(_content_space_ids([instance.pk]))
+    elif action == "post_clear":
+        invalidate_spaces(getattr(instance, "_cleared_space_ids", []))
+    elif action in ("post_add", "post_remove"):
+        invalidate_spaces(pk_set)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # Planの変更をレート制限に反映する
+    plan_registry.invalidate(instance.pk)
+    transaction.on_commit(lambda: plan_registry.invalidate(instance.pk))
+
+
+@receiver(post_save, sender=Plan)
+@receiver(post_delete, sender=Plan)
+def plan_changed(sender, instance, **kwargs):
+    plan_registry.invalidate()
+    transaction.on_commit(plan_registry.invalidate)
+
+
+@pytest.mark.django_db
+def test_content_save_does_not_touch_space():
+    space = Space.objects.create(name="Space")
+    content = Content.objects.create(
+        title="Content", status=Status.objects.create(status="draft")
+    )
+    space.content.add(content)
+    updated_at = Space.objects.get(pk=space.pk).updated_at
+    before = space_validator(space.pk)
+    content.title = "Renamed"
+    content.save()
+    # Contentのupdated_atで検証子が変わり、Spaceの行は更新しない
+    assert Space.objects.get(pk=space.pk).updated_at == updated_at
+    assert space_validator(space.pk) != before
+
+
+@pytest.mark.django_db
+def test_touch_spaces_locks_in_order():
+    spaces = [Space.objects.create(name=f"Space {i}") for i in range(3)]
+    with CaptureQueriesContext(connection) as queries:
+        touch_spaces({space.pk for space in spaces})
+    select = next(q["sql"] for q in queries if q["sql"].startswith("SELECT"))
+    assert "ORDER BY" in select
@@ -0,0 +1,395 @@
+"""
+Spaceのスナップショット (settings.SPACE_SNAPSHOTS)
+Spaceの読み取り結果をSpaceSnapshotに保持し、読み取りを主キーの検索1回にする
+Content, Status, Spaceの所属の変更時は、変更されたContentの行だけを同じトランザクション内で書き換える
+
+Contentの行はFastContentSerializerの出力の値をCONTENT_KEYSの順に並べ、
+カスタムフィールドを[キー, 値]の配列で続けた配列で保持する
+(PostgreSQLのjsonbはオブジェクトのキーの順序を保持しないため)
+bulk_createなどシグナルが送られない変更では、update_snapshotsを直接呼ぶこと
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.test import TestCase, override_settings
+
+from app.models import Content, Space, SpaceSnapshot, Status, Structure
+from app.references import get_reference_loader
+from app.serializer import FastContentSerializer, SpaceSerializer
+from app.structures import structure_registry
+
+SpaceContent = Space.content.through
+
+# FastContentSerializer.to_representationのキーの順
+CONTENT_KEYS = (
+    "id",
+    "_status",
+    "title",
+    "created_at",
+    "updated_at",
+    "published_at",
+    "model",
+    "status",
+)
+_STATUS_ID = CONTENT_KEYS.index("status")
+_STATUS_NAME = CONTENT_KEYS.index("_status")
+
+
+def enabled():
+    return getattr(settings, "SPACE_SNAPSHOTS", False)
+
+
+def _content_row(data):
+    # CONTENT_KEYSの値の後に、カスタムフィールドを[キー, 値]の配列で置く
+    values = list(data.values())
+    fixed = len(CONTENT_KEYS)
+    return values[:fixed] + [[[key, data[key]] for key in list(data)[fixed:]]]
+
+
+def _content_rows(queryset):
+    """Contentのクエリセットをスナップショットの行(idの昇順)にする"""
+    # referenceフィールドはidのまま保持し、読み取り時に展開する
+    serializer = FastContentSerializer(
+        queryset.order_by("id"), many=True, resolve_references=False
+    )
+    return [_content_row(data) for data in serializer.data]
+
+
+def _content_data(row):
+    data = dict(zip(CONTENT_KEYS, row))
+    data.update(row[len(CONTENT_KEYS)])
+    return data
+
+
+def snapshot_payload(snapshot):
+    """SpaceSnapshotからSpaceSerializerと同じ形のdictを作る"""
+    return {
+        "id": snapshot["space_id"],
+        "content": [_content_data(row) for row in snapshot["content"]],
+    }
+
+
+def get_snapshot(space_id):
+    """
+    Spaceの読み取り結果を主キーの検索1回で返す
+    スナップショットがなければ作成する、Spaceがなければ None
+    """
+    snapshot = SpaceSnapshot.objects.filter(pk=space_id).values("space_id", "content")
+    snapshot = next(iter(snapshot), None) or rebuild_snapshot(space_id)
+    if not snapshot:
+        return None
+    payload = snapshot_payload(snapshot)
+    payload["content"] = get_reference_loader().resolve(payload["content"])
+    return payload
+
+
+async def aget_snapshot(space_id):
+    """get_snapshotの非同期版"""
+    snapshot = None
+    async for snapshot in SpaceSnapshot.objects.filter(pk=space_id).values(
+        "space_id", "content"
+    ):
+        break
+    snapshot = snapshot or await sync_to_async(rebuild_snapshot)(space_id)
+    if not snapshot:
+        return None
+    payload = snapshot_payload(snapshot)
+    payload["content"] = await get_reference_loader().aresolve(payload["content"])
+    return payload
+
+
+def rebuild_snapshot(space_id):
+    """Spaceのスナップショットを作り直す、Spaceがなければ None"""
+    if not Space.objects.filter(pk=space_id).exists():
+        return None
+    content = _content_rows(Content.objects.filter(spaces=space_id))
+    SpaceSnapshot.objects.update_or_create(
+        space_id=space_id, defaults={"content": content}
+    )
+    return {"space_id": space_id, "content": content}
+
+
+def _rebuild_in_thread(space_id):
+    try:
+        return rebuild_snapshot(space_id)
+    finally:
+        # スレッドごとの接続を閉じる
+        connection.close()
+
+
+def rebuild_all(space_ids=None, workers=4):
+    """
+    Spaceのスナップショットをworkers個のスレッドで並列に作り直す
+    space_ids: 省略時は全てのSpace
+    @return 作り直した件数
+    """
+    if space_ids is None:
+        space_ids = Space.objects.order_by("id").values_list("id", flat=True)
+    space_ids = list(space_ids)
+    if workers <= 1:
+        results = map(rebuild_snapshot, space_ids)
+        return sum(result is not None for result in results)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_rebuild_in_thread, space_ids)
+        return sum(result is not None for result in results)
+
+
+def lock_snapshots(space_ids):
+    """
+    space_idsのスナップショットをspace_idの順にロックする (トランザクション内で呼ぶ)
+    複数のSpaceを更新するワーカー同士がデッドロックしないよう、常に同じ順で取る
+    space_ids: idの集合かクエリセット
+    """
+    return (
+        SpaceSnapshot.objects.select_for_update()
+        .filter(space_id__in=space_ids)
+        .order_by("space_id")
+    )
+
+
+def update_snapshots(space_ids, content_ids=(), removed_ids=()):
+    """
+    space_idsのスナップショットの行を差し替える
+    content_ids: 追加、または更新されたContent (space_idsの全てに属していること)
+    removed_ids: space_idsから外れた、または削除されたContent
+    スナップショットがないSpaceは作り直す
+    """
+    space_ids = set(space_ids)
+    if not enabled() or not space_ids:
+        return
+    rows = (
+        _content_rows(Content.objects.filter(id__in=content_ids)) if content_ids else []
+    )
+    removed = set(removed_ids) | {row[0] for row in rows}
+    with transaction.atomic():
+        snapshots = lock_snapshots(space_ids)
+        for snapshot in snapshots:
+            content = [row for row in snapshot.content if row[0] not in removed]
+            snapshot.content = sorted(content + rows, key=lambda row: row[0])
+            snapshot.save(update_fields=["content", "updated_at"])
+            space_ids.discard(snapshot.space_id)
+        for space_id in space_ids:
+            rebuild_snapshot(space_id)
+
+
+def rename_status(status_id, name):
+    """Statusの名前を、そのStatusのContentを持つスナップショットに反映する"""
+    with transaction.atomic():
+        space_ids = SpaceContent.objects.filter(content__status_id=status_id).values(
+            "space_id"
+        )
+        snapshots = lock_snapshots(space_ids)
+        for snapshot in snapshots:
+            for row in snapshot.content:
+                if row[_STATUS_ID] == status_id:
+                    row[_STATUS_NAME] = name
+            snapshot.save(update_fields=["content", "updated_at"])
+
+
+def diff_snapshot(space_id):
+    """
+    スナップショットとSpaceSerializerによる現在の出力を比較する
+    @return 差分の説明のリスト、一致していれば空
+    """
+    live = SpaceSerializer(Space.objects.get(pk=space_id)).data
+    snapshot = SpaceSnapshot.objects.filter(pk=space_id).values("space_id", "content")
+    snapshot = next(iter(snapshot), None)
+    if snapshot is None:
+        return ["missing snapshot"]
+    expected = {row["id"]: dict(row) for row in live["content"]}
+    content = get_reference_loader().resolve(snapshot_payload(snapshot)["content"])
+    actual = {row["id"]: row for row in content}
+    differences = []
+    for content_id in sorted(expected.keys() - actual.keys()):
+        differences.append(f"content {content_id}: missing")
+    for content_id in sorted(actual.keys() - expected.keys()):
+        differences.append(f"content {content_id}: unexpected")
+    for content_id in sorted(expected.keys() & actual.keys()):
+        for key, value in expected[content_id].items():
+            if actual[content_id].get(key) != value:
+                differences.append(
+                    f"content {content_id}: {key} {actual[content_id].get(key)!r}"
+                    f" != {value!r}"
+                )
+    return differences
+
+
+def _content_space_ids(content_id):
+    return list(
+        SpaceContent.objects.filter(content_id=content_id).values_list(
+            "space_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Space)
+def space_saved(sender, instance, created, **kwargs):
+    # スナップショットはidとContentのみのため、作成時だけ作る
+    if created and enabled():
+        SpaceSnapshot.objects.get_or_create(space=instance)
+
+
+@receiver(post_save, sender=Content)
+def content_saved(sender, instance, created, **kwargs):
+    if not created and enabled():
+        update_snapshots(_content_space_ids(instance.pk), [instance.pk])
+
+
+@receiver(pre_delete, sender=Content)
+def content_deleting(sender, instance, **kwargs):
+    if enabled():
+        instance._snapshot_space_ids = _content_space_ids(instance.pk)
+
+
+@receiver(post_delete, sender=Content)
+def content_deleted(sender, instance, **kwargs):
+    update_snapshots(
+        getattr(instance, "_snapshot_space_ids", []), removed_ids=[instance.pk]
+    )
+
+
+@receiver(post_save, sender=Status)
+def status_saved(sender, instance, created, **kwargs):
+    # Statusの削除はContentの削除として反映される
+    if not created and enabled():
+        rename_status(instance.pk, instance.status)
+
+
+@receiver(post_save, sender=Structure)
+def structure_saved(sender, instance, created, **kwargs):
+    # schemaの変更はそのStructureのContentの全ての行に影響する
+    # 削除はContentの削除として反映される
+    if created or not enabled():
+        return
+    structure_registry.invalidate(instance.pk)
+    space_ids = (
+        SpaceContent.objects.filter(content__model_id=instance.pk)
+        .values_list("space_id", flat=True)
+        .distinct()
+    )
+    for space_id in space_ids:
+        rebuild_snapshot(space_id)
+
+
+@receiver(m2m_changed, sender=SpaceContent)
+def space_content_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not enabled():
+        return
+    if not reverse:
+        # space.content.add(...)など、instanceはSpace
+        if action == "post_add":
+            update_snapshots([instance.pk], content_ids=pk_set)
+        elif action == "post_remove":
+            update_snapshots([instance.pk], removed_ids=pk_set)
+        elif action == "post_clear":
+            rebuild_snapshot(instance.pk)
+    elif action == "pre_clear":
+        instance._snapshot_space_ids = _content_space_ids(instance.pk)
+    elif action == "post_clear":
+        update_snapshots(
+            getattr(instance, "_snapshot_space_ids", []), removed_ids=[instance.pk]
+        )
+    elif action == "post_add":
+        update_snapshots(pk_set, content_ids=[instance.pk])
+    elif action == "post_remove":
+        update_snapshots(pk_set, removed_ids=[instance.pk])
+
+
+@override_settings(SPACE_SNAPSHOTS=True)
+class TestSpaceSnapshot(TestCase):
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.draft = Status.objects.create(status="draft")
+        self.contents = [
+            Content.objects.create(title=f"Test Content {i}", status=self.draft)
+            for i in range(3)
+        ]
+        self.space.content.set(self.contents)
+
+    def assert_consistent(self):
+        assert diff_snapshot(self.space.id) == []
+
+    def test_content_keys(self):
+        row = FastContentSerializer(Content.objects.all(), many=True).data[0]
+        assert tuple(row) == CONTENT_KEYS
+
+    def test_read_is_one_query(self):
+        with self.assertNumQueries(1):
+            payload = get_snapshot(self.space.id)
+        assert payload == SpaceSerializer(self.space).data
+        assert get_snapshot(self.space.id + 1) is None
+
+        # 有効にする前のSpaceは最初の読み取りで作る
+        SpaceSnapshot.objects.all().delete()
+        assert get_snapshot(self.space.id) == payload
+        assert SpaceSnapshot.objects.filter(pk=self.space.id).exists()
+
+    def test_incremental_updates(self):
+        self.assert_consistent()
+        content = self.contents[0]
+        content.title = "Updated Content"
+        content.save()
+        self.assert_consistent()
+
+        self.space.content.remove(self.contents[1])
+        self.assert_consistent()
+        self.contents[1].spaces.add(self.space)
+        self.assert_consistent()
+        self.contents[2].spaces.clear()
+        self.assert_consistent()
+
+        self.draft.status = "review"
+        self.draft.save()
+        self.assert_consistent()
+        assert get_snapshot(self.space.id)["content"][0]["_status"] == "review"
+
+        self.contents[0].delete()
+        self.assert_consistent()
+        self.space.content.clear()
+        self.assert_consistent()
+        assert get_snapshot(self.space.id)["content"] == []
+
+    def test_only_changed_rows_are_serialized(self):
+        others = Content.objects.bulk_create(
+            [Content(title=f"Other {i}", status=self.draft) for i in range(20)]
+        )
+        self.space.content.add(*others)
+        content = self.contents[0]
+        # シグナルが送られない更新
+        Content.objects.filter(pk=content.pk).update(title="Updated Content")
+        assert diff_snapshot(self.space.id) != []
+        # 変更されたContentの取得, SAVEPOINT, スナップショットのロックと更新, RELEASE
+        # Spaceに属するContentの件数によらない
+        with self.assertNumQueries(5):
+            update_snapshots([self.space.id], [content.pk])
+        self.assert_consistent()
+
+    def test_custom_fields(self):
+        news = Structure.objects.create(
+            name="news", description="", schema=[{"key": "body", "type": "multiline"}]
+        )
+        content = self.contents[0]
+        content.model = news
+        content.custom_fields = {"body": "foo"}
+        content.save()
+        self.assert_consistent()
+        assert get_snapshot(self.space.id)["content"][0]["body"] == "foo"
+
+        news.schema = [{"key": "summary", "type": "singleline"}] + news.schema
+        news.save()
+        self.assert_consistent()
+        row = get_snapshot(self.space.id)["content"][0]
+        assert list(row)[len(CONTENT_KEYS) :] == ["summary", "body"]
+
+    def test_diff_snapshot(self):
+        SpaceSnapshot.objects.filter(pk=self.space.id).update(content=[])
+        assert diff_snapshot(self.space.id) == [
+            f"content {content.id}: missing" for content in self.contents
+        ]
+        assert rebuild_all(workers=1) == 1
+        self.assert_consistent()
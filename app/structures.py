@@ -0,0 +1,663 @@
+"""
+Structureで定義するカスタムフィールド
+Structure.schemaのフィールド定義をCompiledSchemaにコンパイルし、
+Content.custom_fieldsの検証と出力に使う
+コンパイル結果はStructureごとにプロセス内で保持し、保存・削除時はapp.signalsで破棄する
+
+フィールド定義
+    {"key": "price", "type": "number", "required": true, "indexed": true}
+type: singleline, multiline, flexibletext, boolean, number, singleselect(options),
+      datetime, media, reference, block(fields), repeat(fields), combination(blocks)
+indexed: PostgreSQLで式インデックスを作る (sync_custom_field_indexes)
+    datetimeはIMMUTABLEなapp_custom_field_timestamptz(マイグレーション0009)でキャストする
+"""
+
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from django.core.exceptions import ValidationError as ModelValidationError
+from django.db import connection
+from django.db.models import DateTimeField, FloatField, Func, TextField
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast
+from rest_framework.exceptions import ValidationError
+
+from app.models import Content, Status, Structure
+
+FIELD_TYPES = {}
+
+
+def field_type(name):
+    """FIELD_TYPESに登録するデコレータ、関数は(定義) -> 値の検証関数を返す"""
+
+    def decorator(func):
+        FIELD_TYPES[name] = func
+        return func
+
+    return decorator
+
+
+def _check(condition, message):
+    if not condition:
+        raise ValueError(message)
+
+
+def _string(multiline):
+    def validate(value):
+        _check(isinstance(value, str), "文字列を指定してください")
+        _check(multiline or "\n" not in value, "改行は使えません")
+        return value
+
+    return validate
+
+
+field_type("singleline")(lambda definition: _string(multiline=False))
+field_type("multiline")(lambda definition: _string(multiline=True))
+field_type("flexibletext")(lambda definition: _string(multiline=True))
+
+
+@field_type("boolean")
+def _boolean(definition):
+    def validate(value):
+        _check(isinstance(value, bool), "真偽値を指定してください")
+        return value
+
+    return validate
+
+
+@field_type("number")
+def _number(definition):
+    def validate(value):
+        _check(
+            isinstance(value, (int, float)) and not isinstance(value, bool),
+            "数値を指定してください",
+        )
+        return value
+
+    return validate
+
+
+@field_type("singleselect")
+def _singleselect(definition):
+    options = frozenset(definition.get("options", ()))
+
+    def validate(value):
+        _check(value in options, f"{sorted(options)}のいずれかを指定してください")
+        return value
+
+    return validate
+
+
+@field_type("datetime")
+def _datetime(definition):
+    def validate(value):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError("ISO 8601の日時を指定してください")
+        _check(parsed.tzinfo is not None, "タイムゾーンを指定してください")
+        return value
+
+    return validate
+
+
+@field_type("media")
+def _media(definition):
+    def validate(value):
+        _check(
+            isinstance(value, dict) and isinstance(value.get("url"), str),
+            "urlを持つオブジェクトを指定してください",
+        )
+        _check(set(value) <= {"url", "alt"}, "url, alt以外は指定できません")
+        _check(isinstance(value.get("alt", ""), str), "altは文字列を指定してください")
+        return value
+
+    return validate
+
+
+@field_type("reference")
+def _reference(definition):
+    def validate(value):
+        _check(
+            isinstance(value, int) and not isinstance(value, bool),
+            "Contentのidを指定してください",
+        )
+        return value
+
+    return validate
+
+
+@field_type("block")
+def _block(definition):
+    schema = CompiledSchema(definition.get("fields", ()))
+    return schema.clean
+
+
+@field_type("repeat")
+def _repeat(definition):
+    schema = CompiledSchema(definition.get("fields", ()))
+
+    def validate(value):
+        _check(isinstance(value, list), "配列を指定してください")
+        return [schema.clean(item) for item in value]
+
+    return validate
+
+
+@field_type("combination")
+def _combination(definition):
+    blocks = {
+        luid: CompiledSchema(fields)
+        for luid, fields in definition.get("blocks", {}).items()
+    }
+
+    def validate(value):
+        _check(isinstance(value, list), "配列を指定してください")
+        cleaned = []
+        for item in value:
+            _check(
+                isinstance(item, dict) and item.get("luid") in blocks,
+                f"luidは{sorted(blocks)}のいずれかを指定してください",
+            )
+            fields = blocks[item["luid"]].clean(item.get("fields", {}))
+            cleaned.append({"luid": item["luid"], "fields": fields})
+        return cleaned
+
+    return validate
+
+
+class CompiledSchema:
+    """
+    フィールド定義のリストを、キーごとの検証関数にまとめたもの
+    定義の解釈はコンパイル時の1回だけで、行ごとには検証関数を呼ぶだけにする
+    """
+
+    def __init__(self, definitions, reserved=()):
+        self.keys = []
+        self.required = set()
+        self.indexed = []
+        self.references = []
+        self.types = {}
+        self._validators = {}
+        for definition in definitions:
+            if not isinstance(definition, dict) or not isinstance(
+                definition.get("key"), str
+            ):
+                raise TypeError(f"invalid field definition: {definition!r}")
+            key, kind = definition["key"], definition.get("type")
+            if kind not in FIELD_TYPES:
+                raise ValueError(f"unknown field type: {kind}")
+            if key in reserved:
+                raise ValueError(f"reserved field key: {key}")
+            if key in self.types:
+                raise ValueError(f"duplicate field key: {key}")
+            self.keys.append(key)
+            self.types[key] = kind
+            self._validators[key] = FIELD_TYPES[kind](definition)
+            if definition.get("required"):
+                self.required.add(key)
+            if definition.get("indexed"):
+                self.indexed.append(key)
+            if kind == "reference":
+                self.references.append(key)
+
+    def clean(self, values):
+        """
+        valuesを検証して返す
+        不正な値はフィールドごとのエラーを持つValidationErrorを送出する
+        """
+        if not isinstance(values, dict):
+            raise ValidationError(["オブジェクトを指定してください"])
+        errors = {}
+        cleaned = {}
+        for key in values.keys() - self._validators.keys():
+            errors[key] = ["定義されていないフィールドです"]
+        for key, validate in self._validators.items():
+            value = values.get(key)
+            if value is None:
+                if key in self.required:
+                    errors[key] = ["必須です"]
+                continue
+            try:
+                cleaned[key] = validate(value)
+            except ValueError as exc:
+                errors[key] = [str(exc)]
+            except ValidationError as exc:
+                errors[key] = exc.detail
+        if errors:
+            raise ValidationError(errors)
+        return cleaned
+
+    def represent(self, values):
+        """定義の順に全てのキーを並べる、値がなければ None"""
+        values = values or {}
+        return {key: values.get(key) for key in self.keys}
+
+
+EMPTY_SCHEMA = CompiledSchema(())
+
+# Contentの出力でカスタムフィールドと同じ階層に並ぶキー
+RESERVED_KEYS = frozenset(
+    ["id", "_status", "title", "created_at", "updated_at", "published_at"]
+    + ["model", "status"]
+)
+
+
+def validate_schema(schema):
+    """
+    Structure.schemaをコンパイルして検証する (Structure.clean, save)
+    不正な定義は読み取り時のレジストリではなく保存時にValidationErrorにする
+    """
+    if not isinstance(schema, list):
+        raise ModelValidationError({"schema": "フィールド定義の配列を指定してください"})
+    try:
+        return CompiledSchema(schema, reserved=RESERVED_KEYS)
+    except (AttributeError, TypeError, ValueError) as exc:
+        raise ModelValidationError({"schema": str(exc)})
+
+
+class StructureRegistry:
+    """
+    StructureごとのCompiledSchemaのプロセス内レジストリ
+    未読み込みのStructureはprepareでまとめて読み込む
+    ttl: 他のプロセスでのStructureの変更(schema, referenceフィールド)を反映するまでの秒数
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        # Structureのid: (CompiledSchema, 期限)
+        self._schemas = {}
+        # (期限, referenceフィールドのリスト)
+        self._references = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _queryset(self, structure_ids):
+        return Structure.objects.filter(id__in=structure_ids).values_list(
+            "id", "schema"
+        )
+
+    def _set(self, rows):
+        compiled = {
+            pk: CompiledSchema(schema or (), reserved=RESERVED_KEYS)
+            for pk, schema in rows
+        }
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._schemas.update(
+                {pk: (schema, expires) for pk, schema in compiled.items()}
+            )
+        return compiled
+
+    def _current(self, structure_id):
+        """期限内のCompiledSchema、なければNone"""
+        entry = self._schemas.get(structure_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def _missing(self, structure_ids):
+        return {
+            pk for pk in structure_ids if pk is not None and self._current(pk) is None
+        }
+
+    def prepare(self, structure_ids):
+        """
+        未読み込み・期限切れのStructureを1回のクエリで読み込む
+        @return 読み込んだ{Structureのid: CompiledSchema}
+        """
+        missing = self._missing(structure_ids)
+        return self._set(self._queryset(missing)) if missing else {}
+
+    async def aprepare(self, structure_ids):
+        """prepareの非同期版"""
+        missing = self._missing(structure_ids)
+        if not missing:
+            return {}
+        return self._set([row async for row in self._queryset(missing)])
+
+    def get(self, structure_id):
+        """StructureのCompiledSchema、存在しなければ None"""
+        if structure_id is None:
+            return EMPTY_SCHEMA
+        schema = self._current(structure_id)
+        if schema is None:
+            schema = self.prepare([structure_id]).get(structure_id)
+        return schema
+
+    def items(self):
+        """読み込み済みの(Structureのid, CompiledSchema)"""
+        return [(pk, entry[0]) for pk, entry in list(self._schemas.items())]
+
+    def reference_fields(self):
+        """
+        全Structureのreferenceフィールドの(Structureのid, キー)のリスト
+        invalidateかttl秒後まで保持し、その間はクエリを発行しない
+        """
+        references = self._references
+        if references is not None and references[0] > time.monotonic():
+            return references[1]
+        generation = self._generation
+        structure_ids = list(Structure.objects.values_list("id", flat=True))
+        loaded = self.prepare(structure_ids)
+        fields = []
+        for structure_id in structure_ids:
+            schema = loaded.get(structure_id) or self._current(structure_id)
+            if schema is not None:
+                fields.extend((structure_id, key) for key in schema.references)
+        with self._lock:
+            # 読み込み中に破棄された場合は保持しない
+            if generation == self._generation:
+                self._references = (time.monotonic() + self.ttl, fields)
+        return fields
+
+    def invalidate(self, structure_id=None):
+        with self._lock:
+            self._references = None
+            self._generation += 1
+            if structure_id is None:
+                self._schemas.clear()
+            else:
+                self._schemas.pop(structure_id, None)
+
+
+structure_registry = StructureRegistry()
+
+
+# ::timestamptzはSTABLEで式インデックスに使えないため、IMMUTABLEの関数で包む
+TIMESTAMPTZ_FUNCTION = "app_custom_field_timestamptz"
+
+
+def custom_field(structure, key):
+    """
+    custom_fields[key]の式、型に応じてキャストし並べ替えに使えるようにする
+    PostgreSQLでは式インデックス(sync_custom_field_indexes)と同じ式になる
+    """
+    value = KT(f"custom_fields__{key}")
+    kind = structure_registry.get(structure.pk).types.get(key)
+    if kind == "number":
+        return Cast(value, FloatField())
+    if kind == "datetime":
+        if connection.vendor == "postgresql":
+            return Func(
+                value,
+                function=TIMESTAMPTZ_FUNCTION,
+                output_field=DateTimeField(),
+            )
+        return Cast(value, DateTimeField())
+    return Cast(value, TextField())
+
+
+def filter_custom_fields(queryset, structure, **values):
+    """
+    structureのContentをカスタムフィールドの値の一致で絞り込む
+    PostgreSQLでは@>(custom_fields__contains)でGINインデックスを使う
+    """
+    queryset = queryset.filter(model=structure)
+    if not values:
+        return queryset
+    if connection.vendor == "postgresql":
+        return queryset.filter(custom_fields__contains=values)
+    return queryset.filter(
+        **{f"custom_fields__{key}": value for key, value in values.items()}
+    )
+
+
+def order_by_custom_field(queryset, structure, key, descending=False):
+    expression = custom_field(structure, key)
+    expression = expression.desc() if descending else expression.asc()
+    return queryset.filter(model=structure).order_by(expression, "id")
+
+
+def _index_name(structure_id, key):
+    return f"content_cf_{structure_id}_{key}"[:63]
+
+
+def custom_field_index_sql(structure, concurrently=True):
+    """
+    schemaのindexedなフィールドの部分式インデックスを作るSQLのリストを返す(PostgreSQL)
+    concurrently: トランザクション内で実行する場合はFalseにする
+    """
+    schema = structure_registry.get(structure.pk)
+    create = []
+    for key in schema.indexed:
+        if not key.isidentifier():
+            raise ValueError(f"invalid key for index: {key}")
+        value = f"(custom_fields ->> '{key}')"
+        kind = schema.types[key]
+        if kind == "datetime":
+            expression = f"{TIMESTAMPTZ_FUNCTION}{value}"
+        else:
+            expression = f"({value}::{'float8' if kind == 'number' else 'text'})"
+        create.append(
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS"
+            f" {_index_name(structure.pk, key)}"
+            f" ON app_content ({expression}, id)"
+            f" WHERE model_id = {int(structure.pk)}"
+        )
+    return create
+
+
+def sync_custom_field_indexes(structure):
+    """
+    indexedなフィールドの式インデックスを作り、不要になったものを消す
+    CONCURRENTLYを使うため、トランザクションの外で呼ぶこと(PostgreSQLのみ)
+    """
+    if connection.vendor != "postgresql":
+        return []
+    prefix = _index_name(structure.pk, "")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes"
+            " WHERE tablename = 'app_content' AND indexname LIKE %s",
+            [prefix.replace("_", r"\_") + "%"],
+        )
+        existing = {name for (name,) in cursor.fetchall()}
+        wanted = {
+            _index_name(structure.pk, key)
+            for key in structure_registry.get(structure.pk).indexed
+        }
+        statements = custom_field_index_sql(structure)
+        statements += [
+            f"DROP INDEX CONCURRENTLY IF EXISTS {name}"
+            for name in sorted(existing - wanted)
+        ]
+        for sql in statements:
+            cursor.execute(sql)
+    return statements
+
+
+NEWS_SCHEMA = [
+    {"key": "subtitle", "type": "singleline"},
+    {"key": "body", "type": "flexibletext", "required": True},
+    {"key": "price", "type": "number", "indexed": True},
+    {"key": "category", "type": "singleselect", "options": ["a", "b"]},
+    {"key": "featured", "type": "boolean"},
+    {"key": "starts_at", "type": "datetime"},
+    {"key": "image", "type": "media"},
+    {"key": "related", "type": "reference"},
+    {
+        "key": "links",
+        "type": "repeat",
+        "fields": [{"key": "url", "type": "singleline", "required": True}],
+    },
+    {
+        "key": "blocks",
+        "type": "combination",
+        "blocks": {"text": [{"key": "text", "type": "multiline"}]},
+    },
+]
+
+
+def test_compiled_schema_clean():
+    schema = CompiledSchema(NEWS_SCHEMA)
+    values = {
+        "body": "<p>body</p>",
+        "price": 10,
+        "category": "a",
+        "featured": True,
+        "starts_at": "2024-01-01T00:00:00+00:00",
+        "image": {"url": "https://example.com/a.png", "alt": "a"},
+        "related": 1,
+        "links": [{"url": "https://example.com"}],
+        "blocks": [{"luid": "text", "fields": {"text": "foo\nbar"}}],
+    }
+    assert schema.clean(values) == values
+    assert list(schema.represent(values)) == [field["key"] for field in NEWS_SCHEMA]
+
+    with pytest.raises(ValidationError) as exc:
+        schema.clean(
+            {
+                "subtitle": "a\nb",
+                "price": True,
+                "category": "c",
+                "starts_at": "2024-01-01",
+                "links": [{}],
+                "blocks": [{"luid": "image"}],
+                "unknown": 1,
+            }
+        )
+    assert set(exc.value.detail) == {
+        "subtitle",
+        "body",
+        "price",
+        "category",
+        "starts_at",
+        "links",
+        "blocks",
+        "unknown",
+    }
+    with pytest.raises(ValueError):
+        CompiledSchema([{"key": "x", "type": "unknown"}])
+    with pytest.raises(ValueError):
+        CompiledSchema([{"key": "title", "type": "singleline"}], RESERVED_KEYS)
+
+
+@pytest.mark.django_db
+def test_structure_schema_validated_on_save():
+    for schema in [
+        {"key": "x"},
+        [{"key": "x", "type": "unknown"}],
+        [{"key": "x", "type": "number"}, {"key": "x", "type": "boolean"}],
+        [{"key": "status", "type": "singleline"}],
+        [{"type": "singleline"}],
+        [{"key": "x", "type": "combination", "blocks": []}],
+    ]:
+        structure = Structure(name="news", description="news", schema=schema)
+        with pytest.raises(ModelValidationError) as exc:
+            structure.full_clean()
+        assert list(exc.value.message_dict) == ["schema"]
+        with pytest.raises(ModelValidationError):
+            structure.save()
+    assert not Structure.objects.exists()
+    Structure(name="news", description="", schema=NEWS_SCHEMA).save()
+
+
+@pytest.mark.django_db
+def test_structure_registry(django_assert_num_queries):
+    registry = StructureRegistry()
+    news = Structure.objects.create(name="news", description="", schema=NEWS_SCHEMA)
+    other = Structure.objects.create(name="other", description="")
+    with django_assert_num_queries(1):
+        registry.prepare([news.pk, other.pk, None])
+    with django_assert_num_queries(0):
+        assert registry.get(news.pk).indexed == ["price"]
+        assert registry.get(other.pk).keys == []
+        assert registry.get(None) is EMPTY_SCHEMA
+    assert registry.get(other.pk + 1) is None
+
+
+@pytest.mark.django_db
+def test_structure_registry_ttl(django_assert_num_queries):
+    registry = StructureRegistry(ttl=0)
+    news = Structure.objects.create(name="news", description="news", schema=NEWS_SCHEMA)
+    assert registry.get(news.pk).indexed == ["price"]
+    # 他のプロセスでの変更(シグナルが届かない)も期限切れ後の読み直しで反映する
+    Structure.objects.filter(pk=news.pk).update(schema=NEWS_SCHEMA[:1])
+    with django_assert_num_queries(1):
+        assert registry.get(news.pk).keys == ["subtitle"]
+
+
+@pytest.mark.django_db
+def test_structure_registry_reference_fields(django_assert_num_queries):
+    registry = StructureRegistry()
+    Structure.objects.create(name="other", description="other")
+    with django_assert_num_queries(2):
+        assert registry.reference_fields() == []
+    # referenceフィールドがなければ以降はクエリを発行しない
+    with django_assert_num_queries(0):
+        assert registry.reference_fields() == []
+    news = Structure.objects.create(name="news", description="news", schema=NEWS_SCHEMA)
+    registry.invalidate(news.pk)
+    assert registry.reference_fields() == [(news.pk, "related")]
+    news.delete()
+    registry.invalidate(news.pk)
+    assert registry.reference_fields() == []
+
+    registry = StructureRegistry(ttl=0)
+    registry.reference_fields()
+    # 一覧とschemaの両方を読み直す
+    with django_assert_num_queries(2):
+        registry.reference_fields()
+
+
+@pytest.mark.django_db
+def test_filter_and_order_by_custom_field():
+    status = Status.objects.create(status="draft")
+    news = Structure.objects.create(name="news", description="", schema=NEWS_SCHEMA)
+    contents = Content.objects.bulk_create(
+        [
+            Content(
+                title=f"Test Content {i}",
+                model=news,
+                status=status,
+                custom_fields={"body": "", "price": price, "category": category},
+            )
+            for i, (price, category) in enumerate(
+                [(30, "a"), (5, "b"), (200, "a"), (5, "a")]
+            )
+        ]
+    )
+    Content.objects.create(title="Other", status=status, custom_fields={"price": 5})
+    assert set(filter_custom_fields(Content.objects.all(), news, price=5)) == {
+        contents[1],
+        contents[3],
+    }
+    assert list(
+        filter_custom_fields(Content.objects.all(), news, price=5, category="a")
+    ) == [contents[3]]
+    # 文字列ではなく数値として並ぶ
+    ordered = order_by_custom_field(Content.objects.all(), news, "price")
+    assert list(ordered) == [contents[1], contents[3], contents[0], contents[2]]
+
+
+def test_custom_field_index_sql(monkeypatch):
+    schema = NEWS_SCHEMA + [
+        {"key": "ends_at", "type": "datetime", "indexed": True},
+        {"key": "code", "type": "singleline", "indexed": True},
+    ]
+    structure = Structure(pk=3, schema=schema)
+    registry = StructureRegistry()
+    registry._set([(3, schema)])
+    monkeypatch.setattr(__name__ + ".structure_registry", registry)
+    assert custom_field_index_sql(structure) == [
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS content_cf_3_price"
+            " ON app_content (((custom_fields ->> 'price')::float8), id)"
+            " WHERE model_id = 3"
+        ),
+        # ::timestamptzはIMMUTABLEではないため関数で包む
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS content_cf_3_ends_at"
+            " ON app_content"
+            " (app_custom_field_timestamptz(custom_fields ->> 'ends_at'), id)"
+            " WHERE model_id = 3"
+        ),
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS content_cf_3_code"
+            " ON app_content (((custom_fields ->> 'code')::text), id)"
+            " WHERE model_id = 3"
+        ),
+    ]
@@ -0,0 +1,568 @@
+"""
+Planごとのレート制限
+RateLimitMiddlewareがUserごとのトークンバケットでリクエストを数え、
+上限を超えたら429を返す。設定はsettings.RATE_LIMITS
+
+Userはゲートウェイで認証済みのリクエストのヘッダー(USER_HEADER)のidで識別する
+UserのPlanはplan_registryにプロセス内で保持し、リクエストごとにはDBを引かない
+User, Planの保存・削除時はapp.signalsで破棄する
+ヘッダーのない・不正な・存在しないidのリクエストはクライアントのIPごとにANONYMOUSで、
+PLANSにないPlanのUserはDEFAULTで制限する
+
+バケットはLocalBucketBackend(プロセス内)かDjangoCacheBucketBackend(共有キャッシュ)に置く
+レスポンスにはRateLimit-Limit, RateLimit-Remaining, RateLimit-Reset, RateLimit-Policyを付ける
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+from unittest import mock
+
+import pytest
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.http import JsonResponse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from app.models import Plan, Space, User
+
+DEFAULT_SETTINGS = {
+    "BACKEND": "app.throttling.LocalBucketBackend",
+    "OPTIONS": {},
+    # Planの名前: "回数/期間(s, m, h, d)"
+    "PLANS": {},
+    # PLANSにないPlanのUserの制限、Noneなら制限しない
+    "DEFAULT": "60/min",
+    # Userを識別できないリクエストのクライアントのIPごとの制限、Noneなら制限しない
+    "ANONYMOUS": "60/min",
+    "USER_HEADER": "X-User-Id",
+    # このパスで始まるリクエストは制限しない
+    "EXEMPT_PATHS": (),
+}
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class Rate(NamedTuple):
+    """capacity回までまとめて受け付け、period秒でcapacity回分を補充する"""
+
+    capacity: int
+    period: int
+
+    @property
+    def refill(self):
+        """1秒あたりに補充するトークン"""
+        return self.capacity / self.period
+
+    @property
+    def policy(self):
+        return f"{self.capacity};w={self.period}"
+
+
+def parse_rate(rate):
+    """'60/min' -> Rate(60, 60)、DRFのthrottleと同じく期間は先頭の文字で決める"""
+    if rate is None:
+        return None
+    count, _, period = rate.partition("/")
+    return Rate(int(count), PERIODS[period.strip()[0]])
+
+
+def _refill(state, rate, now):
+    """stateの(トークン, 更新時刻)から現在のトークンを返す、stateがなければ満杯"""
+    if state is None:
+        return rate.capacity
+    tokens, updated = state
+    return min(rate.capacity, tokens + (now - updated) * rate.refill)
+
+
+class LocalBucketBackend:
+    """
+    プロセス内のバケット
+    max_entries: 保持するバケットの上限、超えたら最も古いものから捨てる(満杯に戻る)
+
+    制限はプロセスごとにかかるため、複数プロセスで動かす場合は
+    上限をプロセス数で割るか、DjangoCacheBucketBackendを選ぶこと
+    """
+
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, now):
+        """トークンを1つ使えればTrueと残りのトークンを返す"""
+        with self._lock:
+            tokens = _refill(self._buckets.pop(key, None), rate, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    def peek(self, key, rate, now):
+        """トークンを使わずに現在のトークンを返す"""
+        with self._lock:
+            return _refill(self._buckets.get(key), rate, now)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DjangoCacheBucketBackend:
+    """
+    Djangoのキャッシュフレームワーク(settings.CACHES)にバケットを置く
+    読み出しと書き込みの間に他のプロセスが使ったトークンは数えないため、
+    同時のリクエストでは上限をわずかに超えることがある
+    """
+
+    def __init__(self, alias="default"):
+        self.cache = caches[alias]
+
+    def consume(self, key, rate, now):
+        key = f"ratelimit:{key}"
+        tokens = _refill(self.cache.get(key), rate, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # 満杯に戻るまで保持する、期限切れは満杯と同じ
+        timeout = math.ceil((rate.capacity - tokens) / rate.refill) + 1
+        self.cache.set(key, (tokens, now), timeout)
+        return allowed, tokens
+
+    def peek(self, key, rate, now):
+        return _refill(self.cache.get(f"ratelimit:{key}"), rate, now)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class PlanRegistry:
+    """
+    User id -> Planの名前 (存在しないUserはNone)
+    max_entries: 保持するUserの上限
+    max_missing: 存在しないidの上限、任意のidで保持しているUserを追い出させないよう別に持つ
+    ttl: 他のプロセスでの変更を反映するまでの秒数
+    期限切れや破棄の後もPlanを持っていたidは残し、knownで既知のUserとして扱う
+    """
+
+    def __init__(self, max_entries=100_000, max_missing=10_000, ttl=60):
+        self.max_entries = max_entries
+        self.max_missing = max_missing
+        self.ttl = ttl
+        self._plans = OrderedDict()
+        self._missing = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _queryset(self, user_id):
+        return User.objects.filter(pk=user_id).values_list("plan__name", flat=True)
+
+    def _get(self, user_id):
+        with self._lock:
+            for entries in (self._plans, self._missing):
+                entry = entries.get(user_id)
+                if entry is not None and entry[1] >= time.monotonic():
+                    entries.move_to_end(user_id)
+                    return True, entry[0]
+        return False, None
+
+    def _set(self, user_id, name):
+        if name is None:
+            entries, max_entries = self._missing, self.max_missing
+        else:
+            entries, max_entries = self._plans, self.max_entries
+        with self._lock:
+            self._plans.pop(user_id, None)
+            self._missing.pop(user_id, None)
+            entries[user_id] = (name, time.monotonic() + self.ttl)
+            if len(entries) > max_entries:
+                entries.popitem(last=False)
+        return name
+
+    def cached(self, user_id):
+        """user_idのPlan(存在しないことも含む)を保持していればTrue"""
+        return self._get(user_id)[0]
+
+    def known(self, user_id):
+        """user_idのPlanを読み込んだことがあればTrue (期限切れ・破棄済みも含む)"""
+        return user_id in self._plans
+
+    def plan(self, user_id):
+        hit, name = self._get(user_id)
+        if hit:
+            return name
+        return self._set(user_id, self._queryset(user_id).first())
+
+    async def aplan(self, user_id):
+        """planの非同期版"""
+        hit, name = self._get(user_id)
+        if hit:
+            return name
+        return self._set(user_id, await self._queryset(user_id).afirst())
+
+    def invalidate(self, user_id=None):
+        """user_idのPlanを破棄する、省略時は全て (既知のidとしては残す)"""
+        expired = float("-inf")
+        with self._lock:
+            if user_id is None:
+                for key, (name, _) in self._plans.items():
+                    self._plans[key] = (name, expired)
+                self._missing.clear()
+            else:
+                if user_id in self._plans:
+                    self._plans[user_id] = (self._plans[user_id][0], expired)
+                self._missing.pop(user_id, None)
+
+
+plan_registry = PlanRegistry()
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    rate: Rate
+    tokens: float
+
+    @property
+    def remaining(self):
+        return int(self.tokens)
+
+    @property
+    def reset(self):
+        """満杯に戻るまでの秒数"""
+        return math.ceil((self.rate.capacity - self.tokens) / self.rate.refill)
+
+    @property
+    def retry_after(self):
+        """次のトークンが補充されるまでの秒数"""
+        return max(math.ceil((1 - self.tokens) / self.rate.refill), 1)
+
+    def headers(self):
+        headers = {
+            "RateLimit-Limit": str(self.rate.capacity),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset),
+            "RateLimit-Policy": self.rate.policy,
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+class RateLimiter:
+    def __init__(self, config):
+        config = {**DEFAULT_SETTINGS, **config}
+        backend = import_string(config["BACKEND"])
+        self.backend = backend(**config.get("OPTIONS", {}))
+        self.plans = {name: parse_rate(rate) for name, rate in config["PLANS"].items()}
+        self.default = parse_rate(config["DEFAULT"])
+        self.anonymous = parse_rate(config["ANONYMOUS"])
+        header = config["USER_HEADER"].upper().replace("-", "_")
+        self.header = f"HTTP_{header}"
+        self.exempt_paths = tuple(config["EXEMPT_PATHS"])
+
+    def user_id(self, request):
+        """USER_HEADERのUserのid、ないか不正ならNone"""
+        value = request.META.get(self.header)
+        if value is None or not value.isdigit():
+            return None
+        return int(value)
+
+    def exempt(self, request):
+        return (
+            request.path.startswith(self.exempt_paths) if self.exempt_paths else False
+        )
+
+    @staticmethod
+    def _ip_key(request):
+        return f"ip:{request.META.get('REMOTE_ADDR')}"
+
+    def lookup_allowed(self, request, user_id):
+        """
+        user_idのPlanをDBから引いてよいか
+        存在しないidはIPのバケットで数えるため、未知か存在しないidは
+        そのバケットが空なら引かずに拒否させる
+        (任意のidを送るクライアントにリクエストごとのクエリを発行させない)
+        Planを持っていたidは、同じIPの他のクライアントに妨げられないよう常に引く
+        """
+        if (
+            self.anonymous is None
+            or plan_registry.cached(user_id)
+            or plan_registry.known(user_id)
+        ):
+            return True
+        tokens = self.backend.peek(self._ip_key(request), self.anonymous, time.time())
+        return tokens >= 1
+
+    def check(self, request, user_id, plan):
+        """制限しないリクエストはNone"""
+        if user_id is not None and plan is not None:
+            # Planの変更後は新しいPlanのバケットを使う
+            key, rate = f"user:{user_id}:{plan}", self.plans.get(plan, self.default)
+        else:
+            # ヘッダーのない・不正な・存在しないid
+            key, rate = self._ip_key(request), self.anonymous
+        if rate is None:
+            return None
+        allowed, tokens = self.backend.consume(key, rate, time.time())
+        return Decision(allowed, rate, tokens)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """settings.RATE_LIMITSから作ったRateLimiterを返す"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(getattr(settings, "RATE_LIMITS", {}))
+    return _rate_limiter
+
+
+@receiver(setting_changed)
+def reset_rate_limiter(setting, **kwargs):
+    global _rate_limiter
+    if setting in ("RATE_LIMITS", "CACHES"):
+        _rate_limiter = None
+
+
+def _throttled(decision):
+    # DRFのThrottledと同じ形の本文
+    return JsonResponse(
+        {
+            "detail": "Request was throttled. "
+            f"Expected available in {decision.retry_after} seconds."
+        },
+        status=429,
+    )
+
+
+class RateLimitMiddleware:
+    """
+    MIDDLEWAREのQueryMetricsMiddlewareの直後に置き、
+    制限を超えたリクエストはビューやキャッシュに届く前に429を返す
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        limiter = get_rate_limiter()
+        if limiter.exempt(request):
+            return self.get_response(request)
+        user_id = limiter.user_id(request)
+        plan = None
+        if user_id is not None and limiter.lookup_allowed(request, user_id):
+            plan = plan_registry.plan(user_id)
+        decision = limiter.check(request, user_id, plan)
+        if decision is not None and not decision.allowed:
+            return self._set_headers(_throttled(decision), decision)
+        return self._set_headers(self.get_response(request), decision)
+
+    async def __acall__(self, request):
+        limiter = get_rate_limiter()
+        if limiter.exempt(request):
+            return await self.get_response(request)
+        user_id = limiter.user_id(request)
+        plan = None
+        if user_id is not None and limiter.lookup_allowed(request, user_id):
+            plan = await plan_registry.aplan(user_id)
+        decision = limiter.check(request, user_id, plan)
+        if decision is not None and not decision.allowed:
+            return self._set_headers(_throttled(decision), decision)
+        return self._set_headers(await self.get_response(request), decision)
+
+    @staticmethod
+    def _set_headers(response, decision):
+        if decision is not None:
+            for name, value in decision.headers().items():
+                response[name] = value
+        return response
+
+
+def test_parse_rate():
+    assert parse_rate("60/min") == Rate(60, 60)
+    assert parse_rate("10/s") == Rate(10, 1)
+    assert parse_rate("1000/day") == Rate(1000, 86400)
+    assert parse_rate(None) is None
+
+
+def test_local_bucket_backend():
+    backend = LocalBucketBackend()
+    rate = Rate(2, 10)
+    assert backend.consume("a", rate, 0.0) == (True, 1)
+    assert backend.consume("a", rate, 0.0) == (True, 0)
+    assert backend.consume("a", rate, 0.0) == (False, 0)
+    # 5秒で1回分補充される
+    assert backend.consume("a", rate, 5.0) == (True, 0)
+    # 上限を超えては貯まらない
+    assert backend.consume("a", rate, 100.0) == (True, 1)
+    assert backend.consume("b", rate, 0.0) == (True, 1)
+
+
+def test_local_bucket_backend_max_entries():
+    backend = LocalBucketBackend(max_entries=1)
+    rate = Rate(1, 60)
+    assert backend.consume("a", rate, 0.0)[0]
+    assert backend.consume("b", rate, 0.0)[0]
+    # aは捨てられて満杯に戻る
+    assert backend.consume("a", rate, 0.0)[0]
+    assert backend.peek("a", rate, 0.0) == 0
+    assert backend.peek("c", rate, 0.0) == 1
+
+
+@pytest.mark.django_db
+def test_plan_registry_missing():
+    plan = Plan.objects.create(name="free")
+    user = User.objects.create(name="user", plan=plan)
+    registry = PlanRegistry(max_entries=10, max_missing=1)
+    assert registry.plan(user.pk) == "free"
+    assert registry.plan(user.pk + 1) is None
+    assert registry.plan(user.pk + 2) is None
+    # 存在しないidは保持しているUserを追い出さない
+    assert registry.cached(user.pk)
+    assert not registry.cached(user.pk + 1)
+    assert registry.cached(user.pk + 2)
+
+
+def test_decision_headers():
+    decision = Decision(False, Rate(60, 60), 0.25)
+    assert decision.headers() == {
+        "RateLimit-Limit": "60",
+        "RateLimit-Remaining": "0",
+        "RateLimit-Reset": "60",
+        "RateLimit-Policy": "60;w=60",
+        "Retry-After": "1",
+    }
+
+
+LIMITS = {
+    "PLANS": {"free": "3/min", "premium": "100/min"},
+    "DEFAULT": "5/min",
+    "ANONYMOUS": "2/min",
+    "EXEMPT_PATHS": ["/metrics"],
+}
+
+
+@override_settings(RATE_LIMITS=LIMITS)
+class TestRateLimitMiddleware(TestCase):
+    def setUp(self):
+        self.free = Plan.objects.create(name="free")
+        self.premium = Plan.objects.create(name="premium")
+        self.user = User.objects.create(name="user", plan=self.free)
+        self.space = Space.objects.create(name="space")
+        plan_registry.invalidate()
+        get_rate_limiter().backend.clear()
+
+    def get(self, name="space-detail", user=None, client=None):
+        headers = {"x-user-id": str(user or self.user.pk)}
+        path = reverse(name, args=[self.space.pk]) if "space" in name else reverse(name)
+        return (client or self.client).get(path, headers=headers)
+
+    def test_throttled(self):
+        remaining = [self.get()["RateLimit-Remaining"] for _ in range(3)]
+        assert remaining == ["2", "1", "0"]
+        response = self.get()
+        assert response.status_code == 429
+        assert response["RateLimit-Limit"] == "3"
+        assert response["RateLimit-Policy"] == "3;w=60"
+        assert int(response["Retry-After"]) >= 1
+        assert "throttled" in response.json()["detail"]
+        # Userごとのバケット
+        other = User.objects.create(name="other", plan=self.free)
+        assert self.get(user=other.pk).status_code == 200
+
+    def test_no_query_per_request(self):
+        self.get()
+        with CaptureQueriesContext(connection) as queries:
+            self.get()
+        assert not [q for q in queries if "app_user" in q["sql"]]
+
+    def test_plan_change(self):
+        for _ in range(3):
+            self.get()
+        assert self.get().status_code == 429
+        # 保存時にPlanが破棄され、次のリクエストから新しいPlanの制限になる
+        self.user.plan = self.premium
+        self.user.save()
+        response = self.get()
+        assert response.status_code == 200
+        assert response["RateLimit-Limit"] == "100"
+
+    def test_default_limits(self):
+        # PLANSにないPlanはDEFAULT
+        standard = Plan.objects.create(name="standard")
+        user = User.objects.create(name="standard", plan=standard)
+        assert self.get(user=user.pk)["RateLimit-Limit"] == "5"
+        # ヘッダーのないリクエストはIPごとのANONYMOUS
+        response = self.client.get(reverse("space-detail", args=[self.space.pk]))
+        assert response["RateLimit-Limit"] == "2"
+        # 除外するパス
+        for _ in range(5):
+            assert not self.get("metrics").has_header("RateLimit-Limit")
+
+    def test_unknown_user_limited(self):
+        assert self.get().status_code == 200
+        # 不正・存在しないidはIPのバケットを使い、idを変えても制限を回避できない
+        response = self.client.get(
+            reverse("space-detail", args=[self.space.pk]), headers={"x-user-id": "x"}
+        )
+        assert response["RateLimit-Remaining"] == "1"
+        assert self.get(user=self.user.pk + 100).status_code == 200
+        assert self.get(user=self.user.pk + 101).status_code == 429
+        # バケットが空の間は新しいidのUserをDBから引かない
+        with CaptureQueriesContext(connection) as queries:
+            assert self.get(user=self.user.pk + 102).status_code == 429
+        assert not [q for q in queries if "app_user" in q["sql"]]
+        # 保持しているUserは自身のバケット
+        assert self.get().status_code == 200
+
+    def test_known_user_not_blocked_by_ip(self):
+        user = User.objects.create(name="premium", plan=self.premium)
+        # 期限切れの状態で保持させる
+        with mock.patch.object(plan_registry, "ttl", -1):
+            assert self.get(user=user.pk)["RateLimit-Limit"] == "100"
+        assert not plan_registry.cached(user.pk)
+        # 同じIPの他のクライアントがIPのバケットを使い切る
+        for _ in range(2):
+            self.client.get(reverse("space-detail", args=[self.space.pk]))
+        response = self.get(user=user.pk)
+        assert response.status_code == 200
+        assert response["RateLimit-Limit"] == "100"
+        # 破棄(User, Planの保存)の後も同じ
+        plan_registry.invalidate()
+        assert self.get(user=user.pk).status_code == 200
+        # 一度もPlanを引いていないidはIPのバケットが空なら拒否する
+        other = User.objects.create(name="other premium", plan=self.premium)
+        assert self.get(user=other.pk).status_code == 429
+
+    async def test_async_view(self):
+        for _ in range(3):
+            response = await self.aget()
+            assert response.status_code == 200
+        response = await self.aget()
+        assert response.status_code == 429
+        assert response["RateLimit-Remaining"] == "0"
+
+    async def aget(self):
+        return await self.async_client.get(
+            reverse("async-space-detail", args=[self.space.pk]),
+            headers={"x-user-id": str(self.user.pk)},
+        )
@@ -1,19 +1,111 @@
-from django.test import TestCase
+import functools
+import json
+import tracemalloc
+from collections.abc import Iterator
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+from rest_framework.decorators import api_view, parser_classes
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
+from rest_framework.utils import encoders
 
+from app import snapshots
+from app.cache import get_space_cache
+from app.changes import read_changes
+from app.conditional import conditional_space
+from app.fields import content_columns, project_space
+from app.ingest import ingest_contents
+from app.metrics import serializer_timer
 from app.models import Content, Space, Status
-from app.serializer import SpaceSerializer
+from app.pagination import (
+    CONTENT_ORDERING,
+    keyset_queryset,
+    keyset_result,
+    offset_queryset,
+    offset_result,
+)
+from app.parsers import NDJSONParser
+from app.references import ReferenceLoader
+from app.registry import status_registry
+from app.renderers import native_datetimes
+from app.routers import read_replica
+from app.search import search_contents
+from app.serializer import (
+    ChangeFeedQuerySerializer,
+    ContentListQuerySerializer,
+    ContentSerializer,
+    FastContentSerializer,
+    FastSpaceSerializer,
+    ResponseSerializer,
+    SpaceQuerySerializer,
+    SpaceSerializer,
+)
 
 
 def space_detail(request, pk):
     # status = Status.objects.create(name="Test Status")
     # content = Content.objects.create(title="Test Content", status=status)
-    space = Space.objects.get(pk=pk)
     # space.content.set([content])
     # space.save()
+    fields, content_fields = space_fields(request)
+
+    def build():
+        if snapshots.enabled():
+            return project_space(snapshots.get_snapshot(pk), fields, content_fields)
+        if settings.FAST_SERIALIZATION:
+            space = Space.objects.get(pk=pk)
+            serializer = FastSpaceSerializer(
+                space, fields, content_fields, native_datetimes(request)
+            )
+        else:
+            space = Space.objects.all()
+            if content_fields is not None:
+                # 出力するキーの列のみを取得する
+                columns = content_columns(content_fields)
+                space = space.prefetch_related(
+                    Prefetch("content", Content.objects.only(*columns))
+                )
+            elif fields is None or "content" in fields:
+                # 予約公開の日時は出力しない
+                space = space.prefetch_related(
+                    Prefetch("content", Content.objects.defer("scheduled_at"))
+                )
+            serializer = SpaceSerializer(
+                space.get(pk=pk), fields=fields, content_fields=content_fields
+            )
+        with serializer_timer():
+            return dict(serializer.data)
+
+    variant = "" if request is None else request.GET.get("fields", "")
+    variant = cache_variant(request, variant)
+    return Response(get_space_cache().get_or_set(pk, build, variant=variant))
+
+
+def cache_variant(request, variant):
+    """datetimeをそのまま受け取るレンダラーの出力は文字列の出力とキャッシュを分ける"""
+    return f"{variant}:native" if native_datetimes(request) else variant
+
 
-    serializer = SpaceSerializer(space)
-    return Response(serializer.data)
+def space_fields(request):
+    """クエリパラメータfieldsを(Spaceのキー, Contentのキー)にする"""
+    if request is None:
+        return None, None
+    params = SpaceQuerySerializer(data=request.GET)
+    params.is_valid(raise_exception=True)
+    return params.validated_data.get("fields") or (None, None)
+
+
+space_detail_view = api_view(["GET"])(read_replica(conditional_space(space_detail)))
 
 
 # space_detailのpytest
@@ -25,6 +117,112 @@ class TestSpaceDetailView(TestCase):
         self.space.content.set([self.content])
         self.space.save()
 
+    def test_space_detail_cache(self):
+        space_detail(None, self.space.id)
+        with self.assertNumQueries(0):
+            response = space_detail(None, self.space.id)
+        assert response.data["content"][0]["title"] == "Test Content"
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.content.title = "Updated Content"
+            self.content.save()
+        response = space_detail(None, self.space.id)
+        assert response.data["content"][0]["title"] == "Updated Content"
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.space.content.remove(self.content)
+        assert space_detail(None, self.space.id).data["content"] == []
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.content.spaces.add(self.space)
+        assert len(space_detail(None, self.space.id).data["content"]) == 1
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.content.delete()
+        assert space_detail(None, self.space.id).data["content"] == []
+
+    def test_space_detail_no_status_queries(self):
+        others = Content.objects.bulk_create(
+            [Content(title=f"Test Content {i}", status=self.status) for i in range(20)]
+        )
+        self.space.content.add(*others)
+        status_registry.name(self.status.id)
+        for fast in (False, True):
+            get_space_cache().clear()
+            # Spaceの取得とContentの取得のみで、件数によらずStatusは引かない
+            with override_settings(FAST_SERIALIZATION=fast):
+                with self.assertNumQueries(2):
+                    response = space_detail(None, self.space.id)
+            assert len(response.data["content"]) == 21
+            assert {row["_status"] for row in response.data["content"]} == {"draft"}
+
+    def test_space_detail_snapshot(self):
+        with override_settings(SPACE_SNAPSHOTS=True):
+            snapshots.rebuild_snapshot(self.space.id)
+            get_space_cache().clear()
+            # スナップショットの主キー検索のみ
+            with self.assertNumQueries(1):
+                response = space_detail(None, self.space.id)
+            assert response.data == SpaceSerializer(self.space).data
+
+    def test_space_detail_not_modified(self):
+        url = reverse("space-detail", args=[self.space.id])
+        response = self.client.get(url)
+        assert response.status_code == 200
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response.content == b""
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 304
+
+        # 追加、削除、更新のいずれでもETagが変わる
+        other = Content.objects.create(title="Other Content", status=self.status)
+        self.space.content.add(other)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        etag = response["ETag"]
+        self.space.content.remove(self.content)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response["ETag"] != etag
+
+    def test_space_detail_validator_dependencies(self):
+        url = reverse("space-detail", args=[self.space.id])
+        # Last-Modifiedは秒単位のため、過去にずらしてから変更する
+        past = timezone.now() - timedelta(hours=1)
+        Space.objects.filter(pk=self.space.pk).update(updated_at=past)
+        Content.objects.filter(pk=self.content.pk).update(updated_at=past)
+
+        def validators():
+            response = self.client.get(url)
+            return response["ETag"], response["Last-Modified"]
+
+        # Contentのupdated_atに現れない変更でも検証子が変わる
+        etag, last_modified = validators()
+        self.status.status = "review"
+        self.status.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response.json()["content"][0]["_status"] == "review"
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 200
+
+        Space.objects.filter(pk=self.space.pk).update(updated_at=past)
+        etag, last_modified = validators()
+        self.space.content.remove(self.content)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 200
+        assert response.json()["content"] == []
+
+    def test_space_detail_not_found(self):
+        response = self.client.get(reverse("space-detail", args=[self.space.id + 1]))
+        assert response.status_code == 404
+
     def test_space_detail(self):
         response = space_detail(None, self.space.id)
         assert response.data == {
@@ -44,6 +242,441 @@ class TestSpaceDetailView(TestCase):
                         "%Y-%m-%dT%H:%M:%S.%fZ"
                     ),
                     "status": self.content.status.id,
+                    "_status": "draft",
                 }
             ],
         }
+
+
+@api_view(["GET"])
+@read_replica
+@conditional_space
+def space_content_list(request, pk):
+    """
+    Spaceに属するContentをページングして返す
+    offset/limit: OFFSETによるページング
+    cursor/limit: (published_at, id)のキーセットによるページング
+    total: COUNTクエリ1回
+    data: 要求されたページのみ取得する
+    検証子の一致時は検証子の集計クエリ1回で304を返す
+    """
+    params = ContentListQuerySerializer(data=request.query_params)
+    params.is_valid(raise_exception=True)
+
+    def build():
+        return _space_content_page(request, pk, **params.validated_data)
+
+    variant = cache_variant(request, request.query_params.urlencode())
+    return Response(get_space_cache().get_or_set(pk, build, variant=variant))
+
+
+def _space_content_page(request, pk, offset, limit, cursor=None, q=None, fields=None):
+    # Spaceの存在はconditional_spaceで確認済み
+    contents, ranked = space_contents(pk, q)
+    total = contents.count()
+    if settings.FAST_SERIALIZATION:
+        contents = FastContentSerializer.rows(contents, fields, PAGE_COLUMNS)
+        content_serializer = functools.partial(
+            FastContentSerializer, native_datetimes=native_datetimes(request)
+        )
+    elif fields is not None:
+        # 出力するキーとページングに使う列のみを取得する
+        contents = contents.only(*content_columns(fields, PAGE_COLUMNS))
+        content_serializer = ContentSerializer
+    else:
+        # Statusの名前はstatus_registryから引くため結合しない
+        contents = contents.select_related("model").defer("scheduled_at")
+        content_serializer = ContentSerializer
+
+    rows = list(page_queryset(contents, ranked, offset, limit, cursor))
+    page = page_result(rows, ranked, offset, limit, cursor, total)
+    with serializer_timer():
+        return page_response(
+            request, page, content_serializer(page.rows, many=True, fields=fields).data
+        )
+
+
+def space_contents(pk, q=None):
+    """
+    Spaceに属するContentのクエリセット
+    @return (queryset, ranked) rankedがTrueなら検索の関連度順に並べる
+    """
+    contents = Content.objects.filter(spaces=pk)
+    if q:
+        return search_contents(contents, q)
+    return contents, False
+
+
+# キーセットによるページングで行から読む列
+PAGE_COLUMNS = ("published_at",)
+
+
+def page_queryset(contents, ranked, offset, limit, cursor=None):
+    """ページの行を取得するクエリセット (同期・非同期のビューで共通)"""
+    if cursor is not None:
+        return keyset_queryset(contents, cursor, limit)
+    if ranked:
+        # 検索結果は関連度順で返す
+        return contents.order_by("-search_rank", *CONTENT_ORDERING)[
+            offset : offset + limit
+        ]
+    return offset_queryset(contents, offset, limit)
+
+
+class Page(NamedTuple):
+    total: int
+    offset: int | None
+    limit: int
+    rows: list
+    next: str | None
+    previous: str | None
+
+
+def page_result(rows, ranked, offset, limit, cursor, total):
+    """page_querysetの結果からPageを作る"""
+    if cursor is not None:
+        return Page(total, None, limit, *keyset_result(rows, cursor, limit))
+    if ranked:
+        # (published_at, id)の順ではないためカーソルはない
+        return Page(total, offset, limit, rows, None, None)
+    return Page(total, offset, limit, *offset_result(rows, offset, limit, total))
+
+
+def page_response(request, page, data):
+    serializer = ResponseSerializer(
+        {
+            "total": page.total,
+            "offset": page.offset,
+            "limit": page.limit,
+            "next": page.next,
+            "previous": page.previous,
+            "data": data,
+        },
+        context={"request": request},
+    )
+    return dict(serializer.data)
+
+
+class TestSpaceContentListView(TestCase):
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.status = Status.objects.create(status="draft")
+        self.contents = Content.objects.bulk_create(
+            [Content(title=f"Test Content {i}", status=self.status) for i in range(30)]
+        )
+        self.space.content.set(self.contents)
+        self.url = reverse("space-content-list", args=[self.space.id])
+        # Statusの読み込みはプロセスで1回だけのため、ここで済ませておく
+        status_registry.name(self.status.id)
+
+    def test_space_content_list(self):
+        response = self.client.get(self.url, {"offset": 5, "limit": 10})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["total"] == 30
+        assert body["offset"] == 5
+        assert body["limit"] == 10
+        assert body["query_params"] is None
+        assert len(body["data"]) == 10
+
+    def test_space_content_list_query_count(self):
+        # 検証子, COUNT, ページ取得の3クエリでページサイズに依存しない
+        for limit in (1, 10, 30):
+            with self.assertNumQueries(3):
+                response = self.client.get(self.url, {"limit": limit})
+            assert len(response.json()["data"]) == limit
+
+    def test_space_content_list_cursor(self):
+        ids = []
+        params = {"limit": 7}
+        while True:
+            with self.assertNumQueries(3):
+                body = self.client.get(self.url, params).json()
+            ids.extend(row["id"] for row in body["data"])
+            if body["next"] is None:
+                break
+            params = {"limit": 7, "cursor": body["next"]}
+        assert sorted(ids) == sorted(content.id for content in self.contents)
+        assert len(ids) == len(set(ids))
+
+        previous = self.client.get(
+            self.url, {"limit": 7, "cursor": body["previous"]}
+        ).json()
+        assert [row["id"] for row in previous["data"]] == ids[-9:-2]
+
+    def test_space_content_list_fast_serialization(self):
+        params = {"offset": 3, "limit": 10}
+        expected = self.client.get(self.url, params).content
+        get_space_cache().clear()
+        with override_settings(FAST_SERIALIZATION=True):
+            with self.assertNumQueries(3):
+                response = self.client.get(self.url, params)
+        assert response.content == expected
+
+    def test_space_content_list_cache(self):
+        params = {"limit": 5}
+        self.client.get(self.url, params)
+        # 検証子の集計クエリのみ
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, params)
+        assert response.json()["total"] == 30
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.contents[0].delete()
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, params)
+        assert response.json()["total"] == 29
+
+    def test_space_content_list_q(self):
+        response = self.client.get(self.url, {"q": "Content 2"})
+        body = response.json()
+        # "Content 2", "Content 20" ... "Content 29"
+        assert body["total"] == 11
+        assert body["query_params"] == "Content 2"
+
+    def test_space_content_list_invalid_limit(self):
+        response = self.client.get(self.url, {"limit": 0})
+        assert response.status_code == 400
+
+    def test_space_content_list_not_found(self):
+        response = self.client.get(
+            reverse("space-content-list", args=[self.space.id + 1])
+        )
+        assert response.status_code == 404
+
+
+@api_view(["GET"])
+@read_replica
+def space_changes(request, pk):
+    """
+    Spaceのsinceより後の変更を返す (app.changes)
+    クライアントはhas_moreがFalseになるまでnextをsinceに渡して読む
+    """
+    params = ChangeFeedQuerySerializer(data=request.query_params)
+    params.is_valid(raise_exception=True)
+    get_object_or_404(Space.objects.only("id"), pk=pk)
+    return Response(
+        read_changes(
+            pk, native_datetimes=native_datetimes(request), **params.validated_data
+        )
+    )
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _encode_json(data):
+    # rest_framework.renderers.JSONRendererと同じ設定でエンコードする
+    return json.dumps(
+        data, cls=encoders.JSONEncoder, ensure_ascii=False, separators=(",", ":")
+    )
+
+
+def iter_export(space_id, ndjson=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    SpaceのContentをサーバーサイドカーソルで読み、chunk_size件ごとにbytesを返す
+    ndjson=Falseなら全体で1つのJSON配列、Trueなら1行1件
+    """
+    rows = FastContentSerializer.rows(
+        Content.objects.filter(spaces=space_id).order_by("id")
+    ).iterator(chunk_size=chunk_size)
+    serializer = FastContentSerializer(None)
+    separator = "\n" if ndjson else ","
+
+    if not ndjson:
+        yield b"["
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(serializer.to_representation(row))
+        if len(chunk) >= chunk_size:
+            yield _join_chunk(chunk, separator, ndjson, first)
+            chunk = []
+            first = False
+    if chunk:
+        yield _join_chunk(chunk, separator, ndjson, first)
+    if not ndjson:
+        yield b"]"
+
+
+def _join_chunk(chunk, separator, ndjson, first):
+    # referenceフィールドはチャンクごとに展開し、保持する参照先をチャンク内に限る
+    chunk = ReferenceLoader().resolve(chunk)
+    text = separator.join(_encode_json(data) for data in chunk)
+    if ndjson:
+        text += "\n"
+    elif not first:
+        text = separator + text
+    return text.encode()
+
+
+@require_GET
+def space_export(request, pk):
+    """
+    SpaceのContentを全件ストリーミングで返す
+    ?format=ndjson で1行1件のNDJSON、それ以外はJSON配列
+    """
+    get_object_or_404(Space.objects.only("id"), pk=pk)
+    ndjson = request.GET.get("format") == "ndjson"
+    return StreamingHttpResponse(
+        iter_export(pk, ndjson=ndjson),
+        content_type="application/x-ndjson" if ndjson else "application/json",
+    )
+
+
+class TestSpaceExportView(TestCase):
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.status = Status.objects.create(status="draft")
+        self.contents = Content.objects.bulk_create(
+            [Content(title=f"Test Content {i}", status=self.status) for i in range(5)]
+        )
+        self.space.content.set(self.contents)
+        self.url = reverse("space-export", args=[self.space.id])
+        self.expected = FastContentSerializer(
+            Content.objects.order_by("id"), many=True
+        ).data
+
+    def test_space_export_json(self):
+        response = self.client.get(self.url)
+        assert response.streaming
+        assert response["Content-Type"] == "application/json"
+        body = b"".join(response.streaming_content)
+        assert json.loads(body) == self.expected
+
+    def test_space_export_ndjson(self):
+        response = self.client.get(self.url, {"format": "ndjson"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        assert [json.loads(line) for line in lines] == self.expected
+
+    def test_space_export_chunks(self):
+        for ndjson in (False, True):
+            chunks = list(iter_export(self.space.id, ndjson=ndjson, chunk_size=2))
+            body = b"".join(chunks).decode()
+            if ndjson:
+                data = [json.loads(line) for line in body.splitlines()]
+            else:
+                data = json.loads(body)
+            assert data == self.expected
+
+    def test_space_export_empty(self):
+        space = Space.objects.create(name="Empty Space")
+        response = self.client.get(reverse("space-export", args=[space.id]))
+        assert json.loads(b"".join(response.streaming_content)) == []
+
+    def test_space_export_memory_bounded(self):
+        # 行数を5倍にしてもピークメモリがほぼ変わらないことを確認する
+        def peak_memory(space):
+            response = self.client.get(reverse("space-export", args=[space.id]))
+            tracemalloc.start()
+            size = 0
+            for chunk in response.streaming_content:
+                size += len(chunk)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak, size
+
+        peaks = []
+        for rows in (5_000, 25_000):
+            space = Space.objects.create(name=f"Export {rows}")
+            contents = Content.objects.bulk_create(
+                [
+                    Content(title=f"Export Content {i}", status=self.status)
+                    for i in range(rows)
+                ]
+            )
+            Space.content.through.objects.bulk_create(
+                [
+                    Space.content.through(space_id=space.id, content_id=content.id)
+                    for content in contents
+                ]
+            )
+            peak, size = peak_memory(space)
+            peaks.append(peak)
+        small, large = peaks
+        assert large < small * 1.2
+        # 出力全体を保持していない
+        assert large < size
+
+
+@api_view(["POST"])
+@parser_classes([JSONParser, NDJSONParser])
+def space_content_bulk(request, pk):
+    """
+    SpaceにContentを一括登録する
+    本文: ContentIngestSerializerの形のJSON配列、またはNDJSON
+    @return {"created": 作成件数, "errors": [{"row": 行番号, "errors": {...}}]}
+    """
+    space = get_object_or_404(Space.objects.only("id"), pk=pk)
+    rows = request.data
+    if isinstance(rows, dict):
+        rows = [rows]
+    elif not isinstance(rows, (list, Iterator)):
+        # NDJSONはイテレータ、JSONは配列かオブジェクトのみ
+        raise ParseError("JSON配列かオブジェクトを指定してください")
+    result = ingest_contents(space, rows)
+    if result.created:
+        return Response(result.as_dict(), status=201)
+    # 全ての行が失敗した場合のみ400、空の入力は作成0件で200
+    return Response(result.as_dict(), status=400 if result.errors else 200)
+
+
+class TestSpaceContentBulkView(TestCase):
+    def setUp(self):
+        self.space = Space.objects.create(name="Test Space")
+        self.status = Status.objects.create(status="draft")
+        self.url = reverse("space-content-bulk", args=[self.space.id])
+
+    def test_space_content_bulk_json(self):
+        response = self.client.post(
+            self.url,
+            [{"title": "Test Content 1", "status": "draft"}, {"status": "draft"}],
+            content_type="application/json",
+        )
+        assert response.status_code == 201
+        body = response.json()
+        assert body["created"] == 1
+        assert body["errors"][0]["row"] == 1
+        assert "title" in body["errors"][0]["errors"]
+        assert self.space.content.get().title == "Test Content 1"
+
+    def test_space_content_bulk_ndjson(self):
+        body = "\n".join(
+            json.dumps({"title": f"Test Content {i}", "status": "draft"})
+            for i in range(3)
+        )
+        response = self.client.post(self.url, body, content_type="application/x-ndjson")
+        assert response.status_code == 201
+        assert response.json() == {"created": 3, "errors": []}
+        assert self.space.content.count() == 3
+
+    def test_space_content_bulk_invalidates_cache(self):
+        space_detail(None, self.space.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                self.url, [{"title": "Test Content"}], content_type="application/json"
+            )
+        assert len(space_detail(None, self.space.id).data["content"]) == 1
+
+    def test_space_content_bulk_empty(self):
+        for body, content_type in (
+            ("[]", "application/json"),
+            ("\n", "application/x-ndjson"),
+        ):
+            response = self.client.post(self.url, body, content_type=content_type)
+            assert response.status_code == 200
+            assert response.json() == {"created": 0, "errors": []}
+
+    def test_space_content_bulk_scalar(self):
+        for body in ("1", '"title"', "null"):
+            response = self.client.post(self.url, body, content_type="application/json")
+            assert response.status_code == 400
+        assert self.space.content.count() == 0
+
+    def test_space_content_bulk_all_invalid(self):
+        response = self.client.post(
+            self.url,
+            [{"title": "Test Content", "status": "unknown"}],
+            content_type="application/json",
+        )
+        assert response.status_code == 400
@@ -0,0 +1,9 @@
+import pytest
+
+from app.throttling import get_rate_limiter
+
+
+@pytest.fixture(autouse=True)
+def _clear_rate_limits():
+    # バケットはプロセス内に残り、テストクライアントのIPは共通のため、テストごとに空にする
+    get_rate_limiter().backend.clear()
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +47,10 @@ INSTALLED_APPS = [
 TEST_RUNNER = "django_rich.test.RichRunner"
 
 MIDDLEWARE = [
+    "app.metrics.QueryMetricsMiddleware",
+    "app.throttling.RateLimitMiddleware",
+    "app.compression.CompressionMiddleware",
+    "app.references.ReferenceLoaderMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -78,19 +84,73 @@ WSGI_APPLICATION = "core.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(int(default))).lower() in ("1", "true", "yes")
+
+
+def _database(host, port):
+    """
+    env.shの環境変数からPostgreSQLの接続設定を作る
+    DB_POOLが有効ならpsycopgのConnectionPoolを使い、接続はプールに返す
+    無効ならCONN_MAX_AGEの間、スレッドごとに接続を持ち続ける
+    どちらもCONN_HEALTH_CHECKSで、再利用する前に接続が生きているか確認する
+    """
+    database = {
         # "ENGINE": "django.db.backends.sqlite3",
         # "NAME": BASE_DIR / "db.sqlite3",
         "ENGINE": "django.db.backends.postgresql",
-        "NAME": "django",
-        "USER": "postgres",
-        "PASSWORD": "postgres",
-        "HOST": "172.17.0.1",
-        "PORT": "5432",
+        "NAME": os.environ.get("DB_NAME", "django"),
+        "USER": os.environ.get("DB_USER", "postgres"),
+        "PASSWORD": os.environ.get("DB_PASSWORD", "postgres"),
+        "HOST": host,
+        "PORT": port,
+        "CONN_HEALTH_CHECKS": _env_bool("DB_CONN_HEALTH_CHECKS", True),
+        "OPTIONS": {},
     }
+    if _env_bool("DB_POOL", True):
+        # プールと永続接続は併用できないため、CONN_MAX_AGEは0のままにする
+        database["OPTIONS"]["pool"] = {
+            "min_size": _env_int("DB_POOL_MIN_SIZE", 2),
+            "max_size": _env_int("DB_POOL_MAX_SIZE", 10),
+            # 空きがない場合に待つ秒数
+            "timeout": _env_int("DB_POOL_TIMEOUT", 10),
+            # この秒数を超えた接続は作り直す
+            "max_lifetime": _env_int("DB_POOL_MAX_LIFETIME", 1800),
+            "max_idle": _env_int("DB_POOL_MAX_IDLE", 300),
+        }
+    else:
+        database["CONN_MAX_AGE"] = _env_int("DB_CONN_MAX_AGE", 60)
+    return database
+
+
+DATABASES = {
+    "default": _database(
+        os.environ.get("DB_HOST", "172.17.0.1"), os.environ.get("DB_PORT", "5432")
+    ),
 }
 
+# 読み取り専用のレプリカ (app.routers.ReadReplicaRouter)
+# DB_REPLICA_HOSTSをカンマ区切りで指定すると、app.routers.read_replicaを付けた
+# ビューの読み取りをレプリカに振り分ける
+# 書き込み後の最初の読み取りがレプリカの遅延分古いままキャッシュされうるため、
+# 遅延が大きい環境では使わないこと
+DATABASE_REPLICAS = []
+for _i, _host in enumerate(
+    filter(None, os.environ.get("DB_REPLICA_HOSTS", "").split(","))
+):
+    _host, _, _port = _host.partition(":")
+    _alias = f"replica{_i}"
+    DATABASES[_alias] = _database(_host, _port or os.environ.get("DB_PORT", "5432"))
+    DATABASES[_alias]["TEST"] = {"MIRROR": "default"}
+    DATABASE_REPLICAS.append(_alias)
+
+DATABASE_ROUTERS = ["app.routers.ReadReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -134,3 +194,65 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 PYTEST_ADDOPTS = "--disable-pytest-warnings"
+
+# 一覧系のビューでModelSerializerの代わりにFastContentSerializerを使う
+# orjson, msgpackのレンダラーではdatetimeを文字列にせずに渡す (app.renderers)
+FAST_SERIALIZATION = False
+
+# Acceptヘッダーで選ぶレンダラー、先頭が既定 (app.renderers)
+# MessagePackはmsgpackがインストールされている場合のみ
+REST_FRAMEWORK = {
+    "DEFAULT_RENDERER_CLASSES": [
+        "app.renderers.ORJSONRenderer",
+        *(["app.renderers.MessagePackRenderer"] if find_spec("msgpack") else []),
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+}
+
+# Spaceの読み取り結果のキャッシュ (app.cache)
+# 複数プロセスで動かす場合は共有キャッシュを指定する
+# "BACKEND": "app.cache.DjangoCacheBackend", "OPTIONS": {"alias": "default"}
+SPACE_CACHE = {
+    "BACKEND": "app.cache.LRUBackend",
+    "OPTIONS": {"max_entries": 1024, "max_bytes": 64 * 1024 * 1024},
+}
+
+# 1リクエスト内で同じSQLがこの回数以上実行されたらN+1として警告する (app.metrics)
+METRICS_N_PLUS_ONE_THRESHOLD = 5
+
+# Spaceの読み取りをSpaceSnapshotの主キー検索1回にする (app.snapshots)
+# 有効にした後は python manage.py rebuild_snapshots で既存のSpaceを作成しておく
+SPACE_SNAPSHOTS = False
+
+# レスポンスの圧縮 (app.compression)
+# ETagのあるレスポンスは圧縮したバイト列をCACHEに保持し、同じバージョンでは再圧縮しない
+RESPONSE_COMPRESSION = {
+    "MIN_SIZE": _env_int("COMPRESSION_MIN_SIZE", 1024),
+    "LEVELS": {"zstd": 3, "br": 4, "gzip": 6},
+    "CACHE": {
+        "BACKEND": "app.cache.LRUBackend",
+        "OPTIONS": {"max_entries": 1024, "max_bytes": 32 * 1024 * 1024},
+    },
+}
+
+# Planごとのレート制限 (app.throttling)
+# 複数プロセスで動かす場合は共有キャッシュを指定する
+# "BACKEND": "app.throttling.DjangoCacheBucketBackend", "OPTIONS": {"alias": "default"}
+# RATE_LIMIT=0で全て制限しない (負荷試験のサーバーなど、app.loadtest)
+RATE_LIMITS = {
+    "BACKEND": "app.throttling.LocalBucketBackend",
+    "OPTIONS": {"max_entries": 100_000},
+    "PLANS": {"free": "60/min", "standard": "600/min", "premium": "6000/min"},
+    # PLANSにないPlanのUser
+    "DEFAULT": "60/min",
+    # X-User-Idのない・存在しないUserのリクエスト、クライアントのIPごと
+    "ANONYMOUS": "60/min",
+    "USER_HEADER": "X-User-Id",
+    "EXEMPT_PATHS": ["/admin/", "/metrics"],
+}
+if not _env_bool("RATE_LIMIT", True):
+    RATE_LIMITS.update(PLANS={}, DEFAULT=None, ANONYMOUS=None)
+
+# referenceフィールドを展開する深さ (app.references)
+# これより深い参照はContentのidのまま返す
+REFERENCE_MAX_DEPTH = 2
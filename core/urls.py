@@ -18,6 +18,33 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from app import async_views, metrics, views
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics.metrics, name="metrics"),
+    path("spaces/<int:pk>/", views.space_detail_view, name="space-detail"),
+    path(
+        "spaces/<int:pk>/contents/",
+        views.space_content_list,
+        name="space-content-list",
+    ),
+    path(
+        "spaces/<int:pk>/contents/bulk/",
+        views.space_content_bulk,
+        name="space-content-bulk",
+    ),
+    path("spaces/<int:pk>/export/", views.space_export, name="space-export"),
+    path("spaces/<int:pk>/changes/", views.space_changes, name="space-changes"),
+    # ASGIで動かす場合の非同期版、レスポンスは同期版と同じ
+    path(
+        "async/spaces/<int:pk>/",
+        async_views.aspace_detail,
+        name="async-space-detail",
+    ),
+    path(
+        "async/spaces/<int:pk>/contents/",
+        async_views.aspace_content_list,
+        name="async-space-content-list",
+    ),
 ]
@@ -1 +1,22 @@
-export DJANGO_SETTINGS_MODULE=core.settings
\ No newline at end of file
+export DJANGO_SETTINGS_MODULE=core.settings
+
+# PostgreSQL (core.settings)
+export DB_NAME=django
+export DB_USER=postgres
+export DB_PASSWORD=postgres
+export DB_HOST=172.17.0.1
+export DB_PORT=5432
+# 再利用する前に接続が生きているか確認する
+export DB_CONN_HEALTH_CHECKS=1
+
+# psycopgのConnectionPool (DB_POOL=0なら接続をDB_CONN_MAX_AGE秒持ち続ける)
+export DB_POOL=1
+export DB_POOL_MIN_SIZE=2
+export DB_POOL_MAX_SIZE=10
+export DB_POOL_TIMEOUT=10
+export DB_POOL_MAX_LIFETIME=1800
+export DB_POOL_MAX_IDLE=300
+export DB_CONN_MAX_AGE=60
+
+# 読み取りレプリカ (host[:port]をカンマ区切り、空なら使わない)
+export DB_REPLICA_HOSTS=